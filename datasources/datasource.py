@@ -7,6 +7,7 @@ import arcpy
 import requests
 import validators
 
+from utilities import catalog
 from utilities import settings
 from utilities import util
 
@@ -24,6 +25,9 @@ class DataSource(object):
 
         self.layerdef = layerdef
 
+        # Check the source without downloading anything or clearing the download workspace
+        self.validate_only = layerdef.get('validate_only', False)
+
         self._name = None
         self.name = layerdef['tech_title']
 
@@ -55,8 +59,13 @@ class DataSource(object):
 
     @download_workspace.setter
     def download_workspace(self, d):
+        if self.validate_only:
+            self._download_workspace = d
+            return
+
         if os.path.exists(d):
             shutil.rmtree(d)
+            catalog.invalidate(d)
         util.mkdir_p(d)
         self._download_workspace = d
         
@@ -72,7 +81,7 @@ class DataSource(object):
             if validators.url(d):
                 pass
 
-            elif arcpy.Exists(d):
+            elif catalog.exists(d):
                 pass
 
             elif util.validate_osm_source(d):
@@ -117,13 +126,13 @@ class DataSource(object):
 
     @staticmethod
     def remove_all_fields_except(fc, keep_field_list):
-        field_list = [f.name for f in arcpy.ListFields(fc) if not f.required]
+        field_list = [f.name for f in catalog.fields(fc) if not f.required]
 
         for field in field_list:
             if field in keep_field_list:
                 pass
             else:
-                arcpy.DeleteField_management(fc, field)
+                catalog.delete_field(fc, field)
 
         return
 
@@ -155,6 +164,7 @@ class DataSource(object):
         """
         The basic implementation of the get_layer class. This is called in layer_decision_tree.py to download a
         a zipped feature class and return it as input to the large layer updating process
+        Datasources that check for new data return None instead if there's nothing to update
         :return: the layerdef object, updated so that layerdef['source'] now points to a local dataset, not the URL/
         other external source listed in the Google Sheet
         """
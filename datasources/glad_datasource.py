@@ -3,7 +3,6 @@ __author__ = 'Charlie.Hofmann'
 import logging
 import urlparse
 import datetime
-import sys
 
 from datasource import DataSource
 from utilities import aws_s3
@@ -24,7 +23,7 @@ class GladDataSource(DataSource):
     def get_layer(self):
         """
         Download the GLAD datasets
-        :return: an updated layerdef with the local source for the layer.update() process
+        :return: an updated layerdef with the local source for the layer.update() process, or None if no new data
         """
 
         raster_url_list = self.data_source.split(',')
@@ -42,14 +41,14 @@ class GladDataSource(DataSource):
             # Important for the script that reads the log file and sends an email
             # Including this 'Checked' message will show that we checked the layer but it didn't need updating
             logging.critical('Checked | {0}'.format(self.name))
-            sys.exit(0)
+            return None
 
         return self.layerdef
 
     def find_updated_data(self, raster_url_list):
 
         #TODO remove this
-        gs.set_value('tech_title', 'umd_landsat_alerts', 'last_updated', self.gfw_env, '12/8/1987')
+        gs.queue_value('tech_title', 'umd_landsat_alerts', 'last_updated', self.gfw_env, '12/8/1987')
 
         config_sheet_datetime_text = gs.get_value('tech_title', 'umd_landsat_alerts', 'last_updated', self.gfw_env)
         config_sheet_datetime = datetime.datetime.strptime(config_sheet_datetime_text, '%m/%d/%Y')
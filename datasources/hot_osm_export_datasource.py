@@ -5,6 +5,7 @@ import urllib2
 import logging
 import arcpy
 
+from utilities import catalog
 from utilities import util
 from utilities import field_map
 from datasource import DataSource
@@ -145,7 +146,7 @@ class HotOsmExportDataSource(DataSource):
         field_dict = {}
 
         for fc in fc_list:
-            for f in arcpy.ListFields(fc):
+            for f in catalog.fields(fc):
 
                 if not f.required:
                     try:
@@ -124,11 +124,12 @@ class ImazonDataSource(DataSource):
     def download_new_source_data(self):
         """
         Find new data on SAD website, download and unzip
-        :return:
+        :return: a list of downloaded shapefiles; empty if there's no new data
         """
         sad_urls = self.list_sad_urls()
 
         to_download = self.check_imazon_already_downloaded(sad_urls)
+        source_list = []
 
         if not to_download:
             logging.info('No new data on the imazon site')
@@ -136,11 +137,8 @@ class ImazonDataSource(DataSource):
             # Important for the script that reads the log file and sends an email
             # Including this 'Checked' message will show that we checked the layer but it didn't need updating
             logging.critical('Checked | {0}'.format(self.name))
-            sys.exit(0)
             
         else:
-            source_list = []
-
             for download_file in self.download_sad_zipfiles(to_download):
                 outdir = os.path.dirname(download_file)
                 
@@ -226,9 +224,13 @@ class ImazonDataSource(DataSource):
         Get layer method called by layer_decision_tree.py
         Will perform the entire process of finding the new Imazon URLs, downloading, unzipping, and merging to one dataset
         that can be used in our layer.update() workflow
-        :return: an updated layerdef pointing ot a local source
+        :return: an updated layerdef pointing ot a local source, or None if there's no new data
         """
         source_list = self.download_new_source_data()
+
+        if not source_list:
+            return None
+
         input_layers = self.clean_source_shps(source_list)
 
         logging.info('merging datasets: {0}'.format(', '.join(input_layers)))
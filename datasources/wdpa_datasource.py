@@ -7,6 +7,7 @@ import datetime
 import calendar
 
 from datasource import DataSource
+from utilities import catalog
 from utilities import google_sheet as gs
 
 
@@ -22,6 +23,10 @@ class WDPADatasource(DataSource):
         self.layerdef = layerdef
 
     def download_wpda_to_gdb(self):
+        """
+        Download and unzip the WDPA GDB, then set the data_source to the polygon FC inside it
+        :return: True if the download is a new version of WDPA, otherwise False
+        """
         local_file = self.download_file(self.data_source, self.download_workspace)
 
         self.unzip(local_file, self.download_workspace)
@@ -37,7 +42,8 @@ class WDPADatasource(DataSource):
 
         # Compare this to what's listed as the current version in the metadata table
         # If we're up to date for this data, exit this workflow
-        self.check_current_version(unzipped_gdb)
+        if not self.check_current_version(unzipped_gdb):
+            return False
 
         if unzipped_gdb:
             arcpy.env.workspace = unzipped_gdb
@@ -45,7 +51,7 @@ class WDPADatasource(DataSource):
             logging.error("Expected to find GDB somewhere in the unzipped dirs, but didn't. Exiting")
             sys.exit(1)
 
-        poly_list = [x for x in arcpy.ListFeatureClasses() if arcpy.Describe(x).shapeType == 'Polygon']
+        poly_list = [x for x in arcpy.ListFeatureClasses() if catalog.describe(x).shapeType == 'Polygon']
 
         if len(poly_list) != 1:
             logging.error("Expected one polygon FC in the wdpa gdb. Found {0}. Exiting now.".format(len(poly_list)))
@@ -53,6 +59,8 @@ class WDPADatasource(DataSource):
         else:
             self.data_source = os.path.join(unzipped_gdb, poly_list[0])
 
+        return True
+
     def prep_source_fc(self):
 
         simplified_fc = self.data_source + '_simplified'
@@ -73,7 +81,7 @@ class WDPADatasource(DataSource):
         If we're up to date, exit this workflow, logging that we've 'checked' the dataset
         Otherwise continue to process
         :param wdpa_gdb: the unzipped gdb just downloaded from wdpa
-        :return:
+        :return: True if the download is a new version, otherwise False
         """
 
         # Parameters required to check the metadata response spreadsheet
@@ -101,13 +109,17 @@ class WDPADatasource(DataSource):
             # Important for the script that reads the log file and sends an email
             # Including this 'Checked' message will show that we checked the layer but it didn't need updating
             logging.critical('Checked | {0}'.format(self.name))
-            sys.exit(0)
+            new_version = False
 
         # Update the value in the metadata table and continue processing the dataset
         else:
             logging.debug('Current WDPA version text is {0}, downloaded version is {1} Updating '
                           'dataset now.'.format(current_version_text, download_version_text))
-            gs.set_value(unique_col, unique_val, update_col, sheet_name, download_version_text, gs_key)
+            # Written at the end of the run, and only if the layer updates successfully
+            gs.queue_value(unique_col, unique_val, update_col, sheet_name, download_version_text, gs_key)
+            new_version = True
+
+        return new_version
 
     def parse_month_abbrev(self, download_version):
 
@@ -168,9 +180,11 @@ class WDPADatasource(DataSource):
         """
         Full process, called in layer_decision_tree.py. Downloads and preps the data
         :return: Returns and updated layerdef, used in the layer.update() process in layer_decision_tree.py
+        or None if we already have the current version of WDPA
         """
 
-        self.download_wpda_to_gdb()
+        if not self.download_wpda_to_gdb():
+            return None
 
         self.prep_source_fc()
 
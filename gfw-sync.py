@@ -1,9 +1,118 @@
 import argparse
+import logging
+import sys
 
 import layer_decision_tree
 from utilities import google_sheet as gs
+from utilities import instrumentation
 from utilities import logger
 from utilities import settings
+from utilities.cronjob import parse_update_freq
+from utilities.lazy_import import arcpy
+from utilities.run_state import RunState
+
+
+def process_layer(layername, gfw_env, run_state):
+    """
+    Build a layer from its layerdef in the config table, update it and record the update in the config table
+    :param layername: the data layer to process; must match a value for tech_title in the config
+    :param gfw_env: the environment/config files to use for this run
+    :param run_state: the RunState used to checkpoint this run
+    :return: the result of the update-- finished | checked | skipped. The layer isn't marked as finished in the
+    run_state; that waits until its config table writes have been flushed
+    """
+    layer_run_state = run_state.layer(layername)
+
+    if layer_run_state.finished:
+        logging.info('{0} already finished in run {1}; skipping'.format(layername, run_state.run_id))
+        return 'skipped'
+
+    logging.critical('Starting | {0}'.format(layername))
+
+    # Get the layerdef from the correct sheet of the config table (PROD | DEV)
+    # Config table: https://docs.google.com/spreadsheets/d/1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI/edit#gid=0
+    layerdef = gs.get_layerdef(layername, gfw_env)
+    logging.debug(layerdef)
+
+    layerdef['run_state'] = layer_run_state
+
+    # arcpy.env is global to the process; don't let the last layer's workspace or transformations carry over
+    arcpy.ResetEnvironments()
+
+    # Pass the layerdef to the build_layer function
+    layer = layer_decision_tree.build_layer(layerdef, gfw_env)
+
+    # The datasource checked for new data, didn't find any and logged this as 'Checked'
+    if not layer:
+        return 'checked'
+
+    # Update the layer in the output data sources
+    layer.update()
+
+    # The source hasn't changed since the last successful update; the layer has logged this as 'Checked'
+    if layer.source_unchanged:
+        layer.cleanup()
+        return 'checked'
+
+    # Queue an update of the last-updated timestamp in the config table; written at the end of the run
+    gs.update_gs_timestamp(layername, gfw_env)
+
+    # Delete scratch workspace
+    layer.cleanup()
+
+    logging.critical('Finished | {0}'.format(layername))
+
+    return 'finished'
+
+
+def validate_layers(layer_list, gfw_env):
+    """
+    Build each layer in validate-only mode to check its layerdef, without downloading or copying any data
+    :param layer_list: list of layer names to check
+    :param gfw_env: the environment/config files to use
+    :return: list of layers that failed validation
+    """
+    invalid_layers = []
+
+    for layername in layer_list:
+        layerdef = gs.get_layerdef(layername, gfw_env)
+
+        # Validation errors have already been logged by the setter that found them
+        try:
+            layer_decision_tree.build_layer(layerdef, gfw_env, validate_only=True)
+            logging.info('Valid | {0}'.format(layername))
+
+        except SystemExit as e:
+            if e.code:
+                logging.error('Invalid | {0}'.format(layername))
+                invalid_layers.append(layername)
+
+        except Exception:
+            logging.exception('Invalid | {0}'.format(layername))
+            invalid_layers.append(layername)
+
+    logging.info('Validated {0} layers; {1} invalid'.format(len(layer_list), len(invalid_layers)))
+
+    return invalid_layers
+
+
+def rollback_cartodb(layer_list, gfw_env):
+    """
+    Put back the cartoDB table that the last full refresh of each layer replaced
+    :param layer_list: list of layer names
+    :param gfw_env: the environment/config files to use
+    :return:
+    """
+    # Only needed for a rollback; keep it out of gfw-sync's startup imports
+    from utilities import cartodb
+
+    for layername in layer_list:
+        production_table = gs.get_layerdef(layername, gfw_env)['cartodb_service_output']
+
+        if production_table:
+            cartodb.cartodb_rollback_swap(production_table, gfw_env)
+        else:
+            logging.info('{0} has no cartodb_service_output; nothing to roll back'.format(layername))
 
 
 def main():
@@ -12,38 +121,130 @@ def main():
     parser = argparse.ArgumentParser(description='Get layer name, environment and verbosity for gfw-sync.')
     parser.add_argument('--environment', '-e', default='DEV', choices=('DEV', 'PROD'),
                         help='the environment/config files to use for this run')
-    parser.add_argument('--layer', '-l', required=True,
-                        help='the data layer to process; must match a value for tech_title in the config')
+
+    layer_group = parser.add_mutually_exclusive_group(required=True)
+    layer_group.add_argument('--layer', '-l', nargs='+',
+                             help='the data layer(s) to process; must match a value for tech_title in the config')
+    layer_group.add_argument('--all-due', action='store_true',
+                             help='process all layers scheduled to update today based on the update_days column')
+    layer_group.add_argument('--all', action='store_true',
+                             help='all layers in the config table; only used with --validate-only')
+
     parser.add_argument('--verbose', '-v', default='debug', choices=('debug', 'info', 'warning', 'error'),
                         help='set verbosity level to print and write to file')
+    parser.add_argument('--config-source', default='google',
+                        help='where to read the config table: google, or the path to a JSON file or directory of '
+                             'CSVs exported from it')
+    parser.add_argument('--refresh-config', action='store_true',
+                        help='download the config table even if a recent snapshot exists')
+    parser.add_argument('--resume', metavar='RUN_ID',
+                        help='resume a failed run, skipping the stages it completed if the source is unchanged')
+    parser.add_argument('--validate-only', action='store_true',
+                        help='check the layerdefs of the layers without downloading, copying or updating anything')
+    parser.add_argument('--rollback-cartodb', action='store_true',
+                        help='swap the cartoDB tables of the layers back to the version their last full refresh '
+                             'replaced')
     args = parser.parse_args()
 
+    if args.all and not args.validate_only:
+        parser.error('--all can only be used with --validate-only')
+
+    if args.rollback_cartodb and not args.layer:
+        parser.error('--rollback-cartodb can only be used with --layer')
+
     # Instantiate logger; write to {dir}\logs
-    logging = logger.build_logger(args.verbose)
+    logger.build_logger(args.verbose)
     logging.info("\n{0}\n{1} v{2}\n{0}\n".format('*' * 50, settings.get_settings(args.environment)['tool_info']['name'],
                                                  settings.get_settings(args.environment)['tool_info']['version']))
-    logging.critical('Starting | {0}'.format(args.layer))
 
-    # Open the correct sheet of the config table (PROD | DEV) and get the layerdef
-    # Config table: https://docs.google.com/spreadsheets/d/1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI/edit#gid=0
-    layerdef = gs.get_layerdef(args.layer, args.environment)
-	
-    print args.environment
-    print layerdef
+    gs.set_config_source(args.config_source)
 
-    # Pass the layerdef to the build_layer function
-    layer = layer_decision_tree.build_layer(layerdef, args.environment)
+    # Download the config table once (or reuse a recent snapshot); all layers processed in this run share it
+    config_snapshot = gs.load_config_snapshot(args.environment, args.refresh_config)
 
-    # Update the layer in the output data sources
-    layer.update()
+    if args.all:
+        layer_list = sorted(config_snapshot.keys())
+    elif args.all_due:
+        layer_list = sorted([layername for layername, layerdef in config_snapshot.iteritems()
+                             if parse_update_freq(layerdef['update_days'])])
+    else:
+        layer_list = args.layer
 
-    # Update the last-updated timestamp in the config table
-    gs.update_gs_timestamp(args.layer, args.environment)
+    if args.validate_only:
+        if validate_layers(layer_list, args.environment):
+            sys.exit(1)
 
-    # Delete scratch workspace
-    layer.cleanup()
+        return
+
+    if args.rollback_cartodb:
+        rollback_cartodb(layer_list, args.environment)
+        return
+
+    # Record completed work so that this run can be resumed if it fails
+    if args.resume:
+        run_state = RunState.load(args.resume)
+    else:
+        run_state = RunState.create()
+
+    logging.info('Run id: {0}'.format(run_state.run_id))
+
+    # Time arcpy tools and HTTP requests for the run reports in {dir}\logs\{date}
+    instrumentation.install()
+
+    failed_layers = []
+    updated_layers = []
+
+    for layername in layer_list:
+        instrumentation.start_report(layername, args.environment, run_state.run_id)
+        status = 'failed'
+
+        # Config table updates queued from here on belong to this layer
+        write_index = gs.pending_write_count()
+
+        # Don't let one bad layer stop the rest of the batch; the error has already been logged
+        try:
+            status = process_layer(layername, args.environment, run_state)
+
+        except SystemExit as e:
+            if e.code:
+                logging.error('Update failed for {0}'.format(layername))
+                failed_layers.append(layername)
+            else:
+                status = 'checked'
+
+        except Exception:
+            logging.exception('Update failed for {0}'.format(layername))
+            failed_layers.append(layername)
+
+        # Don't record a new version/timestamp in the config table for a layer that didn't update
+        if status == 'failed':
+            gs.discard_pending_writes(write_index)
+
+        elif status in ['finished', 'checked']:
+            updated_layers.append(layername)
+
+        # Write any chunks recorded since the state file was last written
+        run_state.save()
+
+        # Don't overwrite the report from the run that actually updated the layer
+        if status == 'skipped':
+            instrumentation.discard_report()
+        else:
+            instrumentation.finish_report(status)
+
+    # Write all queued config table updates in one batch per sheet
+    # Layers whose writes fail aren't marked as finished, so --resume runs them again
+    if not gs.flush_pending_writes():
+        logging.error('Unable to update the config table for this run')
+        logging.error('To retry, run again with --resume {0}'.format(run_state.run_id))
+        sys.exit(1)
+
+    for layername in updated_layers:
+        run_state.layer(layername).finish()
 
-    logging.critical('Finished | {0}'.format(args.layer))
+    if failed_layers:
+        logging.error('To retry the failed layers, run again with --resume {0}'.format(run_state.run_id))
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
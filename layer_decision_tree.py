@@ -1,89 +1,129 @@
 import sys
 import logging
+import importlib
 
-from layers.raster_layer import RasterLayer
-from layers.vector_layer import VectorLayer
-from layers.country_vector_layer import CountryVectorLayer
-from layers.glad_raster_layer import GladRasterLayer
-from layers.terrai_raster_layer import TerraiRasterLayer
+from utilities import google_sheet as gs
 
-from datasources.imazon_datasource import ImazonDataSource
-from datasources.glad_datasource import GladDataSource
-from datasources.terrai_datasource import TerraiDataSource
-from datasources.wdpa_datasource import WDPADatasource
-from datasources.hot_osm_export_datasource import HotOsmExportDataSource
-from datasources.forest_atlas_datasource import ForestAtlasDataSource
+# Layer type in the config table: (layer class, datasource class or None)
+# Modules are only imported the first time a layer of that type is built, so a simple_vector run doesn't
+# need boto, bs4 etc and we don't pay to import them
+LAYER_TYPES = {
+    'simple_vector': ('layers.vector_layer.VectorLayer', None),
+    'raster': ('layers.raster_layer.RasterLayer', None),
+    'country_vector': ('layers.country_vector_layer.CountryVectorLayer', None),
+    'terrai_raster': ('layers.terrai_raster_layer.TerraiRasterLayer', 'datasources.terrai_datasource.TerraiDataSource'),
+    'imazon_vector': ('layers.vector_layer.VectorLayer', 'datasources.imazon_datasource.ImazonDataSource'),
+    'glad_raster': ('layers.glad_raster_layer.GladRasterLayer', 'datasources.glad_datasource.GladDataSource'),
+    'hot_osm_export': ('layers.vector_layer.VectorLayer',
+                       'datasources.hot_osm_export_datasource.HotOsmExportDataSource'),
+    'wdpa_vector': ('layers.vector_layer.VectorLayer', 'datasources.wdpa_datasource.WDPADatasource'),
+    'forest_atlas_vector': ('layers.country_vector_layer.CountryVectorLayer',
+                            'datasources.forest_atlas_datasource.ForestAtlasDataSource'),
+}
+
+
+def load_class(class_path):
+    """
+    Import a class given its full path
+    :param class_path: module path and class name, i.e. layers.vector_layer.VectorLayer
+    :return: the class
+    """
+    module_name, class_name = class_path.rsplit('.', 1)
 
-from utilities import google_sheet as gs
+    return getattr(importlib.import_module(module_name), class_name)
 
 
-def build_layer(layerdef, gfw_env):
+def layer_from_datasource(layer_class, datasource):
     """
-    Used to get a layerdef for our layer of interest, then build a layer object based on the type of layer input
-    :param layerdef: a layerdef that defines a layers inputs/outputs from the Google Sheet
-    :param gfw_env: the environment in which we're running the script (PROD | DEV)
-    :return: a layer object to gfw-sync so that it can call the update method
+    Get the local layerdef from a datasource and use it to build a layer
+    :param layer_class: the layer class to build
+    :param datasource: a datasource object
+    :return: a layer object, or None if the datasource found no new data
     """
+    local_layerdef = datasource.get_layer()
 
-    if layerdef["type"] == "simple_vector":
-        layer = VectorLayer(layerdef)
+    if local_layerdef is None:
+        return None
 
-    elif layerdef["type"] == "raster":
-        layer = RasterLayer(layerdef)
+    return layer_class(local_layerdef)
 
-    elif layerdef["type"] == "terrai_raster":
-        datasource = TerraiDataSource(layerdef)
-        layer = TerraiRasterLayer(datasource.get_layer())
 
-    elif layerdef["type"] == "imazon_vector":
-        datasource = ImazonDataSource(layerdef)
-        layer = VectorLayer(datasource.get_layer())
+def validate_global_layer(global_layername, gfw_env):
+    """
+    Country vector layers also update their global layer, so check the global layer's layerdef before we start
+    The global layer is only validated; nothing is copied and its scratch workspace is left alone
+    :param global_layername: tech_title of the global layer
+    :param gfw_env: the environment in which we're running the script (PROD | DEV)
+    :return: the validated global layer object
+    """
+    # Get the associated layerdef for the global_layer specified by our original dataset of interest
+    # This is important because if we updated gab_logging, we also need to updated gfw_logging
+    logging.debug('Found a value for global_layer. Validating this input using the VectorLayer schema')
+    global_layerdef = gs.get_layerdef(global_layername, gfw_env)
 
-    elif layerdef["type"] == "glad_raster":
-        datasource = GladDataSource(layerdef)
-        layer = GladRasterLayer(datasource.get_layer())
+    # Use the output value as the source so that all the tests (validating that the "source" exists etc pass
+    # This allows us to leave the source field in the google spreadsheet blank for this dataset, which makes
+    # sense. The source for a global layer is made up of a bunch of smaller country layers
+    global_layerdef['source'] = global_layerdef['esri_service_output']
+    global_layerdef['validate_only'] = True
 
-    elif layerdef["type"] == "hot_osm_export":
-        datasource = HotOsmExportDataSource(layerdef)
-        layer = VectorLayer(datasource.get_layer())
+    global_layer = load_class(LAYER_TYPES['simple_vector'][0])(global_layerdef)
+    logging.debug('Global layer validation complete')
 
-    elif layerdef["type"] == "wdpa_vector":
-        datasource = WDPADatasource(layerdef)
-        layer = VectorLayer(datasource.get_layer())
+    return global_layer
 
-    elif layerdef["type"] == "forest_atlas_vector":
-        datasource = ForestAtlasDataSource(layerdef)
-        layer = CountryVectorLayer(datasource.get_layer())
 
-    elif layerdef["type"] == "country_vector":
-        if layerdef['global_layer']:
+def build_layer(layerdef, gfw_env, validate_only=False):
+    """
+    Used to get a layerdef for our layer of interest, then build a layer object based on the type of layer input
+    :param layerdef: a layerdef that defines a layers inputs/outputs from the Google Sheet
+    :param gfw_env: the environment in which we're running the script (PROD | DEV)
+    :param validate_only: only validate the layerdef. Datasources don't download anything, the source isn't
+    copied locally and nothing is created on disk
+    :return: a layer object to gfw-sync so that it can call the update method. None if the datasource for this
+    layer has checked for new data and didn't find any
+    """
+    layer_type = layerdef["type"]
 
-            # Get the associated layerdef for the global_layer specified by our original dataset of interest
-            # This is important because if we updated gab_logging, we also need to updated gfw_logging
-            logging.debug('Found a value for global_layer. Validating this input using the VectorLayer schema')
-            global_layerdef = gs.get_layerdef(layerdef['global_layer'], gfw_env)
+    if layer_type == "global_vector":
+        # Global layers are updated through their country layers, but can still be validated on their own
+        if validate_only:
+            return validate_global_layer(layerdef['tech_title'], gfw_env)
 
-            # Use the output value as the source so that all the tests (validating that the "source" exists etc pass
-            # This allows us to leave the source field in the google spreadsheet blank for this dataset, which makes
-            # sense. The source for a global layer is made up of a bunch of smaller country layers
-            global_layerdef['source'] = global_layerdef['esri_service_output']
-            VectorLayer(global_layerdef)
-            logging.debug('Global layer validation complete')
+        logging.error('Please update global vector data by updating a country_vector dataset and specifying '
+                      'the global layer in the global_layer column \n Exiting now.')
+        sys.exit(1)
 
-            layer = CountryVectorLayer(layerdef)
+    elif layer_type not in LAYER_TYPES:
+        logging.error("Layer type {0} unknown".format(layer_type))
+        sys.exit(1)
 
-        else:
+    if layer_type == "country_vector":
+        if not layerdef['global_layer']:
             logging.error('Expecting to find global_layer associated with country_vector but did not.'
                           'If no global_layer associated, this should be classified as simple_vector. Exiting.')
             sys.exit(1)
 
-    elif layerdef["type"] == "global_vector":
-        logging.error('Please update global vector data by updating a country_vector dataset and specifying '
-                      'the global layer in the global_layer column \n Exiting now.')
-        sys.exit(1)
+        validate_global_layer(layerdef['global_layer'], gfw_env)
+
+    layer_class_path, datasource_class_path = LAYER_TYPES[layer_type]
+    layer_class = load_class(layer_class_path)
+
+    if validate_only:
+        layerdef = dict(layerdef, validate_only=True)
+
+        if datasource_class_path:
+            # The datasource validates the source; the layer's source is whatever the datasource downloads
+            load_class(datasource_class_path)(layerdef)
+            layerdef['source'] = None
+
+        layer = layer_class(layerdef)
+
+    elif datasource_class_path:
+        datasource = load_class(datasource_class_path)(layerdef)
+        layer = layer_from_datasource(layer_class, datasource)
 
     else:
-        logging.error("Layer type {0} unknown".format(layerdef["type"]))
-        sys.exit(1)
+        layer = layer_class(layerdef)
 
     return layer
@@ -6,6 +6,8 @@ import sys
 import arcpy
 
 from vector_layer import VectorLayer
+from utilities import archive
+from utilities import catalog
 from utilities import google_sheet as gs
 from utilities import field_map
 from utilities import util
@@ -14,13 +16,21 @@ from utilities import util
 class CountryVectorLayer(VectorLayer):
     """
     CountryVectorLayer layer class. Inherits from VectorLayer
-    Uses the ._update method from VectorLayer to update the country-specific data, then
-    defines update_global_layer() to update the associated global layer of which it is a component
+    Uses the update graph from VectorLayer to update the country-specific data, then
+    defines add_global_layer_stages() to update the associated global layer of which it is a component
     """
+
+    checkpoint_attributes = VectorLayer.checkpoint_attributes + ['global_src', 'global_where_clause',
+                                                                 'global_country_added']
+
     def __init__(self, layerdef):
         logging.debug('Starting country_vector_layer')
         super(CountryVectorLayer, self).__init__(layerdef)
 
+        self.global_src = None
+        self.global_where_clause = None
+        self.global_country_added = False
+
     def apply_field_map_if_exists(self, field_map_path, out_dataset_name):
         """
         Check if there's a field map to go from the country specific data to global data
@@ -108,10 +118,11 @@ class CountryVectorLayer(VectorLayer):
 
         return country_populated
 
-    def update_global_layer(self, global_layerdef):
+    def prepare_global_source(self, global_layerdef):
         """
-        Using the just-updated country vector data, grab the associated global_layer and update it, making sure to
+        Using the just-updated country vector data, build the source used to update the global layer, making sure to
         check that the country field is populated in the source and exists in esri and cartodb outputs
+        Sets self.global_src, self.global_where_clause and self.global_country_added for the stages that follow
         :param global_layerdef:
         :return:
         """
@@ -120,7 +131,7 @@ class CountryVectorLayer(VectorLayer):
         country_src = self.apply_field_map_if_exists(global_layerdef['field_map'], global_layerdef['tech_title'])
 
         # Add country field and populate
-        country_added = self.add_and_populate_country_field(country_src)
+        self.global_country_added = self.add_and_populate_country_field(country_src)
 
         # Make sure that both input and output FCs have the 'country' field
         # Otherwise can't reliably append/delete based on ISO code
@@ -131,38 +142,81 @@ class CountryVectorLayer(VectorLayer):
         if self.check_country_fields(country_fc_list) and self.check_country_populated(country_src):
 
             # Build a where clause to add/delete where country = '{ISO}'
-            where_clause = """{0} = '{1}'""".format(global_layerdef['merge_where_field'], self.add_country_value)
-
-            # Append our country-specific data to the global output
-            self.append_to_esri_source(country_src, global_layerdef['esri_service_output'], where_clause)
-
-            # Zip the global output for archive and download
-            self._archive(global_layerdef['esri_service_output'], global_layerdef['download_output'],
-                          global_layerdef['archive_output'])
-
-            # Append our country-specific data to the global output
-            self.sync_cartodb(country_src, global_layerdef['cartodb_service_output'], where_clause)
+            self.global_where_clause = """{0} = '{1}'""".format(global_layerdef['merge_where_field'],
+                                                                self.add_country_value)
+            self.global_src = country_src
 
         else:
             logging.error("Field country not present or not populated in input/output FCs. Exiting.")
             sys.exit(1)
 
-        # Delete the country field if we had to add it for this purpose
-        if country_added:
-            arcpy.DeleteField_management(country_src, 'country')
+    def cleanup_global_source(self):
+        """
+        Delete the country field if we had to add it to update the global layer
+        :return:
+        """
+        if self.global_country_added:
+            catalog.delete_field(self.global_src, 'country')
 
-    def update(self):
+    def add_global_layer_stages(self, graph, global_layerdef):
         """
-        Carry out the standard VectorLayer update for the country-specific data (self._update())
-        Then grab the global_layerdef and use that to update the global layer of which this is a part
+        Add the stages that update the global layer to the update graph for the country-specific data
+        :param graph: StageGraph built by build_update_graph()
+        :param global_layerdef: the layerdef of the global layer
         :return:
         """
 
-        # Update the country-specific layer-- same as for a standard vector layer
-        self._update()
+        # If there's no field map to the global schema, the global source is our esri_service_output itself
+        # Wait for all other stages that read it before adding a country field to it
+        if global_layerdef['field_map']:
+            prepare_depends_on = ['append_to_esri_source']
+        else:
+            prepare_depends_on = ['vector_to_raster', 'update_esri_metadata', 'update_tile_cache',
+                                  'create_archive_and_download_zip', 'sync_cartodb']
+
+        # Stages that run arcpy tools in this process run one at a time; see StageGraph
+        graph.add_stage('prepare_global_source', lambda: self.prepare_global_source(global_layerdef),
+                        prepare_depends_on, uses_arcpy=True)
+
+        # Append our country-specific data to the global output
+        graph.add_stage('append_to_global_esri_source',
+                        lambda: self.append_to_esri_source(self.global_src, global_layerdef['esri_service_output'],
+                                                           self.global_where_clause),
+                        ['prepare_global_source'], uses_arcpy=True)
+
+        # Zip the global output for archive and download
+        graph.add_stage('archive_global_layer',
+                        lambda: graph.run_in_process(archive.zip_file, global_layerdef['esri_service_output'],
+                                                     self.scratch_workspace, global_layerdef['download_output'],
+                                                     global_layerdef['archive_output']),
+                        ['append_to_global_esri_source'])
+
+        # Append our country-specific data to the global cartodb output
+        graph.add_stage('sync_global_cartodb',
+                        lambda: self.sync_cartodb(self.global_src, global_layerdef['cartodb_service_output'],
+                                                  self.global_where_clause, graph.run_in_process),
+                        ['prepare_global_source'])
+
+        graph.add_stage('cleanup_global_source', self.cleanup_global_source,
+                        ['append_to_global_esri_source', 'sync_global_cartodb'], uses_arcpy=True)
+
+    def update(self):
+        """
+        Carry out the standard VectorLayer update for the country-specific data
+        Then grab the global_layerdef and use that to update the global layer of which this is a part. Both updates
+        run as one graph of stages, so the global layer can start as soon as the country data has been appended
+        :return:
+        """
 
         # Grab the info about the global layer that we need to update
         global_layerdef = gs.get_layerdef(self.global_layer, self.gfw_env)
 
+        self.restore_run_state()
+
+        # Update the country-specific layer-- same as for a standard vector layer
+        graph = self.build_update_graph()
+
         # Update the global layer using it's own layerdef
-        self.update_global_layer(global_layerdef)
+        self.add_global_layer_stages(graph, global_layerdef)
+
+        self.run_update_graph(graph)
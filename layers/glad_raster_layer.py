@@ -7,6 +7,7 @@ import logging
 import arcpy
 
 from layers.global_forest_change_layer import GlobalForestChangeLayer
+from utilities import instrumentation
 
 
 class GladRasterLayer(GlobalForestChangeLayer):
@@ -29,6 +30,7 @@ class GladRasterLayer(GlobalForestChangeLayer):
         update_glad.copy_to_esri_output_multiple()
         update.glad.calculate_stats()
 
+    @instrumentation.stage
     def start_visualization_process(self):
 
         self.set_processing_server_state('running')
@@ -45,6 +47,7 @@ class GladRasterLayer(GlobalForestChangeLayer):
         cmd = ['fab', 'kickoff:GLAD', '-i', pem_file, '-H', host_name]
         self.proc = subprocess.Popen(cmd, cwd=utilities_dir, stdout=subprocess.PIPE)
 
+    @instrumentation.stage
     def finish_visualization_process(self):
 
         while True:
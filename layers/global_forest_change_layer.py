@@ -6,6 +6,7 @@ import boto.ec2
 
 from layers.raster_layer import RasterLayer
 from utilities import util
+from utilities import instrumentation
 
 
 class GlobalForestChangeLayer(RasterLayer):
@@ -20,6 +21,7 @@ class GlobalForestChangeLayer(RasterLayer):
         self.server_name = 'TERRANLYSIS-GFW-DEV'
         self.server_ip = None
 
+    @instrumentation.stage
     def archive_source_rasters(self):
         """
         Create timestamped backup of source datasets
@@ -28,6 +30,7 @@ class GlobalForestChangeLayer(RasterLayer):
         for ras in self.source:
             self.archive_source(ras)
 
+    @instrumentation.stage
     def copy_to_esri_output_multiple(self):
         """
         Copy inputs downloaded from the source to the proper output location
@@ -39,6 +42,7 @@ class GlobalForestChangeLayer(RasterLayer):
         for input_ras, output_ras in input_output_tuples:
             self.copy_to_esri_output(input_ras, output_ras)
 
+    @instrumentation.stage
     def calculate_stats(self):
         '''
         calculate stats on rasters and mosaics
@@ -1,7 +1,10 @@
+import json
+import hashlib
 import logging
 import os
 import shutil
 import sys
+import threading
 import arcpy
 
 from utilities import archive
@@ -10,6 +13,9 @@ from utilities import util
 from utilities import field_map
 from utilities import metadata
 from utilities import tile_cache_service
+from utilities import instrumentation
+from utilities import catalog
+from utilities import run_state
 
 
 class Layer(object):
@@ -19,6 +25,17 @@ class Layer(object):
     :return:
     """
 
+    # Attributes saved to the run state after each update stage, and restored when resuming a run
+    checkpoint_attributes = ['_source']
+
+    # Stages that edit the source in place; the input fingerprint is updated after these
+    source_editing_stages = []
+
+    # Attributes whose setters call arcpy (Exists, Describe, ListFields, MakeFeatureLayer). arcpy isn't thread safe,
+    # so set_attributes_concurrently validates these one at a time
+    arcpy_attributes = ['source', 'esri_service_output', 'merge_where_field', 'delete_features_input_where_clause',
+                        'transformation', 'vector_to_raster_output', 'tile_cache_service']
+
     def __init__(self, layerdef):
         logging.debug('Starting layer class')
 
@@ -28,6 +45,21 @@ class Layer(object):
         self._gfw_env = None
         self.gfw_env = layerdef['gfw_env']
 
+        # LayerRunState from gfw-sync.py, used to checkpoint and resume updates
+        self.run_state = layerdef.get('run_state')
+        self.input_config = {k: v for k, v in layerdef.iteritems()
+                             if k not in ['run_state', 'last_updated', 'validate_only']}
+        self.input_source = layerdef['source']
+
+        self._input_fingerprint = None
+        self.resuming = self.check_run_state()
+
+        # Check the layerdef without copying, field mapping or creating anything on disk (i.e. to lint the config)
+        self.validate_only = layerdef.get('validate_only', False)
+
+        # Set by the update process if the source is the same as it was for the last successful update
+        self.source_unchanged = False
+
         self._scratch_workspace = None
         self.scratch_workspace = os.path.join(settings.get_settings(self.gfw_env)['paths']['scratch_workspace'],
                                               self.name)
@@ -39,46 +71,102 @@ class Layer(object):
         self.field_map = layerdef['field_map']
 
         self._source = None
-        self.source = layerdef['source']
+        self._source_is_local = False
+        self._source_lock = threading.RLock()
+        resumed_source = self.run_state.attributes().get('_source') if self.resuming else None
+
+        # Pick up the local copy of the source made in the run we're resuming, rather than copying it again
+        if resumed_source and catalog.exists(resumed_source):
+            self._source = resumed_source
+            self._source_is_local = True
+            source_list = []
+        else:
+            source_list = [('source', layerdef['source'])]
 
         self._esri_service_output = None
-        self.esri_service_output = layerdef['esri_service_output']
-
         self._cartodb_service_output = None
-        self.cartodb_service_output = layerdef['cartodb_service_output']
-
         self._merge_where_field = None
-        self.merge_where_field = layerdef['merge_where_field']
-
         self._delete_features_input_where_clause = None
-        self.delete_features_input_where_clause = layerdef['delete_features_input_where_clause']
-
         self._archive_output = None
-        self.archive_output = layerdef['archive_output']
-
         self._download_output = None
-        self.download_output = layerdef['download_output']
+        self._transformation = None
+        self._global_layer = None
+        self._add_country_value = None
+        self._vector_to_raster_output = None
+        self._tile_cache_service = None
+        self._post_process_script = None
 
-        self._esri_mosaics = None
         self.esri_mosaics = layerdef['esri_mosaics']
 
-        self._transformation = None
-        self.transformation = layerdef['transformation']
+        # These checks don't depend on each other; the ones that don't use arcpy wait on file shares or CartoDB
+        self.set_attributes_concurrently(source_list + [
+            ('esri_service_output', layerdef['esri_service_output']),
+            ('cartodb_service_output', layerdef['cartodb_service_output']),
+            ('archive_output', layerdef['archive_output']),
+            ('download_output', layerdef['download_output']),
+            ('global_layer', layerdef['global_layer']),
+            ('add_country_value', layerdef['add_country_value']),
+            ('vector_to_raster_output', layerdef['vector_to_raster_output']),
+            ('tile_cache_service', layerdef['tile_cache_service']),
+            ('post_process_script', layerdef['post_process_script'])])
+
+        # These compare the source to the outputs, so can only run once both are valid
+        self.set_attributes_concurrently([
+            ('merge_where_field', layerdef['merge_where_field']),
+            ('delete_features_input_where_clause', layerdef['delete_features_input_where_clause']),
+            ('transformation', layerdef['transformation'])])
+
+    def set_attributes_concurrently(self, attribute_list):
+        """
+        Set attributes whose setters validate independently of each other. Setters that only check CartoDB or the
+        file system each run in their own thread; those in arcpy_attributes run one after another in this thread
+        while they do. Setters log an error and call sys.exit(1) if a value is invalid; rather than stopping at
+        the first one, wait for all checks to finish so that every problem with the layerdef is reported at once
+        :param attribute_list: list of (attribute name, value) tuples
+        :return:
+        """
+        failed_attributes = []
+        failed_lock = threading.Lock()
 
-        self._global_layer = None
-        self.global_layer = layerdef['global_layer']
+        def set_attribute(attribute_name, value):
+            try:
+                setattr(self, attribute_name, value)
 
-        self._add_country_value = None
-        self.add_country_value = layerdef['add_country_value']
+            except SystemExit as e:
+                if e.code:
+                    with failed_lock:
+                        failed_attributes.append(attribute_name)
 
-        self._vector_to_raster_output = None
-        self.vector_to_raster_output = layerdef['vector_to_raster_output']
+            except Exception:
+                logging.exception('Error validating {0} for {1}'.format(attribute_name, self.name))
+                with failed_lock:
+                    failed_attributes.append(attribute_name)
 
-        self._tile_cache_service = None
-        self.tile_cache_service = layerdef['tile_cache_service']
+        thread_list = []
 
-        self._post_process_script = None
-        self.post_process_script = layerdef['post_process_script']
+        for attribute_name, value in attribute_list:
+            if attribute_name not in self.arcpy_attributes:
+                thread = threading.Thread(target=set_attribute, args=(attribute_name, value),
+                                          name='{0}.{1}'.format(self.name, attribute_name))
+                thread.daemon = True
+                thread.start()
+
+                thread_list.append(thread)
+
+        for attribute_name, value in attribute_list:
+            if attribute_name in self.arcpy_attributes:
+                set_attribute(attribute_name, value)
+
+        for thread in thread_list:
+            thread.join()
+
+        if failed_attributes:
+            # Report in the order the attributes are listed in the layerdef, not the order the checks finished
+            failed_attributes = [a for a, v in attribute_list if a in failed_attributes]
+
+            logging.error('Layer {0} failed validation of: {1}. Exiting'.format(self.name,
+                                                                              ', '.join(failed_attributes)))
+            sys.exit(1)
 
     # Validate name
     @property
@@ -98,9 +186,16 @@ class Layer(object):
 
     @scratch_workspace.setter
     def scratch_workspace(self, s):
-        if os.path.exists(s):
+        if self.validate_only:
+            self._scratch_workspace = s
+            return
+
+        # Keep the scratch workspace if we're resuming-- later stages may need data from earlier ones
+        if os.path.exists(s) and not self.resuming:
             shutil.rmtree(s)
-        os.mkdir(s)
+            catalog.invalidate(s)
+        if not os.path.exists(s):
+            os.mkdir(s)
         self._scratch_workspace = s
 
     # Validate esri_service_output
@@ -113,10 +208,14 @@ class Layer(object):
 
         l = e.split(',')
 
-        for output_path in l:
-            if not arcpy.Exists(output_path):
-                logging.error("esri_service_output {0} does not exist".format(output_path))
-                sys.exit(1)
+        # Check every path, so that all missing outputs are listed
+        missing_list = [output_path for output_path in l if not catalog.exists(output_path)]
+
+        for output_path in missing_list:
+            logging.error("esri_service_output {0} does not exist".format(output_path))
+
+        if missing_list:
+            sys.exit(1)
 
         self._esri_service_output = e
 
@@ -155,7 +254,8 @@ class Layer(object):
         :return:
         """
         if m:
-            if m not in util.list_fields(self.source, self.gfw_env):
+            # Check the fields the source will have once it's localized and any field map is applied
+            if self._source and m not in self.source_field_names():
                 logging.debug("Where clause field {0} specified for merge_where_field but "
                               "field not in source dataset".format(m))
 
@@ -193,21 +293,50 @@ class Layer(object):
                 logging.debug("delete_features_input_where_clause {0} doesn't have quoted strings. "
                               "It probably should.".format(f))
 
-            where_clause_field_name = f.split()[0].replace("'", "").replace('"', "")
+            # The field may only exist after the field map is applied; localize_source checks it then
+            if self._source and self.field_map and not self._source_is_local:
+                logging.debug("delete_features_input_where_clause '{0!s}' will be checked once the field map "
+                              "is applied to the source".format(f))
 
-            if where_clause_field_name in util.list_fields(self.source, self.gfw_env):
-                try:
-                        arcpy.MakeFeatureLayer_management(self.source, self.name, f)
+            elif self._source:
+                self.check_where_clause(self._source, f)
+
+        self._delete_features_input_where_clause = f
 
-                        # Clean up temporary feature layer after we create it
-                        arcpy.Delete_management(self.name)
+    def check_where_clause(self, fc, where_clause):
+        """
+        Check that a where clause can be used to select from a feature class. Skipped if the feature class doesn't
+        have the field it starts with
+        :param fc: the feature class to select from
+        :param where_clause: the where clause
+        :return:
+        """
+        where_clause_field_name = where_clause.split()[0].replace("'", "").replace('"', "")
 
-                except arcpy.ExecuteError:
-                    logging.error("delete_features_input_where_clause '{0!s}' is invalide "
-                                  "or delete FL failed".format(f))
-                    sys.exit(1)
+        if where_clause_field_name not in util.list_fields(fc, self.gfw_env):
+            return
 
-        self._delete_features_input_where_clause = f
+        try:
+            arcpy.MakeFeatureLayer_management(fc, self.name, where_clause)
+
+            # Clean up temporary feature layer after we create it
+            arcpy.Delete_management(self.name)
+
+        except arcpy.ExecuteError:
+            logging.error("delete_features_input_where_clause '{0!s}' is invalide "
+                          "or delete FL failed".format(where_clause))
+            sys.exit(1)
+
+    def source_field_names(self):
+        """
+        List the fields of the source as the update stages will see it. With a field map these are the output
+        fields it defines, as the source isn't field mapped until it's localized
+        :return: list of field names
+        """
+        if self.field_map and not self._source_is_local:
+            return [k for k in self.field_map.keys() if k != '__joins__']
+
+        return util.list_fields(self._source, self.gfw_env)
 
     # Validate layer_type
     @property
@@ -249,75 +378,111 @@ class Layer(object):
     # Validate source
     @property
     def source(self):
+        """
+        The source, copied locally the first time it's needed. Outside of validate_only mode, anything that
+        reads the source data should use this rather than _source
+        :return: path to the source
+        """
+        if not self._source_is_local and not self.validate_only:
+            self.localize_source()
+
         return self._source
 
     @source.setter
     def source(self, s):
         """
-        Validates source; can apply a fieldmap to an FC, also will copy locally if an external dataset
+        Validates that the source exists. Applying the field map or copying a network source locally is
+        left to localize_source, so that validating a layer doesn't copy any data
         :param s:
         :return:
         """
+        # Layers built from a datasource have no source to check until the datasource downloads it
+        if s is None and self.validate_only:
+            logging.debug('No source to validate for {0}; it comes from a datasource'.format(self.name))
+            self._source = None
+            self._source_is_local = True
+            return
+
         valid = True
 
         if type(s) is list:
             for path in s:
-                if not arcpy.Exists(path):
+                if not catalog.exists(path):
                     valid = False
                     break
 
         else:
-            if not arcpy.Exists(s):
+            if not catalog.exists(s):
                 valid = False
 
         if not valid:
             logging.error("Cannot find source {0!s} Exiting".format(s))
             sys.exit(1)
 
-        # If there's a field map, use it as an input to the FeatureClassToFeatureClass tool and copy the data locally
-        if self.field_map:
-            s = field_map.ini_fieldmap_to_fc(s, self.name, self.field_map, self.scratch_workspace)
+        with self._source_lock:
+            self._source = s
 
-        elif type(s) is list:
-            # If we're dealing with a list (currently only GLAD and Terra-I, we can skip this validation)
-            pass
+            # If we're dealing with a list (currently only GLAD and Terra-I), there's nothing to copy
+            self._source_is_local = type(s) is list and not self.field_map
 
-        # If there's not a field map, need to figure out what type of data source it is, and if it's local or not
-        else:
-            # This could be a folder, a gdb/mdb, a featuredataset, or an SDE database
-            source_dirname = os.path.dirname(s)
+    def localize_source(self):
+        """
+        Apply the field map to the source, or copy it locally if it's an external dataset. Called the first time
+        the source is read, rather than when the layer is built
+        :return:
+        """
+        with self._source_lock:
+            if self._source_is_local:
+                return
 
-            # we want to simply determine if this is local/not local so we can copy the datasource
-            # first determine if our source dataset is within a featuredataset
+            s = self._source
 
-            desc = arcpy.Describe(source_dirname)
-            if hasattr(desc, "datasetType") and desc.datasetType == 'FeatureDataset':
-                source_dirname = os.path.dirname(source_dirname)
+            # If there's a field map, use it as an input to the FeatureClassToFeatureClass tool and copy the
+            # data locally
+            if self.field_map:
+                s = field_map.ini_fieldmap_to_fc(s, self.name, self.field_map, self.scratch_workspace)
 
-            # Test if it's an SDE database
-            try:
-                server_address = arcpy.Describe(source_dirname).connectionProperties.server
+                # Couldn't be checked against the source before its fields were mapped
+                if self.delete_features_input_where_clause:
+                    self.check_where_clause(s, self.delete_features_input_where_clause)
 
-                # If source SDE is localhost, don't need to worry about copying anywhere
-                if server_address == 'localhost':
-                    pass
-                else:
-                    s = util.copy_to_scratch_workspace(self.source, self.scratch_workspace)
+            # If there's not a field map, need to figure out what type of data source it is, and if it's local or not
+            else:
+                # This could be a folder, a gdb/mdb, a featuredataset, or an SDE database
+                source_dirname = os.path.dirname(s)
+
+                # we want to simply determine if this is local/not local so we can copy the datasource
+                # first determine if our source dataset is within a featuredataset
+
+                desc = catalog.describe(source_dirname)
+                if hasattr(desc, "datasetType") and desc.datasetType == 'FeatureDataset':
+                    source_dirname = os.path.dirname(source_dirname)
+
+                # Test if it's an SDE database
+                try:
+                    server_address = catalog.describe(source_dirname).connectionProperties.server
+
+                    # If source SDE is localhost, don't need to worry about copying anywhere
+                    if server_address == 'localhost':
+                        pass
+                    else:
+                        s = util.copy_to_scratch_workspace(s, self.scratch_workspace)
 
-            # Otherwise, just look at the drive letter to determine if it's local or not
-            except AttributeError:
+                # Otherwise, just look at the drive letter to determine if it's local or not
+                except AttributeError:
 
-                # Split the drive from the path returns (Letter and :), then take only the letter and lower it
-                drive = os.path.splitdrive(s)[0][0].lower()
+                    # Split the drive from the path returns (Letter and :), then take only the letter and lower it
+                    drive = os.path.splitdrive(s)[0][0].lower()
 
-                if drive in util.list_network_drives():
-                    s = util.copy_to_scratch_workspace(self.source, self.scratch_workspace)
+                    if drive in util.list_network_drives():
+                        s = util.copy_to_scratch_workspace(s, self.scratch_workspace)
 
-                elif drive not in ['c', 'd']:
-                    logging.info("Are you sure the source dataset is local to this machine? \
-                    It's not on drives C or D . . .")
+                    elif drive not in ['c', 'd']:
+                        logging.info("Are you sure the source dataset is local to this machine? \
+                        It's not on drives C or D . . .")
 
-        self._source = s
+            self._source = s
+            self._source_is_local = True
 
     # Validate transformation
     @property
@@ -327,27 +492,28 @@ class Layer(object):
     @transformation.setter
     def transformation(self, t):
 
-        if type(self.source) is list:
-            s = self.source
+        # Compare the source as listed in the config; copying it locally doesn't change its spatial reference
+        if self._source is None:
+            s = []
+            esri_output = None
+
+        elif type(self._source) is list:
+            s = self._source
             esri_output = self.esri_service_output.split(',')
 
         else:
-            s = [self.source]
+            s = [self._source]
             esri_output = [self.esri_service_output]
 
-            print self.source
-
         for dataset in s:
-            from_desc = arcpy.Describe(dataset)
-            from_srs = from_desc.spatialReference
-
-            to_srs = arcpy.Describe(esri_output[0]).spatialReference
+            from_srs = catalog.spatial_reference(dataset)
+            to_srs = catalog.spatial_reference(esri_output[0])
 
             if from_srs.GCS != to_srs.GCS:
                 if not t:
                     logging.debug("No transformation defined")
                 else:
-                    extent = from_desc.extent
+                    extent = catalog.extent(dataset)
                     transformations = arcpy.ListTransformations(from_srs, to_srs, extent)
                     if self.transformation not in transformations:
                         logging.info("Transformation {0!s}: not compatible with in- and output "
@@ -355,7 +521,6 @@ class Layer(object):
 
                         t = None
 
-            del from_desc
             del to_srs
         self._transformation = t
 
@@ -372,7 +537,7 @@ class Layer(object):
 
         archive_dir = os.path.dirname(a)
 
-        if not os.path.exists(archive_dir):
+        if not os.path.exists(archive_dir) and not self.validate_only:
             util.mkdir_p(archive_dir)
 
         self._archive_output = a
@@ -391,7 +556,7 @@ class Layer(object):
         else:
             download_dir = os.path.dirname(d)
 
-            if not os.path.exists(download_dir):
+            if not os.path.exists(download_dir) and not self.validate_only:
                 util.mkdir_p(download_dir)
 
         self._download_output = d
@@ -418,7 +583,7 @@ class Layer(object):
         if not r:
             r = None
 
-        elif not arcpy.Exists(r):
+        elif not catalog.exists(r):
             logging.error("Could not find raster_output {0}. Exiting.".format(r))
             sys.exit(1)
 
@@ -442,11 +607,11 @@ class Layer(object):
             local_server_path = t[0:arcgis_index] + 'arcgis on localhost ' + t[admin_index:]
 
             # Validate path on PROD server
-            if arcpy.Describe(t).dataType != 'MapServer':
+            if catalog.data_type(t) != 'MapServer':
                 logging.error("Tile cache service path {0} does not appear to be a map service. Exiting.".format(t))
                 sys.exit(1)
 
-            elif arcpy.Describe(local_server_path).dataType != 'MapServer':
+            elif catalog.data_type(local_server_path) != 'MapServer':
                 logging.error("Does not appear to be a corresponding map service on localhost. This is required"
                               "to prevent the PROD server from being overworked. Local server path checked: "
                               "{0}".format(local_server_path))
@@ -498,6 +663,55 @@ class Layer(object):
 
         self._add_country_value = c
 
+    def input_fingerprint(self, refresh=False):
+        """
+        Fingerprint the layer config and the input source, so that we can tell whether a run can be resumed
+        Computed once per run (for an SDE source it counts the rows), unless refresh is set
+        :param refresh: fingerprint the source again, i.e. after a stage has edited it
+        :return: md5 hex digest
+        """
+        if refresh or not self._input_fingerprint:
+            md5 = hashlib.md5()
+            md5.update(json.dumps(self.input_config, sort_keys=True))
+            md5.update(run_state.fingerprint_source(self.input_source))
+
+            self._input_fingerprint = md5.hexdigest()
+
+        return self._input_fingerprint
+
+    def check_run_state(self):
+        """
+        Compare the current input to the input recorded in the run state
+        :return: True if we're resuming a previous run of this layer, otherwise False
+        """
+        if not self.run_state:
+            return False
+
+        return self.run_state.check_fingerprint(self.input_fingerprint()) and self.run_state.has_progress()
+
+    def restore_run_state(self):
+        """
+        Restore attributes saved by the stages completed in a previous run
+        :return:
+        """
+        if self.resuming:
+            for attribute, value in self.run_state.attributes().iteritems():
+                if attribute in self.checkpoint_attributes:
+                    setattr(self, attribute, value)
+
+    def checkpoint(self, stage_name):
+        """
+        Called by the StageGraph after each stage to get the attributes to save to the run state
+        If the stage has edited the input source directly (i.e. adding gfwid to a local source), update the
+        fingerprint so that our own edits don't look like a changed source when resuming
+        :param stage_name: the stage that just finished
+        :return: dict of attributes
+        """
+        if stage_name in self.source_editing_stages and self.source == self.input_source:
+            self.run_state.update_fingerprint(self.input_fingerprint(refresh=True))
+
+        return {attribute: getattr(self, attribute) for attribute in self.checkpoint_attributes}
+
     def _archive(self, input_fc, download_output, archive_output, sr_is_local=False):
         logging.debug('Starting layer._archive')
         archive.zip_file(input_fc, self.scratch_workspace, download_output, archive_output, sr_is_local)
@@ -506,10 +720,29 @@ class Layer(object):
 
     def cleanup(self):
         shutil.rmtree(self.scratch_workspace)
+        catalog.invalidate(self.scratch_workspace)
 
-    def update_esri_metadata(self):
-        metadata.update_metadata(self.esri_service_output, self.name, self.gfw_env)
+    @instrumentation.stage
+    def update_esri_metadata(self, run_in_process=None):
+        """
+        Update the metadata of the esri_service_output from the metadata API
+        :param run_in_process: optional StageGraph.run_in_process, to run arcpy_metadata in a worker process
+        :return:
+        """
+        if run_in_process:
+            run_in_process(metadata.update_metadata, self.esri_service_output, self.name, self.gfw_env)
+        else:
+            metadata.update_metadata(self.esri_service_output, self.name, self.gfw_env)
 
-    def update_tile_cache(self):
+    @instrumentation.stage
+    def update_tile_cache(self, run_in_process=None):
+        """
+        Rebuild the tile cache of the layer's tile_cache_service, if it has one
+        :param run_in_process: optional StageGraph.run_in_process, to run the arcpy tools in a worker process
+        :return:
+        """
         if self.tile_cache_service:
-            tile_cache_service.update_cache(self.tile_cache_service, self.scratch_workspace)
+            if run_in_process:
+                run_in_process(tile_cache_service.update_cache, self.tile_cache_service, self.scratch_workspace)
+            else:
+                tile_cache_service.update_cache(self.tile_cache_service, self.scratch_workspace)
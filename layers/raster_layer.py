@@ -5,6 +5,7 @@ import logging
 import os
 
 from layer import Layer
+from utilities import instrumentation
 
 
 class RasterLayer(Layer):
@@ -19,6 +20,7 @@ class RasterLayer(Layer):
         # self.wgs84_file = None
         # self.export_file = None
 
+    @instrumentation.stage
     def archive(self):
         logging.info('Starting raster_layer.archive')
         self._archive(self.source, self.download_output, self.archive_output)
@@ -43,6 +45,7 @@ class RasterLayer(Layer):
         self._archive(ras_path, None, src_archive_output)
 
     @staticmethod
+    @instrumentation.stage
     def copy_to_esri_output(input_ras, output_ras):
         logging.info('Starting to copy from {0} to esri_service_output: {1}'.format(input_ras, output_ras))
         arcpy.CopyRaster_management(input_ras, output_ras)
@@ -5,6 +5,7 @@ import arcpy
 import logging
 
 from layers.global_forest_change_layer import GlobalForestChangeLayer
+from utilities import instrumentation
 
 
 class TerraiRasterLayer(GlobalForestChangeLayer):
@@ -78,6 +79,7 @@ class TerraiRasterLayer(GlobalForestChangeLayer):
 
         return esri_formatted
 
+    @instrumentation.stage
     def reclassify_rasters(self):
 
         source_dir = os.path.join(self.processing_dir, 'source')
@@ -105,6 +107,7 @@ class TerraiRasterLayer(GlobalForestChangeLayer):
                 logging.debug('Reclassifying {0} to {1}'.format(os.path.basename(input_ras), output_name))
                 arcpy.gp.Reclassify_sa(input_ras, "Value", remap_table, output_ras, "DATA")
 
+    @instrumentation.stage
     def project_rasters(self):
 
         reclass_dir = os.path.join(self.processing_dir, 'source', 'reclassified')
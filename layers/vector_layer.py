@@ -2,14 +2,22 @@ __author__ = 'Thomas.Maschler'
 
 import os
 import sys
+import json
 import time
+import hashlib
 import logging
 import arcpy
 import shutil
 
 from layer import Layer
+from utilities import archive
 from utilities import cartodb
+from utilities import catalog
+from utilities import fingerprint
+from utilities import instrumentation
+from utilities import settings
 from utilities import util
+from utilities.stage_graph import StageGraph
 
 
 class VectorLayer(Layer):
@@ -17,6 +25,10 @@ class VectorLayer(Layer):
     Vector layer class. Inherits from Layer
     """
 
+    checkpoint_attributes = Layer.checkpoint_attributes + ['update_where_clause']
+
+    source_editing_stages = ['update_gfwid', 'add_country_code']
+
     def __init__(self, layerdef):
         logging.debug('Starting vectorlayer')
 
@@ -75,7 +87,7 @@ class VectorLayer(Layer):
         logging.debug('Starting vector_layer.update_gfwid for {0}'.format(self.name))
 
         if "gfwid" not in util.list_fields(self.source, self.gfw_env):
-            arcpy.AddField_management(self.source, "gfwid", "TEXT", field_length=50, field_alias="GFW ID")
+            catalog.add_field(self.source, "gfwid", "TEXT", field_length=50, field_alias="GFW ID")
 
         # Required to prevent calcuate field failures-- will likely fail to hash the !Shape! object if there are
         # null geometries
@@ -125,8 +137,8 @@ class VectorLayer(Layer):
         logging.info('Starting vector_layer.append_to_esri_source for {0}'.format(self.name))
 
         # Check if source SR matches esri_service_output SR
-        from_srs = arcpy.Describe(input_fc).spatialReference
-        to_srs = arcpy.Describe(esri_output_fc).spatialReference
+        from_srs = catalog.spatial_reference(input_fc)
+        to_srs = catalog.spatial_reference(esri_output_fc)
 
         if to_srs.exportToString() != from_srs.exportToString():
 
@@ -153,7 +165,7 @@ class VectorLayer(Layer):
 
         sde_workspace = os.path.dirname(esri_output_fc)
 
-        desc = arcpy.Describe(sde_workspace)
+        desc = catalog.describe(sde_workspace)
         if hasattr(desc, "datasetType") and desc.datasetType == 'FeatureDataset':
             sde_workspace = os.path.dirname(sde_workspace)
 
@@ -180,9 +192,13 @@ class VectorLayer(Layer):
 
         esri_output_pre_append_count = int(arcpy.GetCount_management("esri_service_output_fl").getOutput(0))
         input_feature_count = int(arcpy.GetCount_management(fc_to_append).getOutput(0))
+        instrumentation.add_rows(input_feature_count)
 
         logging.debug('Starting to append to esri_service_output')
-        arcpy.Append_management(fc_to_append, "esri_service_output_fl", "NO_TEST")
+        catalog.append(fc_to_append, "esri_service_output_fl", "NO_TEST")
+
+        # The append target is a feature layer, so invalidate the dataset behind it
+        catalog.invalidate(esri_output_fc)
 
         arcpy.ReconcileVersions_management(input_database=sde_workspace, reconcile_mode="ALL_VERSIONS",
                                            target_version="sde.DEFAULT", edit_versions='gfw.' + version_name,
@@ -206,58 +222,27 @@ class VectorLayer(Layer):
 
         return
 
-    def vector_to_raster(self, input_fc):
-
+    def vector_to_raster(self, input_fc, run_in_process=None):
+        """
+        If the layer has a vector_to_raster_output, rasterize the input and replace that raster with the result
+        :param input_fc: the feature class to rasterize
+        :param run_in_process: optional StageGraph.run_in_process, to run the arcpy tools in a worker process
+        :return:
+        """
         if self.vector_to_raster_output:
+            args = (input_fc, self.vector_to_raster_output, self.scratch_workspace, self.transformation,
+                    self.gfw_env)
 
-            temp_dir = util.create_temp_dir(self.scratch_workspace)
-            arcpy.CreateFileGDB_management(temp_dir, 'temp.gdb')
-
-            # Get spatial reference of output
-            sr = arcpy.Describe(self.vector_to_raster_output).spatialReference
-
-            logging.debug('Starting to project input vector FC to the spatial reference of the output raster')
-            out_projected_fc = os.path.join(temp_dir, 'temp.gdb', 'src_prj_to_ras_sr')
-            arcpy.Project_management(input_fc, out_projected_fc, sr)
-
-            util.add_field_and_calculate(out_projected_fc, 'ras_val', 'SHORT', '', 1, self.gfw_env)
-
-            # Get cell size of output
-            cell_size = int(arcpy.GetRasterProperties_management(self.vector_to_raster_output,
-                                                                 'CELLSIZEX').getOutput(0))
-
-            arcpy.env.pyramid = "NONE"
-            arcpy.env.snapRaster = self.vector_to_raster_output
-
-            logging.debug('Rasterizing and outputting as tif')
-            out_raster = os.path.join(temp_dir, 'out.tif')
-
-            arcpy.PolygonToRaster_conversion(out_projected_fc, 'ras_val', out_raster, "CELL_CENTER", "", cell_size)
-
-            logging.debug('Copying raster {0} to output {1}'.format(out_raster, self.vector_to_raster_output))
-            arcpy.Delete_management(self.vector_to_raster_output)
-
-            # Move all related tif files to final destination
-            # Much faster than using CopyRaster_management-- just need to physically move the files
-            src_dir = os.path.dirname(out_raster)
-            src_file_name = os.path.splitext(os.path.basename(out_raster))[0]
-
-            out_dir = os.path.dirname(self.vector_to_raster_output)
-            out_file_name = os.path.splitext(os.path.basename(self.vector_to_raster_output))[0]
-
-            for extension in ['.tif', '.tfw', '.tif.aux.xml', '.tif.vat.cpg', '.tif.vat.dbf', '.tif.xml']:
-                src_file = os.path.join(src_dir, src_file_name + extension)
-                out_file = os.path.join(out_dir, out_file_name + extension)
-
-                shutil.move(src_file, out_file)
-
-        else:
-            pass
+            if run_in_process:
+                run_in_process(rasterize, *args)
+            else:
+                rasterize(*args)
 
-    def create_archive_and_download_zip(self):
+    def create_archive_and_download_zip(self, run_in_process=None):
         """
         Check if the source is wgs84; if not, create a local projection download zip
         Project to wgs84, and create a download zip and a timestamped archive zip
+        :param run_in_process: optional StageGraph.run_in_process, to run the arcpy tools in a worker process
         :return:
         """
         logging.info('Starting vector_layer.create_archive_and_download_zip for {0}'.format(self.name))
@@ -267,36 +252,32 @@ class VectorLayer(Layer):
         # this suggests that our source dataset is only part of the larger whole, which is in wgs84
         # example: imazon_sad-- we download pieces each month, project to WGS84, then share the output
         # don't want to pretend that one of those monthly local projection files is actually the entire dataset
-        if not util.is_wgs_84(self.source) and not self.merge_where_field:
-
-            download_basename = self.name + '.shp'
-            if os.path.basename(self.source) == download_basename:
-                local_coords_source = self.source
+        args = (self.name, self.source, self.esri_service_output, self.scratch_workspace, self.download_output,
+                self.archive_output, not self.merge_where_field)
 
-            # If the name of the .shp is not correct (or it's not even a .shp; create it then zip)
-            else:
-                local_coords_source = os.path.join(self.scratch_workspace, download_basename)
-                arcpy.CopyFeatures_management(self.source, local_coords_source)
-
-            # Create a separate _local.zip download file
-            self._archive(local_coords_source, self.download_output, None, True)
-
-        # Create an archive and a download file for final dataset (esri_service_output)
-        self._archive(self.esri_service_output, self.download_output, self.archive_output)
+        if run_in_process:
+            run_in_process(archive_and_download_zip, *args)
+        else:
+            archive_and_download_zip(*args)
 
-    def sync_cartodb(self, input_fc, cartodb_output_fc, where_clause):
+    def sync_cartodb(self, input_fc, cartodb_output_fc, where_clause, run_in_process=None):
         """
         Take the esri source dataset and append it to cartodb. If a where_clause specified,
         use that to build a DELETE where clause to run against the cartoDB table before appending
         :param input_fc: the source dataset
         :param cartodb_output_fc: the output table in cartoDB
         :param where_clause: a where clause to apply to select from the input_fc and to delete from the cartodb_output
+        :param run_in_process: optional StageGraph.run_in_process, to export the input in a worker process
         :return:
         """
         logging.info('Starting vector_layer.sync_cartodb for {0}. Output {1}, '
                      'wc {2}'.format(os.path.basename(input_fc), cartodb_output_fc, where_clause))
 
-        cartodb.cartodb_sync(input_fc, cartodb_output_fc, where_clause, self.gfw_env, self.scratch_workspace)
+        # Record uploaded chunks in the run state so that a resumed run can skip them
+        ledger = self.run_state.chunk_ledger(cartodb_output_fc) if self.run_state else None
+
+        cartodb.cartodb_sync(input_fc, cartodb_output_fc, where_clause, self.gfw_env, self.scratch_workspace, ledger,
+                             run_in_process)
 
     def update(self):
         """
@@ -306,30 +287,194 @@ class VectorLayer(Layer):
         """
         self._update()
 
+    def build_update_graph(self):
+        """
+        Build the graph of update stages for a vector layer. Everything up to append_to_esri_source has to run in
+        order; the stages after that only read the esri_service_output, so they can run at the same time
+        :return: a StageGraph
+        """
+        max_workers = settings.get_settings(self.gfw_env)['stages']['max_workers']
+        graph = StageGraph(self.name, max_workers, self.run_state, self.checkpoint)
+
+        # These stages run arcpy tools in this process, so only one of them runs at a time
+        graph.add_stage('archive_source', self.archive_source, uses_arcpy=True)
+
+        graph.add_stage('filter_source_dataset',
+                        lambda: self.filter_source_dataset(self.delete_features_input_where_clause),
+                        ['archive_source'], uses_arcpy=True)
+
+        graph.add_stage('update_gfwid', self.update_gfwid, ['filter_source_dataset'], uses_arcpy=True)
+
+        graph.add_stage('add_country_code', self.add_country_code, ['update_gfwid'], uses_arcpy=True)
+
+        graph.add_stage('build_update_where_clause',
+                        lambda: self.build_update_where_clause(self.source, self.merge_where_field),
+                        ['add_country_code'], uses_arcpy=True)
+
+        graph.add_stage('append_to_esri_source',
+                        lambda: self.append_to_esri_source(self.source, self.esri_service_output,
+                                                           self.update_where_clause),
+                        ['build_update_where_clause'], uses_arcpy=True)
+
+        # The arcpy work of these stages runs in worker processes, so they don't share arcpy.env or schema locks
+        graph.add_stage('vector_to_raster',
+                        lambda: self.vector_to_raster(self.esri_service_output, graph.run_in_process),
+                        ['append_to_esri_source'])
+
+        graph.add_stage('update_esri_metadata', lambda: self.update_esri_metadata(graph.run_in_process),
+                        ['append_to_esri_source'])
+
+        graph.add_stage('update_tile_cache', lambda: self.update_tile_cache(graph.run_in_process),
+                        ['append_to_esri_source'])
+
+        # Wait for the metadata so that it's included in the archive and download zips
+        graph.add_stage('create_archive_and_download_zip',
+                        lambda: self.create_archive_and_download_zip(graph.run_in_process),
+                        ['update_esri_metadata'])
+
+        # cartodb_sync exports the esri_service_output to a scratch copy before adding its temp id field, so it
+        # doesn't edit the dataset that the stages above are reading
+        graph.add_stage('sync_cartodb',
+                        lambda: self.sync_cartodb(self.esri_service_output, self.cartodb_service_output,
+                                                  self.update_where_clause, graph.run_in_process),
+                        ['append_to_esri_source'])
+
+        return graph
+
+    def source_fingerprint(self):
+        """
+        Fingerprint the layer config and the contents of the source. Fields that the update process adds to the
+        source itself are excluded, otherwise the source would look changed after every update
+        :return: md5 hex digest
+        """
+        exclude_fields = ['gfwid', 'c_temp_id']
+
+        if self.add_country_value:
+            exclude_fields.append('country')
+
+        md5 = hashlib.md5()
+        md5.update(json.dumps(self.input_config, sort_keys=True))
+        md5.update(fingerprint.fingerprint_dataset(self.source, exclude_fields))
+
+        return md5.hexdigest()
+
+    def run_update_graph(self, graph):
+        """
+        Run the update graph, unless the source is unchanged since the last successful update
+        When resuming a run, the update has already started, so always run the remaining stages
+        :param graph: the StageGraph to run
+        :return:
+        """
+        if self.resuming:
+            graph.run()
+            return
+
+        source_fingerprint = self.source_fingerprint()
+
+        if source_fingerprint == fingerprint.get_last_fingerprint(self.name, self.gfw_env):
+            logging.info('Source for {0} is unchanged since the last update'.format(self.name))
+
+            # Important for the script that reads the log file and sends an email
+            # Including this 'Checked' message will show that we checked the layer but it didn't need updating
+            logging.critical('Checked | {0}'.format(self.name))
+            self.source_unchanged = True
+
+        else:
+            graph.run()
+            fingerprint.save_fingerprint(self.name, self.gfw_env, source_fingerprint)
+
     def _update(self):
         """
         Contains all relevant update functions for a vector layer
         :return:
         """
+        self.restore_run_state()
+
+        self.run_update_graph(self.build_update_graph())
+
+
+def rasterize(input_fc, output_raster, scratch_workspace, transformation, gfw_env):
+    """
+    Rasterize a feature class to the spatial reference, cell size and extent of an existing raster, then replace
+    that raster with the result. Module-level so that it can run in a worker process
+    :param input_fc: the feature class to rasterize
+    :param output_raster: the .tif to replace
+    :param scratch_workspace: scratch workspace
+    :param transformation: geographic transformation to use when projecting the input, if any
+    :param gfw_env: gfw env
+    :return:
+    """
+    temp_dir = util.create_temp_dir(scratch_workspace)
+    arcpy.CreateFileGDB_management(temp_dir, 'temp.gdb')
+
+    # Get spatial reference of output
+    sr = catalog.spatial_reference(output_raster)
+
+    if transformation:
+        arcpy.env.geographicTransformations = transformation
 
-        self.archive_source()
+    logging.debug('Starting to project input vector FC to the spatial reference of the output raster')
+    out_projected_fc = os.path.join(temp_dir, 'temp.gdb', 'src_prj_to_ras_sr')
+    arcpy.Project_management(input_fc, out_projected_fc, sr)
 
-        self.filter_source_dataset(self.delete_features_input_where_clause)
+    util.add_field_and_calculate(out_projected_fc, 'ras_val', 'SHORT', '', 1, gfw_env)
 
-        self.update_gfwid()
+    # Get cell size of output
+    cell_size = int(arcpy.GetRasterProperties_management(output_raster, 'CELLSIZEX').getOutput(0))
 
-        self.add_country_code()
+    arcpy.env.pyramid = "NONE"
+    arcpy.env.snapRaster = output_raster
 
-        self.build_update_where_clause(self.source, self.merge_where_field)
+    logging.debug('Rasterizing and outputting as tif')
+    out_raster = os.path.join(temp_dir, 'out.tif')
 
-        self.append_to_esri_source(self.source, self.esri_service_output, self.update_where_clause)
+    arcpy.PolygonToRaster_conversion(out_projected_fc, 'ras_val', out_raster, "CELL_CENTER", "", cell_size)
 
-        self.vector_to_raster(self.esri_service_output)
+    logging.debug('Copying raster {0} to output {1}'.format(out_raster, output_raster))
+    catalog.delete(output_raster)
 
-        self.update_esri_metadata()
+    # Move all related tif files to final destination
+    # Much faster than using CopyRaster_management-- just need to physically move the files
+    src_dir = os.path.dirname(out_raster)
+    src_file_name = os.path.splitext(os.path.basename(out_raster))[0]
 
-        self.update_tile_cache()
+    out_dir = os.path.dirname(output_raster)
+    out_file_name = os.path.splitext(os.path.basename(output_raster))[0]
+
+    for extension in ['.tif', '.tfw', '.tif.aux.xml', '.tif.vat.cpg', '.tif.vat.dbf', '.tif.xml']:
+        src_file = os.path.join(src_dir, src_file_name + extension)
+        out_file = os.path.join(out_dir, out_file_name + extension)
+
+        shutil.move(src_file, out_file)
+
+
+def archive_and_download_zip(layername, source, esri_service_output, scratch_workspace, download_output,
+                             archive_output, allow_local_download):
+    """
+    Create a download zip and a timestamped archive zip of the esri_service_output. If the source isn't in wgs84,
+    also create a _local.zip download in its own projection. Module-level so that it can run in a worker process
+    :param layername: tech_title of the layer
+    :param source: the layer source
+    :param esri_service_output: the updated esri output
+    :param scratch_workspace: scratch workspace
+    :param download_output: path to the download zip
+    :param archive_output: path to the archive zip
+    :param allow_local_download: create a _local.zip if the source isn't in wgs84
+    :return:
+    """
+    if allow_local_download and not util.is_wgs_84(source):
+
+        download_basename = layername + '.shp'
+        if os.path.basename(source) == download_basename:
+            local_coords_source = source
+
+        # If the name of the .shp is not correct (or it's not even a .shp; create it then zip)
+        else:
+            local_coords_source = os.path.join(scratch_workspace, download_basename)
+            arcpy.CopyFeatures_management(source, local_coords_source)
 
-        self.create_archive_and_download_zip()
+        # Create a separate _local.zip download file
+        archive.zip_file(local_coords_source, scratch_workspace, download_output, None, True)
 
-        self.sync_cartodb(self.esri_service_output, self.cartodb_service_output, self.update_where_clause)
+    # Create an archive and a download file for final dataset (esri_service_output)
+    archive.zip_file(esri_service_output, scratch_workspace, download_output, archive_output)
@@ -0,0 +1,87 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the number of requests in flight to an API, adjusting the limit to how the API is responding
+    (additive increase, multiplicative decrease). Each healthy response raises the limit by 1 / limit, so the limit
+    goes up by about one for every limit's worth of healthy responses. A response showing the API is overloaded
+    (429, 5xx, timeout) halves it
+    :param name: name used when logging changes to the limit
+    :param max_concurrency: the limit never goes above this
+    :param min_concurrency: the limit never goes below this
+    :param initial_concurrency: limit to start at; defaults to min_concurrency
+    :return:
+    """
+
+    def __init__(self, name, max_concurrency, min_concurrency=1, initial_concurrency=None):
+        self.name = name
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.min_concurrency = min(max(int(min_concurrency), 1), self.max_concurrency)
+
+        if initial_concurrency is None:
+            initial_concurrency = self.min_concurrency
+
+        self.limit = float(min(max(initial_concurrency, self.min_concurrency), self.max_concurrency))
+
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until there's room under the current limit for another request
+        :return:
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+
+            self.in_flight += 1
+
+    def release(self, healthy=True, overloaded=False):
+        """
+        Record the outcome of a request and free its place
+        :param healthy: the request succeeded
+        :param overloaded: the API is overloaded; takes precedence over healthy
+        :return:
+        """
+        with self._condition:
+            self.in_flight -= 1
+            previous_limit = int(self.limit)
+
+            if overloaded:
+                self.limit = max(self.limit / 2, self.min_concurrency)
+
+            elif healthy:
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+
+            if int(self.limit) != previous_limit:
+                logging.debug('{0} concurrency {1} -> {2}'.format(self.name, previous_limit, int(self.limit)))
+
+            self._condition.notify_all()
+
+    @contextmanager
+    def request(self, is_overloaded):
+        """
+        Hold a place under the limit while making a request
+        :param is_overloaded: function that takes an exception raised by the request and returns True if it
+        means the API is overloaded
+        :return:
+        """
+        self.acquire()
+
+        try:
+            yield
+
+        except Exception as e:
+            self.release(healthy=False, overloaded=is_overloaded(e))
+            raise
+
+        except BaseException:
+            self.release(healthy=False)
+            raise
+
+        else:
+            self.release(healthy=True)
@@ -9,6 +9,7 @@ import shutil
 import time
 import datetime
 import util
+import catalog
 import logging
 
 
@@ -128,7 +129,7 @@ def zip_file(input_fc, temp_zip_dir, download_output=None, archive_output=None,
     basepath, fname, base_fname = util.gen_paths_shp(input_fc)
     temp_dir = util.create_temp_dir(temp_zip_dir)
 
-    data_type = arcpy.Describe(input_fc).dataType
+    data_type = catalog.data_type(input_fc)
 
     if data_type in ['FeatureClass', 'ShapeFile']:
 
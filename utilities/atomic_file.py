@@ -0,0 +1,99 @@
+import os
+import sys
+import ctypes
+import tempfile
+from contextlib import contextmanager
+
+# MoveFileEx flags
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+
+def replace(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists, in one step. os.rename does this on POSIX, but on Windows it
+    fails if dst exists, and removing dst first leaves a moment where neither file is there
+    :param src: path to the new file
+    :param dst: path to replace
+    :return:
+    """
+    if sys.platform == 'win32':
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                                                  MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+
+@contextmanager
+def write(path, mode='w'):
+    """
+    Open a temp file next to path for writing, then swap it in for path once it's been written and closed. Readers
+    see either the old file or the new one, never a partly written file, and a crash mid-write leaves the old file
+    :param path: the file to write
+    :param mode: file mode, i.e. 'w' or 'wb'
+    :return: the open temp file
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    handle, temp_path = tempfile.mkstemp(prefix=basename + '.', suffix='.tmp', dir=dirname)
+
+    try:
+        with os.fdopen(handle, mode) as temp_file:
+            yield temp_file
+
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        replace(temp_path, path)
+
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@contextmanager
+def lock(path):
+    """
+    Hold an exclusive lock on {path}.lock while reading, changing and writing path, so that other processes (and
+    threads) doing the same wait rather than overwriting each other's changes
+    :param path: the file to lock
+    :return:
+    """
+    lock_path = path + '.lock'
+
+    if not os.path.exists(os.path.dirname(os.path.abspath(lock_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(lock_path)))
+
+    # Append mode, so opening the lock file never truncates it under another process
+    with open(lock_path, 'a+') as lock_file:
+        if sys.platform == 'win32':
+            import msvcrt
+
+            lock_file.seek(0)
+
+            # LK_LOCK raises IOError if the lock is still held after 10 tries a second apart; keep waiting
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass
+
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+        try:
+            yield
+
+        finally:
+            if sys.platform == 'win32':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -1,15 +1,25 @@
-import json
+import bisect
+import hashlib
 import logging
+import math
 import os
+import re
+import sqlite3
 import subprocess
 import sys
-import urllib
-import arcpy
-from collections import OrderedDict
+import threading
+import time
+from collections import OrderedDict, defaultdict
 from retrying import retry
 
 import util
+import catalog
+import cartodb_catalog
+import cartodb_client
+import cartodb_ledger
+from adaptive_concurrency import AdaptiveConcurrency
 import settings
+import instrumentation
 
 
 def run_subprocess(cmd, log=True):
@@ -46,66 +56,61 @@ def run_subprocess(cmd, log=True):
     return subprocess_list
 
 
-def generate_where_clause(start_row, end_row, where_field_name):
-    """
-    Build a series of where clauses based on a start_row, end_row, a number of ids per where_clause, and the field_name
-    Also sleeps for a minute every time the current_max_id is divisible by 20,000. Important to give the API a break
-    Per the cartoDB developers, we're hardcoding the transaction row limit to 500
-    :param start_row: the first ID to append, usually 0
-    :param end_row: the last ID in the dataset
-    :param where_field_name: the field name of the where_field
-    :return: where_clauses for all ids from start_id to end_id in the appropriate chunks
-    """
-    transaction_row_limit = 500
+# {gfw_env: AdaptiveConcurrency} limiting the chunks sent to each cartoDB account at once from this process
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+# Columns added to the validated sqlite database for the bulk loader; not copied to cartoDB
+SQLITE_FID_FIELD = 'ogc_fid'
+SQLITE_GEOMETRY_FIELD = 'geometry'
+SQLITE_WKB_FIELD = 'wkb_hex'
+SQLITE_SIZE_FIELD = 'payload_size'
+
+# Bytes added to the size of each row for the SQL around its values
+ROW_OVERHEAD_BYTES = 100
 
-    # Set the max to the start_id
-    current_max_id = start_row
+# Columns that cartoDB fills in itself; not compared when diffing a layer against its cartoDB table
+CARTODB_SYSTEM_FIELDS = ['cartodb_id', 'the_geom', 'the_geom_webmercator', 'created_at', 'updated_at']
 
-    # Iterate until the current max is > the last id of interest
-    while current_max_id <= end_row:
-        yield '{0} >= {1} and {0} < {2}'.format(where_field_name, current_max_id,
-                                                current_max_id + transaction_row_limit)
+# Rows of the production table read per request when diffing; the attributes only, so much more than a chunk
+DIFF_PAGE_ROWS = 10000
 
-        # Increment the current_max_id based on the rows we just processed
-        current_max_id += transaction_row_limit
+# Dates as written by ogr2ogr (2016/01/31 12:00:00) or returned by the SQL API (2016-01-31T12:00:00Z)
+DATE_PATTERN = re.compile(r'^(\d{4})[-/](\d{2})[-/](\d{2})(?:[T ](\d{2}:\d{2}:\d{2}))?'
+                          r'(?:\.\d+)?(?:Z|[+-]\d{2}(?::?\d{2})?)?$')
 
 
-def cartodb_sql(sql, gfw_env):
+def cartodb_sql(sql, gfw_env, timeout=None):
     """
     Execute a SQL statement using the API
     :param sql: a SQL statment
     :param gfw_env: the gfw_env-- used to grab the correct API token
+    :param timeout: optional (connect, read) timeout in seconds for this statement
     :return:
     """
 
-    logging.debug(sql)
-    key = util.get_token(settings.get_settings(gfw_env)['cartodb']['token'])
-    api_url = settings.get_settings(gfw_env)["cartodb"]["sql_api"]
+    # Don't write every row of a bulk insert to the log
+    logging.debug(sql if len(sql) <= 1000 else sql[:1000] + ' ...')
 
-    result = urllib.urlopen("{0!s}?api_key={1!s}&q={2!s}".format(api_url, key, sql))
-    json_result = json.loads(result.readlines()[0], object_pairs_hook=OrderedDict)
-
-    if "error" in json_result.keys():
-        raise SyntaxError(json_result['error'])
+    with instrumentation.measure('http', 'cartodb sql_api'):
+        json_result = cartodb_client.get_client(gfw_env).sql(sql, timeout)
 
     return json_result
 
 
 def sqlite_row_count(sqlite_db):
+    """
+    Count the rows in the validated sqlite database
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :return: row count
+    """
+    table_name = sqlite_table_name(sqlite_db)
+    conn = sqlite3.connect(sqlite_db)
 
-    ogrinfo = run_subprocess(['ogrinfo', '-q', sqlite_db])
-
-    # Grab the first line from the ogrinfo command, split it, and take the second value
-    # Example ogrinfo output: "1: tiger_conservation_landscapes (Multi Polygon)"
-    table_name = ogrinfo[0].split()[1]
-
-    ogr_row_count_text = run_subprocess(['ogrinfo', sqlite_db, '-q',
-                                         '-sql', 'SELECT count(*) FROM {0}'.format(table_name)])
-
-    # Response looks like this ['', 'Layer  name: SELECT', 'OGRFeature(SELECT):0', 'count(*) (Integer) = 76', '']
-    row_count = int(ogr_row_count_text[-2].split(' = ')[1])
-
-    return row_count
+    try:
+        return conn.execute('SELECT count(*) FROM {0}'.format(table_name)).fetchone()[0]
+    finally:
+        conn.close()
 
 
 def get_layer_type(in_fc):
@@ -121,7 +126,7 @@ def get_layer_type(in_fc):
         shapetype = ogrinfo[0].split('(')[1].lower()
 
     else:
-        shapetype = arcpy.Describe(in_fc).shapeType.lower()
+        shapetype = catalog.describe(in_fc).shapeType.lower()
 
     if 'string' in shapetype or 'line' in shapetype:
         layer_type = 'LINE'
@@ -134,7 +139,7 @@ def get_layer_type(in_fc):
     return layer_type
 
 
-def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw_env):
+def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw_env, ledger=None, id_list=None):
     """
     Create a new dataset/table on cartodb
     :param sqlite_path: path to sqlite database with geometry-cleaned FC
@@ -142,10 +147,34 @@ def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw
     :param output_table: name of the new table to create and push data to
     :param temp_id_field: temp id field that will be used to build where_clauses when uploading to cartodb
     :param gfw_env: the gfw-env-- required to pick the API key
+    :param ledger: optional StagingLedger; if it was loaded from an existing staging table, that table is kept
+    and only its missing chunks are uploaded
+    :param id_list: temp ids of the rows to upload; if None, all rows are uploaded
     :return:
     """
     logging.debug("upload data from {0} to staging table {1}".format(sqlite_path, output_table))
 
+    # Count dataset rows and compare them to the append limit we're using for each API transaction
+    row_count = sqlite_row_count(sqlite_path) if id_list is None else len(id_list)
+
+    # Each multi-row INSERT statement carries about chunk_target_bytes of data, up to insert_batch_size rows
+    cartodb_settings = settings.get_settings(gfw_env)['cartodb']
+    batch_size = int(cartodb_settings.get('insert_batch_size', 500))
+    target_bytes = int(cartodb_settings.get('chunk_target_bytes', 2000000))
+
+    where_clause_list = list(sqlite_chunk_where_clauses(sqlite_path, temp_id_field, target_bytes, batch_size,
+                                                        id_list))
+    logging.debug('Uploading {0} rows in {1} chunks'.format(row_count, len(where_clause_list)))
+
+    if ledger and ledger.has_chunks():
+        logging.debug('Resuming upload to existing staging table {0}'.format(output_table))
+        verify_staging_chunks(sqlite_path, output_table, temp_id_field, where_clause_list, ledger, gfw_env)
+        cartodb_execute_where_clause(where_clause_list, temp_id_field, sqlite_path, output_table, gfw_env,
+                                     ledger=ledger)
+        ledger.save()
+        check_row_count(output_table, row_count, gfw_env)
+        return
+
     # Create a copy of the output table for staging
     create_staging_table_sql = "CREATE TABLE {0} AS SELECT * FROM {1} WHERE cartodb_id = -9999".format(output_table,
                                                                                                        template_table)
@@ -163,11 +192,345 @@ def cartodb_create(sqlite_path, template_table, output_table, temp_id_field, gfw
     else:
         cartodb_sql("select cdb_cartodbfytable('{0}', '{1}');".format(account_name, output_table), gfw_env)
 
-    # Count dataset rows and compare them to the append limit we're using for each API transaction
-    row_count = sqlite_row_count(sqlite_path)
+    # The bulk loader selects and deletes chunks of the staging table by the temp id
+    if temp_id_field not in get_column_order(template_table, gfw_env):
+        cartodb_sql('ALTER TABLE {0} ADD COLUMN {1} integer'.format(output_table, temp_id_field), gfw_env)
+
+    # Without an index each chunk's DELETE would scan the whole (growing) staging table
+    cartodb_sql('CREATE INDEX {0} ON {1} ({2})'.format(temp_id_index_name(output_table, temp_id_field),
+                                                       output_table, temp_id_field), gfw_env)
+
+    # cdb_cartodbfytable adds the cartodb columns, so look up the new table's columns when they're next needed
+    cartodb_catalog.invalidate(output_table, gfw_env)
+
+    # Write the (empty) ledger to the new table, so that a restarted sync knows what data it holds
+    if ledger:
+        ledger.save()
+
+    # Use cartodb_execute_where_clause to append each chunk with exponential backoff
+    cartodb_execute_where_clause(where_clause_list, temp_id_field, sqlite_path, output_table, gfw_env, ledger=ledger)
+
+    if ledger:
+        ledger.save()
+
+    check_row_count(output_table, row_count, gfw_env)
+
+
+def temp_id_index_name(staging_table, temp_id_field):
+    return '{0}_{1}_idx'.format(staging_table, temp_id_field)
+
+
+def verify_staging_chunks(sqlite_db, staging_table, id_field, where_clause_list, ledger, gfw_env):
+    """
+    Count the rows of each chunk that are already in the staging table, and compare them with the sqlite database.
+    Complete chunks are marked done, even if the ledger didn't record them before the sync stopped; incomplete
+    chunks are uploaded again (the bulk insert deletes a chunk's rows before inserting it)
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param staging_table: staging table
+    :param id_field: the temp id field
+    :param where_clause_list: where clauses of the upload chunks, in id order
+    :param ledger: StagingLedger
+    :param gfw_env: gfw env
+    :return:
+    """
+    if not where_clause_list:
+        return
+
+    chunk_starts = [cartodb_ledger.parse_range(wc)[1] for wc in where_clause_list]
+
+    expected_counts = [0] * len(chunk_starts)
+
+    conn = sqlite3.connect(sqlite_db)
+
+    try:
+        for (row_id,) in conn.execute('SELECT {0} FROM {1}'.format(id_field, sqlite_table_name(sqlite_db))):
+            expected_counts[bisect.bisect_right(chunk_starts, row_id) - 1] += 1
+
+    finally:
+        conn.close()
+
+    # width_bucket returns i for ids from the start of chunk i up to the start of the next one (1-based)
+    sql = 'SELECT width_bucket({0}, ARRAY[{1}]) AS chunk, count(*) AS row_count FROM {2} GROUP BY 1'
+    row_list = cartodb_sql(sql.format(id_field, ', '.join([str(x) for x in chunk_starts]), staging_table),
+                           gfw_env)['rows']
+
+    staging_counts = dict([(row['chunk'], row['row_count']) for row in row_list])
+
+    complete_count = 0
+
+    for i, wc in enumerate(where_clause_list):
+        if staging_counts.get(i + 1, 0) == expected_counts[i]:
+            complete_count += 1
+
+            if not ledger.is_done(wc):
+                ledger.mark_done(wc)
+
+        elif ledger.is_done(wc):
+            ledger.forget(wc)
+
+    logging.info('{0} of {1} chunks already uploaded to {2}'.format(complete_count, len(where_clause_list),
+                                                                   staging_table))
+
+
+def verify_pushed_chunks(staging_table, production_table, where_clause, ledger, gfw_env):
+    """
+    Check that the rows in production in the where clause are the chunks the ledger says were pushed. If they
+    aren't (i.e. a chunk was pushed but the sync stopped before recording it), delete and push them all again
+    :param staging_table: staging table
+    :param production_table: prod table
+    :param where_clause: where clause of the rows the sync replaces; None if it replaces all rows
+    :param ledger: StagingLedger
+    :param gfw_env: gfw env
+    :return:
+    """
+    range_sql = ' OR '.join(['(cartodb_id >= {0} AND cartodb_id < {1})'.format(start, end)
+                             for start, end in ledger.field_ranges('cartodb_id')])
+
+    count_sql = 'SELECT count(*) AS row_count FROM {0} WHERE {1}'
+
+    pushed_count = cartodb_sql(count_sql.format(staging_table, range_sql or 'false'), gfw_env)['rows'][0]['row_count']
+    production_count = cartodb_sql(count_sql.format(production_table, where_clause or 'true'),
+                                   gfw_env)['rows'][0]['row_count']
+
+    if pushed_count != production_count:
+        logging.warning('{0} has {1} rows in {2}, but the ledger lists {3} rows as pushed; '
+                        'pushing all rows again'.format(production_table, production_count, where_clause,
+                                                        pushed_count))
 
-    # Use cartodb_execute_where_clause to generate where_clauses and append them with exponential backoff
-    cartodb_execute_where_clause(0, row_count, temp_id_field, sqlite_path, output_table, gfw_env)
+        ledger.forget_field('cartodb_id')
+        ledger.forget('delete_from_production')
+
+
+def sqlite_fingerprint(sqlite_db, id_field):
+    """
+    Hash the contents of the validated sqlite database, to check that an existing staging table was uploaded
+    from the same data
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param id_field: the temp id field
+    :return: md5 hex digest
+    """
+    table_name = sqlite_table_name(sqlite_db)
+    conn = sqlite3.connect(sqlite_db)
+
+    try:
+        # The geometry is included as hex WKB
+        column_list = [r[1] for r in conn.execute('PRAGMA table_info({0})'.format(table_name))
+                       if r[1].lower() != SQLITE_GEOMETRY_FIELD]
+
+        md5 = hashlib.md5()
+
+        for row in conn.execute('SELECT {0} FROM {1} ORDER BY {2}'.format(', '.join(column_list), table_name,
+                                                                          id_field)):
+            md5.update(repr(row))
+
+    finally:
+        conn.close()
+
+    return md5.hexdigest()
+
+
+def check_row_count(table_name, expected_row_count, gfw_env):
+    """
+    Check that all rows of the local dataset made it to the cartoDB table
+    :param table_name: cartoDB table
+    :param expected_row_count: number of rows in the local sqlite database
+    :param gfw_env: gfw env
+    :return:
+    """
+    table_row_count = cartodb_sql('SELECT count(*) AS row_count FROM {0}'.format(table_name),
+                                  gfw_env)['rows'][0]['row_count']
+
+    if table_row_count != expected_row_count:
+        logging.error('Uploaded {0} rows to {1}, but the local dataset has {2} rows. '
+                      'Exiting'.format(table_row_count, table_name, expected_row_count))
+        sys.exit(1)
+
+    logging.debug('Uploaded all {0} rows to {1}'.format(table_row_count, table_name))
+
+
+def sqlite_table_name(sqlite_db):
+    """
+    Get the name of the geometry table in a spatialite database created by ogr2ogr
+    :param sqlite_db: path to the sqlite database
+    :return: the table name
+    """
+    conn = sqlite3.connect(sqlite_db)
+
+    try:
+        return conn.execute('SELECT f_table_name FROM geometry_columns').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def sqlite_chunk_where_clauses(sqlite_db, id_field, target_bytes, max_rows, id_list=None):
+    """
+    Split the rows of the validated sqlite database into chunks of about target_bytes, using the payload size
+    of each row calculated when the database was built. A chunk of a few large polygons then carries about as
+    much data as a chunk of many points. A row larger than target_bytes is sent in a chunk of its own
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param id_field: the temp id field
+    :param target_bytes: approximate size of each chunk
+    :param max_rows: max rows in a chunk
+    :param id_list: ids of the rows to include; if None, all rows are included. Chunks of some of the rows list
+    their ids, rather than giving a range
+    :return: where clauses on the id field, in id order
+    """
+    table_name = sqlite_table_name(sqlite_db)
+    id_set = set(id_list) if id_list is not None else None
+
+    def chunk_where_clause(chunk_ids):
+        if id_set is None:
+            return '{0} >= {1} and {0} < {2}'.format(id_field, chunk_ids[0], chunk_ids[-1] + 1)
+        else:
+            return '{0} IN ({1})'.format(id_field, ', '.join([str(i) for i in chunk_ids]))
+
+    conn = sqlite3.connect(sqlite_db)
+
+    try:
+        sql = 'SELECT {0}, {1} FROM {2} ORDER BY {0}'.format(id_field, SQLITE_SIZE_FIELD, table_name)
+
+        chunk_ids = []
+        chunk_bytes = 0
+
+        for row_id, row_bytes in conn.execute(sql):
+            if id_set is not None and row_id not in id_set:
+                continue
+
+            if chunk_ids and (chunk_bytes + row_bytes > target_bytes or len(chunk_ids) >= max_rows):
+                yield chunk_where_clause(chunk_ids)
+
+                chunk_ids = []
+                chunk_bytes = 0
+
+            chunk_ids.append(row_id)
+            chunk_bytes += row_bytes
+
+        if chunk_ids:
+            yield chunk_where_clause(chunk_ids)
+
+    finally:
+        conn.close()
+
+
+def sqlite_add_payload_size(sqlite_db, id_field):
+    """
+    Store the approximate size of each row's values in a SQL statement, used to size the upload chunks
+    Must be run after the hex WKB has been calculated
+    Also indexes the temp id field. Without the index, selecting each chunk scans the whole table, so the upload
+    takes time proportional to the square of the row count. With the size in the index as well, choosing the
+    chunk boundaries only reads the index, and each row's values are read once, by the chunk it's in
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param id_field: the temp id field
+    :return:
+    """
+    table_name = sqlite_table_name(sqlite_db)
+    conn = sqlite3.connect(sqlite_db)
+
+    try:
+        column_list = [r[1] for r in conn.execute('PRAGMA table_info({0})'.format(table_name))
+                       if r[1].lower() not in [SQLITE_FID_FIELD, SQLITE_GEOMETRY_FIELD]]
+
+        # NULLs are sent as 'NULL'; numbers are sent as text, so length() is close for them too
+        size_sql = ' + '.join(['coalesce(length({0}), 4)'.format(c) for c in column_list])
+
+        conn.execute('ALTER TABLE {0} ADD COLUMN {1} INTEGER'.format(table_name, SQLITE_SIZE_FIELD))
+        conn.execute('UPDATE {0} SET {1} = {2} + {3}'.format(table_name, SQLITE_SIZE_FIELD, size_sql,
+                                                             ROW_OVERHEAD_BYTES))
+        conn.execute('CREATE INDEX {0}_{1}_idx ON {0} ({1}, {2})'.format(table_name, id_field, SQLITE_SIZE_FIELD))
+        conn.commit()
+
+    finally:
+        conn.close()
+
+
+def sql_literal(value):
+    """
+    Format a value read from sqlite as a SQL literal
+    :param value: None, a number or a string
+    :return: the literal
+    """
+    if value is None:
+        return 'NULL'
+
+    # repr of a long has a trailing L, and sqlite3 returns longs for big integers on Windows
+    elif isinstance(value, (int, long)):
+        return str(value)
+
+    elif isinstance(value, float):
+        # NaN and infinity aren't numeric literals in SQL; store them as NULL
+        if math.isnan(value) or math.isinf(value):
+            return 'NULL'
+
+        return repr(value)
+
+    else:
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+
+        return u"'{0}'".format(value.replace("'", "''"))
+
+
+def build_bulk_insert_sql(sqlite_db, out_table, where_clause, gfw_env):
+    """
+    Read the rows matching the where clause from the validated sqlite database and build one multi-row INSERT
+    statement for them. Geometry is sent as hex WKB, calculated when the sqlite database was built
+    The statement deletes the rows in the where clause first, so that retrying it doesn't duplicate rows
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param out_table: cartoDB table to insert into
+    :param where_clause: where clause on the temp id field
+    :param gfw_env: gfw env
+    :return: the SQL statement and the number of rows, or (None, 0) if no rows match
+    """
+    table_name = sqlite_table_name(sqlite_db)
+    out_columns = get_column_order(out_table, gfw_env)
+
+    conn = sqlite3.connect(sqlite_db)
+    conn.text_factory = unicode
+
+    try:
+        skip_columns = [SQLITE_FID_FIELD, SQLITE_GEOMETRY_FIELD, SQLITE_WKB_FIELD, SQLITE_SIZE_FIELD]
+        sqlite_columns = [r[1] for r in conn.execute('PRAGMA table_info({0})'.format(table_name))]
+
+        # Only copy columns that are in the cartoDB table; ogr2ogr lower cases the field names in sqlite
+        column_list = [c for c in sqlite_columns if c.lower() not in skip_columns and c.lower() in out_columns]
+
+        sql = 'SELECT {0} FROM {1} WHERE {2}'.format(', '.join(column_list + [SQLITE_WKB_FIELD]), table_name,
+                                                     where_clause)
+
+        value_list = []
+
+        for row in conn.execute(sql):
+            wkb_hex = row[-1]
+            geom_sql = "ST_GeomFromWKB(decode('{0}', 'hex'), 4326)".format(wkb_hex) if wkb_hex else 'NULL'
+
+            value_list.append(u'({0})'.format(u', '.join([sql_literal(v) for v in row[:-1]] + [geom_sql])))
+
+    finally:
+        conn.close()
+
+    if not value_list:
+        return None, 0
+
+    insert_sql = u'DELETE FROM {0} WHERE {1}; INSERT INTO {0} ({2}) VALUES {3}'.format(
+        out_table, where_clause, ', '.join([c.lower() for c in column_list] + ['the_geom']), u', '.join(value_list))
+
+    return insert_sql, len(value_list)
+
+
+def cartodb_bulk_insert(sqlite_db, out_table, gfw_env, where_clause):
+    """
+    Insert the rows matching the where clause from the validated sqlite database into a cartoDB table
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param out_table: cartoDB table
+    :param gfw_env: gfw env
+    :param where_clause: where clause on the temp id field
+    :return:
+    """
+    insert_sql, row_count = build_bulk_insert_sql(sqlite_db, out_table, where_clause, gfw_env)
+
+    if insert_sql:
+        cartodb_sql(insert_sql.encode('utf-8'), gfw_env)
+        instrumentation.add_rows(row_count)
 
 
 def add_fc_to_ogr2ogr_cmd(in_path, cmd):
@@ -194,43 +557,6 @@ def add_fc_to_ogr2ogr_cmd(in_path, cmd):
     return cmd
 
 
-def add_where_clause_to_ogr2ogr_cmd(in_where_clause, cmd):
-    """
-    Add where clause to cmd list of parameters if it exists
-    :param in_where_clause: where clause
-    :param cmd: current list of CMD parameters
-    :return: updated cmd list of parameters
-    """
-    if in_where_clause:
-        cmd.insert(1, '-where')
-        cmd.insert(2, in_where_clause)
-
-    return cmd
-
-
-def cartodb_append(sqlite_db_path, out_cartodb_name, gfw_env, where_clause=None):
-    """
-    Append a local FC to a cartoDB dataset
-    :param sqlite_db_path: path to local sqlite db
-    :param out_cartodb_name: cartoDB table
-    :param gfw_env: gfw_env
-    :param where_clause: where_clause to apply to the dataset
-    :return:
-    """
-    key = util.get_token(settings.get_settings(gfw_env)['cartodb']['token'])
-    account_name = get_account_name(gfw_env)
-
-    # Help: http://www.gdal.org/ogr2ogr.html
-    # The -dim 2 option ensures that only two dimensional data is created; no Z or M values
-    cmd = ['ogr2ogr', '--config', 'CARTODB_API_KEY', key, '-append', '-skipfailures', '-t_srs', 'EPSG:4326',
-           '-f', 'CartoDB',  '-nln', out_cartodb_name, '-dim', '2', 'CartoDB:{0}'.format(account_name)]
-
-    cmd = add_fc_to_ogr2ogr_cmd(sqlite_db_path, cmd)
-    cmd = add_where_clause_to_ogr2ogr_cmd(where_clause, cmd)
-
-    run_subprocess(cmd)
-
-
 def get_account_name(gfw_env):
     account_name = settings.get_settings(gfw_env)['cartodb']['token'].split('@')[0]
 
@@ -239,20 +565,12 @@ def get_account_name(gfw_env):
 
 def cartodb_check_exists(table_name, gfw_env):
     """
-    Check if the table exists by executing a LIMIT 1 query against it
+    Check if the table exists, using the cached list of tables in the account
     :param table_name: cartoDB table name
     :param gfw_env: gfw env
     :return: True | False
     """
-    sql = "SELECT * FROM {0} LIMIT 1".format(table_name)
-
-    try:
-        cartodb_sql(sql, gfw_env)
-        table_exists = True
-    except SyntaxError:
-        table_exists = False
-
-    return table_exists
+    return cartodb_catalog.table_exists(table_name, gfw_env)
 
 
 def get_column_order(table_name, gfw_env):
@@ -262,42 +580,56 @@ def get_column_order(table_name, gfw_env):
     :param gfw_env: gfw env
     :return: field list
     """
-    sql = 'SELECT * FROM {0} LIMIT 1'.format(table_name)
+    column_list = cartodb_catalog.columns(table_name, gfw_env)
 
-    return cartodb_sql(sql, gfw_env)['fields'].keys()
+    if column_list is None:
+        raise SyntaxError('relation "{0}" does not exist'.format(table_name))
 
+    return column_list
 
-def cartodb_min_max(table_name, gfw_env):
+
+def keyset_where_clauses(table_name, id_field, chunk_size, gfw_env, where_clause=None):
     """
-    Get min/max id for cartodb_id in table
+    Build where clauses that each cover chunk_size rows of a cartoDB table, however sparse its ids are. A window
+    query returns the id of every chunk_size'th row, so there's one request per chunk_size rows rather than per
+    chunk_size ids in the range min(id) to max(id)
     :param table_name: cartoDB table
+    :param id_field: integer field to split on, i.e. cartodb_id
+    :param chunk_size: rows per where clause
     :param gfw_env: gfw env
-    :return: int value of row count
+    :param where_clause: only count the rows in this where clause; the where clauses returned don't include it
+    :return: list of where clauses, in id order; empty if the table has no rows
     """
-    sql = "SELECT min(cartodb_id) as a, max(cartodb_id) as b FROM {0}".format(table_name)
-    result = cartodb_sql(sql, gfw_env)['rows'][0]
+    sql = ('SELECT {0} AS chunk_start, max_id FROM (SELECT {0}, row_number() OVER (ORDER BY {0}) AS row_num, '
+           'max({0}) OVER () AS max_id FROM {1}{3}) ids WHERE (row_num - 1) % {2} = 0 ORDER BY {0}')
+
+    filter_sql = ' WHERE {0}'.format(where_clause) if where_clause else ''
 
-    min_cartodb_id = result['a']
+    row_list = cartodb_sql(sql.format(id_field, table_name, chunk_size, filter_sql), gfw_env)['rows']
 
-    # Add 1 to this value so that it's included in any >= and < statements
-    max_cartodb_id = result['b'] + 1
+    if not row_list:
+        return []
 
-    logging.debug('CartoDB ID min: {0}, max: {1}'.format(min_cartodb_id, max_cartodb_id))
+    boundary_list = [r['chunk_start'] for r in row_list] + [row_list[0]['max_id'] + 1]
 
-    return min_cartodb_id, max_cartodb_id
+    logging.debug('{0}: {1} chunks of {2} rows'.format(table_name, len(row_list), chunk_size))
 
+    return ['{0} >= {1} and {0} < {2}'.format(id_field, start, end) for start, end in zip(boundary_list,
+                                                                                         boundary_list[1:])]
 
-def cartodb_push_to_production(staging_table, production_table, gfw_env):
+
+def cartodb_push_to_production(staging_table, production_table, gfw_env, ledger=None):
     """
     Push temporary cartoDB staging table to production by selecting rows from it and inserting into production table
     :param staging_table: staging table
     :param production_table: prod table
     :param gfw_env: gfw env
+    :param ledger: optional ChunkLedger or StagingLedger used to skip chunks already pushed
     :return:
     """
     logging.debug("push staging to production table: {0}".format(production_table))
 
-    min_cartodb_id, max_cartodb_id = cartodb_min_max(staging_table, gfw_env)
+    where_clause_list = keyset_where_clauses(staging_table, 'cartodb_id', 500, gfw_env)
 
     prod_columns = get_column_order(production_table, gfw_env)
     staging_columns = get_column_order(staging_table, gfw_env)
@@ -309,27 +641,101 @@ def cartodb_push_to_production(staging_table, production_table, gfw_env):
     sql = 'INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE {3}'
     format_tuple = (production_table, final_columns_sql, staging_table)
 
-    cartodb_execute_where_clause(min_cartodb_id, max_cartodb_id, 'cartodb_id', None, None, gfw_env, sql, format_tuple)
+    cartodb_execute_where_clause(where_clause_list, 'cartodb_id', None, None, gfw_env, sql, format_tuple, ledger)
+
+
+def get_concurrency_controller(gfw_env):
+    """
+    Get the controller that limits concurrent chunks for the gfw_env's cartoDB account. It's shared by all syncs in
+    this process, so the limit it has found carries over from one sync to the next
+    :param gfw_env: gfw env
+    :return: an AdaptiveConcurrency object
+    """
+    with _controllers_lock:
+        if gfw_env not in _controllers:
+            max_concurrency = int(settings.get_settings(gfw_env)['cartodb'].get('max_concurrency', 1))
+            _controllers[gfw_env] = AdaptiveConcurrency('CartoDB {0}'.format(get_account_name(gfw_env)),
+                                                        max_concurrency)
+
+        return _controllers[gfw_env]
 
 
-def cartodb_execute_where_clause(start_row, end_row, id_field, src_fc, out_table, gfw_env, sql=None, format_tuple=None):
+def cartodb_execute_where_clause(where_clause_list, id_field, src_fc, out_table, gfw_env, sql=None, format_tuple=None,
+                                 ledger=None):
     """
-    Generates a where clause and executes it to append to a cartodb table or execute SQL against the API
-    :param start_row: first row ID of the where clause
-    :param end_row: last row ID
-    :param id_field: field to use to build integer where clauses
+    Executes a list of where clauses to append to a cartodb table or execute SQL against the API
+    Chunks are sent from a pool of threads; the number in flight is set by the account's concurrency controller
+    :param where_clause_list: where clauses to execute, i.e. from keyset_where_clauses
+    :param id_field: field the where clauses select on
     :param src_fc: source FC, if appending from a local esri FC
     :param out_table: out table, if appending to a cartoDB table
     :param gfw_env: need to know which account to use
     :param sql: SQL statement to execute against the cartoDB API
     :param format_tuple: tuple to pass when formatting the SQL statement
+    :param ledger: optional ChunkLedger or StagingLedger; chunks it lists as done are skipped, and each completed
+    chunk is recorded
     :return:
     """
-    for wc in generate_where_clause(start_row, end_row, id_field):
-        cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc)
+    controller = get_concurrency_controller(gfw_env)
+
+    # Staging uploads are keyed by c_temp_id and pushes to production by cartodb_id, so the where clause
+    # alone identifies the chunk
+    wc_iter = (wc for wc in where_clause_list if not (ledger and ledger.is_done(wc)))
+
+    wc_lock = threading.Lock()
+    error_list = []
+
+    # Chunks are recorded under the caller's stage, and their rows and bytes count towards it
+    parent_records = instrumentation.open_records()
+
+    def worker():
+        with instrumentation.inherit(parent_records):
+            send_chunks()
+
+    def send_chunks():
+        while True:
+            with wc_lock:
+                # Stop handing out chunks once one has failed
+                wc = next(wc_iter, None) if not error_list else None
 
+            if not wc:
+                return
 
-def cartodb_make_valid_geom_local(src_fc):
+            try:
+                with instrumentation.measure('cartodb_chunk', wc):
+                    cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc, controller)
+
+                if ledger:
+                    ledger.mark_done(wc)
+
+            except BaseException as e:
+                with wc_lock:
+                    error_list.append(e)
+                return
+
+    thread_list = []
+
+    for i in range(controller.max_concurrency):
+        thread = threading.Thread(target=worker, name='{0}.chunk{1}'.format(out_table or id_field, i))
+        thread.daemon = True
+        thread.start()
+
+        thread_list.append(thread)
+
+    for thread in thread_list:
+        thread.join()
+
+    if error_list:
+        raise error_list[0]
+
+
+def cartodb_make_valid_geom_local(src_fc, temp_id_field):
+    """
+    Copy a feature class to a spatialite database, repair invalid geometries and prepare it for the bulk loader
+    :param src_fc: the feature class to upload
+    :param temp_id_field: the temp id field used to build where clauses for each chunk
+    :return: path to the sqlite database
+    """
 
     if os.path.splitext(src_fc)[1] == '.shp':
         source_dir = os.path.dirname(src_fc)
@@ -341,7 +747,8 @@ def cartodb_make_valid_geom_local(src_fc):
 
     out_sqlite_path = os.path.join(sqlite_dir, 'out.sqlite')
 
-    cmd = ['ogr2ogr', '-f', 'SQLite', out_sqlite_path]
+    # Project to WGS84 and drop Z/M values here, rather than when appending to cartoDB
+    cmd = ['ogr2ogr', '-f', 'SQLite', '-t_srs', 'EPSG:4326', '-dim', '2', out_sqlite_path]
     cmd = add_fc_to_ogr2ogr_cmd(src_fc, cmd)
     cmd += ["-dsco", "SPATIALITE=yes"]
 
@@ -354,15 +761,47 @@ def cartodb_make_valid_geom_local(src_fc):
 
     run_subprocess(cmd)
 
+    # Store the hex WKB of each geometry for the bulk loader, so it can read the rows with the sqlite3 module
+    # rather than needing the spatialite extension
+    sql = 'ALTER TABLE {0} ADD COLUMN {1} TEXT; UPDATE {0} SET {1} = Hex(AsBinary(GEOMETRY));'.format(table_name,
+                                                                                                   SQLITE_WKB_FIELD)
+    cmd = ['spatialite', out_sqlite_path, sql]
+
+    run_subprocess(cmd)
+
+    sqlite_add_payload_size(out_sqlite_path, temp_id_field)
+
     return out_sqlite_path
 
 
 @retry(wait_exponential_multiplier=1000, wait_exponential_max=512000, stop_max_delay=18000000)
-def cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc):
+def cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc, controller=None):
     """
-    Used to retry the ogr2ogr append/SQL query defined from by the where clause
+    Used to retry the bulk insert/SQL query defined from by the where clause
     Wait 2^x seconds between each retry, up to 8.5 minutes, then 8.5 minutes afterwards until we hit 5 hours
-    :param src_fc: the source fc, if appending
+    The wait between retries doesn't hold a place under the concurrency limit
+    :param src_fc: the validated sqlite database, if appending
+    :param out_table: the out table, if appending
+    :param gfw_env: gfw_env to know which cartodb account
+    :param sql: SQL to execute against the API
+    :param format_tuple: tuple to format the sql statement if {0}/{1}/etc included
+    :param wc: the where clause to add to the SQL statement
+    :param controller: optional AdaptiveConcurrency; each attempt waits for a place under its limit, and tells it
+    whether the API looked healthy or overloaded
+    :return:
+    """
+    if controller:
+        with controller.request(cartodb_client.is_overload_error):
+            cartodb_execute_chunk(src_fc, out_table, gfw_env, sql, format_tuple, wc)
+
+    else:
+        cartodb_execute_chunk(src_fc, out_table, gfw_env, sql, format_tuple, wc)
+
+
+def cartodb_execute_chunk(src_fc, out_table, gfw_env, sql, format_tuple, wc):
+    """
+    Execute the SQL statement or bulk insert for a single where clause
+    :param src_fc: the validated sqlite database, if appending
     :param out_table: the out table, if appending
     :param gfw_env: gfw_env to know which cartodb account
     :param sql: SQL to execute against the API
@@ -373,10 +812,26 @@ def cartodb_retry(src_fc, out_table, gfw_env, sql, format_tuple, wc):
     if sql:
         format_tuple += (wc,)
         sql = sql.format(*format_tuple)
-        cartodb_sql(sql, gfw_env)
+        result = cartodb_sql(sql, gfw_env)
+
+        # For INSERT/UPDATE/DELETE statements, total_rows is the number of rows affected
+        instrumentation.add_rows(result.get('total_rows', 0))
 
     else:
-        cartodb_append(src_fc, out_table, gfw_env, wc)
+        cartodb_bulk_insert(src_fc, out_table, gfw_env, wc)
+
+
+def delete_where_clause_or_truncate_sql(in_prod_table, in_wc):
+    """
+    Build the statement that clears the rows of the prod table that a sync replaces
+    :param in_prod_table: prod_table
+    :param in_wc: where clause; if None, all rows are replaced
+    :return: DELETE or TRUNCATE statement
+    """
+    if in_wc:
+        return 'DELETE FROM {0!s} WHERE {1}'.format(in_prod_table, in_wc)
+    else:
+        return 'TRUNCATE {0!s}'.format(in_prod_table)
 
 
 def cartodb_delete_where_clause_or_truncate_prod_table(in_prod_table, in_wc, in_gfw_env):
@@ -389,12 +844,450 @@ def cartodb_delete_where_clause_or_truncate_prod_table(in_prod_table, in_wc, in_
     """
     logging.debug("delete or truncate rows from production table")
 
-    if in_wc:
-        sql = 'DELETE FROM {0!s} WHERE {1}'.format(in_prod_table, in_wc)
+    cartodb_sql(delete_where_clause_or_truncate_sql(in_prod_table, in_wc), in_gfw_env)
+
+
+@retry(retry_on_exception=cartodb_client.is_overload_error, wait_exponential_multiplier=1000,
+       wait_exponential_max=60000, stop_max_attempt_number=10)
+def batch_api_request(func, *args):
+    """
+    Make a request to the Batch SQL API, retrying if it's rate limited or unavailable. SQL errors aren't retried
+    :param func: CartoDBClient method, i.e. client.get_job
+    :param args: arguments to the method
+    :return: the job dict
+    """
+    return func(*args)
+
+
+def cartodb_batch_sql(sql, gfw_env, timeout=None):
+    """
+    Run a long statement as a Batch SQL API job, rather than a request that has to finish before the SQL API's
+    HTTP timeout. Polls the job, waiting 1 second at first and doubling the wait up to 30 seconds
+    :param sql: a SQL statement; several statements separated by semicolons are run as one transaction
+    :param gfw_env: the gfw_env-- used to grab the correct API token
+    :param timeout: seconds to wait for the job before cancelling it; defaults to the batch_timeout setting
+    :return: the finished job dict
+    """
+    client = cartodb_client.get_client(gfw_env)
+
+    if timeout is None:
+        timeout = float(settings.get_settings(gfw_env)['cartodb'].get('batch_timeout', 18000))
+
+    logging.debug(sql if len(sql) <= 1000 else sql[:1000] + ' ...')
+
+    with instrumentation.measure('http', 'cartodb batch_api'):
+        job = batch_api_request(client.create_job, sql)
+        logging.debug('Submitted batch job {0}'.format(job['job_id']))
+
+        start_time = time.time()
+        poll_seconds = 1
+
+        while job['status'] in ['pending', 'running']:
+            if time.time() - start_time > timeout:
+                batch_api_request(client.cancel_job, job['job_id'])
+                logging.error('Batch job {0} did not finish in {1} seconds; cancelled it. '
+                              'Exiting'.format(job['job_id'], timeout))
+                sys.exit(1)
+
+            time.sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, 30)
+
+            job = batch_api_request(client.get_job, job['job_id'])
+
+    if job['status'] != 'done':
+        raise SyntaxError('Batch job {0} {1}: {2}'.format(job['job_id'], job['status'],
+                                                          job.get('failed_reason', '')))
+
+    logging.debug('Batch job {0} done in {1:.0f} seconds'.format(job['job_id'], time.time() - start_time))
+
+    return job
+
+
+def cartodb_batch_push_to_production(staging_table, production_table, where_clause, gfw_env):
+    """
+    Replace rows in the production table with the staging table in a single batch job. The delete and the
+    INSERT ... SELECT run in one transaction on the server, so production is never left half-replaced
+    :param staging_table: staging table
+    :param production_table: prod table
+    :param where_clause: where clause of rows to replace; if None, all rows are replaced
+    :param gfw_env: gfw env
+    :return:
+    """
+    logging.debug("push staging to production table {0} in a batch job".format(production_table))
+
+    prod_columns = get_column_order(production_table, gfw_env)
+    staging_columns = get_column_order(staging_table, gfw_env)
+
+    final_columns_sql = ', '.join([x for x in prod_columns if x in staging_columns if x != 'cartodb_id'])
+
+    sql = '{0}; INSERT INTO {1} ({2}) SELECT {2} FROM {3}'.format(
+        delete_where_clause_or_truncate_sql(production_table, where_clause), production_table, final_columns_sql,
+        staging_table)
+
+    cartodb_batch_sql(sql, gfw_env)
+
+
+def diff_key(values):
+    """
+    Normalize the values of a row so that a value read from sqlite equals the same value returned by the SQL API
+    :param values: list of values
+    :return: tuple of normalized values
+    """
+    key = []
+
+    for value in values:
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            value = float(value)
+
+        elif isinstance(value, basestring):
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+
+            date_match = DATE_PATTERN.match(value)
+
+            if date_match:
+                value = u'{0}-{1}-{2}T{3}'.format(*date_match.groups(u'00:00:00'))
+
+        key.append(value)
+
+    return tuple(key)
+
+
+def cartodb_diff(sqlite_db, production_table, where_clause, temp_id_field, gfw_env):
+    """
+    Compare the validated sqlite database with the rows of the production table in the where clause. Rows are
+    matched on gfwid (the hash of their geometry) and the values of the other columns they have in common, so
+    a feature whose attributes have changed is replaced too. Geometry isn't downloaded
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param production_table: prod table
+    :param where_clause: where clause of the rows the sync replaces; if None, all rows
+    :param temp_id_field: temp id field in the sqlite database
+    :param gfw_env: gfw env
+    :return: (temp ids of local rows to insert, cartodb_ids of remote rows to delete, local row count,
+    remote row count), or None if the local or remote dataset doesn't have a gfwid
+    """
+    table_name = sqlite_table_name(sqlite_db)
+    prod_columns = get_column_order(production_table, gfw_env)
+
+    conn = sqlite3.connect(sqlite_db)
+    conn.text_factory = unicode
+
+    try:
+        sqlite_columns = [r[1] for r in conn.execute('PRAGMA table_info({0})'.format(table_name))]
+
+        skip_columns = [SQLITE_FID_FIELD, SQLITE_GEOMETRY_FIELD, SQLITE_WKB_FIELD, SQLITE_SIZE_FIELD,
+                        temp_id_field.lower()] + CARTODB_SYSTEM_FIELDS
+
+        # gfwid first, then the other columns in common; ogr2ogr lower cases the field names in sqlite
+        column_list = sorted([c for c in sqlite_columns if c.lower() in prod_columns and c.lower() not in skip_columns],
+                             key=lambda c: (c.lower() != 'gfwid', c.lower()))
+
+        if not column_list or column_list[0].lower() != 'gfwid':
+            logging.debug('gfwid not in both {0} and {1}; unable to diff'.format(sqlite_db, production_table))
+            return None
+
+        local_sql = 'SELECT {0}, {1} FROM {2}'.format(temp_id_field, ', '.join(column_list), table_name)
+        local_rows = [(row[0], diff_key(row[1:])) for row in conn.execute(local_sql)]
+
+    finally:
+        conn.close()
+
+    remote_sql = 'SELECT cartodb_id, {0} FROM {1} WHERE {{0}}'.format(', '.join([c.lower() for c in column_list]),
+                                                                     production_table)
+
+    if where_clause:
+        remote_sql += ' AND ({0})'.format(where_clause)
+
+    # Several rows can have the same geometry and attributes, so match them one for one
+    remote_ids = defaultdict(list)
+    remote_count = 0
+
+    # Read production a page at a time, so no one request has to return the whole table before the API times out
+    for page_where_clause in keyset_where_clauses(production_table, 'cartodb_id', DIFF_PAGE_ROWS, gfw_env,
+                                                  where_clause):
+        for row in cartodb_sql(remote_sql.format(page_where_clause), gfw_env)['rows']:
+            remote_ids[diff_key([row[c.lower()] for c in column_list])].append(row['cartodb_id'])
+            remote_count += 1
+
+    insert_ids = []
+
+    for temp_id, key in local_rows:
+        if remote_ids[key]:
+            remote_ids[key].pop()
+        else:
+            insert_ids.append(temp_id)
+
+    delete_ids = sorted([cartodb_id for id_list in remote_ids.values() for cartodb_id in id_list])
+
+    return insert_ids, delete_ids, len(local_rows), remote_count
+
+
+def cartodb_diff_sync(sqlite_db, production_table, staging_table, where_clause, temp_id_field, gfw_env):
+    """
+    Update the production table by uploading only the rows that have changed, and deleting the rows that are no
+    longer in the source. If more than diff_max_changed_fraction of the rows have changed, nothing is done and
+    the caller runs the full sync
+    The diff is worked out again from what's in production each time, so a failed diff sync can just be run again
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param production_table: prod table
+    :param staging_table: staging table to upload the changed rows to
+    :param where_clause: where clause of the rows the sync replaces; if None, all rows
+    :param temp_id_field: temp id field in the sqlite database
+    :param gfw_env: gfw env
+    :return: True if production was updated, False if the full sync is needed
+    """
+    diff = cartodb_diff(sqlite_db, production_table, where_clause, temp_id_field, gfw_env)
+
+    if not diff:
+        return False
+
+    insert_ids, delete_ids, local_row_count, remote_row_count = diff
+
+    # Replacing every row counts as 1
+    changed_fraction = float(len(insert_ids) + len(delete_ids)) / max(local_row_count + remote_row_count, 1)
+    max_changed_fraction = float(settings.get_settings(gfw_env)['cartodb'].get('diff_max_changed_fraction', 0.2))
+
+    logging.info('{0}: {1} rows to insert, {2} to delete ({3:.1%} changed)'.format(production_table,
+                                                                                  len(insert_ids), len(delete_ids),
+                                                                                  changed_fraction))
+
+    if changed_fraction > max_changed_fraction:
+        logging.info('More than {0:.1%} changed; replacing all rows'.format(max_changed_fraction))
+        return False
+
+    delete_where_clause_list = ['cartodb_id IN ({0})'.format(', '.join([str(i) for i in delete_ids[i:i + 500]]))
+                                for i in range(0, len(delete_ids), 500)]
+
+    # Also drops a staging table left by an earlier full sync
+    delete_staging_table_if_exists(staging_table, gfw_env)
+
+    if insert_ids:
+        cartodb_create(sqlite_db, production_table, staging_table, temp_id_field, gfw_env, id_list=insert_ids)
+
+    if settings.get_settings(gfw_env)['cartodb'].get('push_mode', 'chunked') == 'batch':
+        sql_list = ['DELETE FROM {0} WHERE {1}'.format(production_table, wc) for wc in delete_where_clause_list]
+
+        if insert_ids:
+            final_columns = [x for x in get_column_order(production_table, gfw_env)
+                             if x in get_column_order(staging_table, gfw_env) if x != 'cartodb_id']
+            sql_list.append('INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(production_table,
+                                                                              ', '.join(final_columns),
+                                                                              staging_table))
+
+        if sql_list:
+            cartodb_batch_sql('; '.join(sql_list), gfw_env)
+
     else:
-        sql = 'TRUNCATE {0!s};'.format(in_prod_table)
+        if delete_where_clause_list:
+            cartodb_execute_where_clause(delete_where_clause_list, 'cartodb_id', None, None, gfw_env,
+                                         'DELETE FROM {0} WHERE {1}', (production_table,))
 
-    cartodb_sql(sql, in_gfw_env)
+        if insert_ids:
+            cartodb_push_to_production(staging_table, production_table, gfw_env)
+
+    if insert_ids:
+        delete_staging_table_if_exists(staging_table, gfw_env)
+
+    return True
+
+
+def previous_table_name(production_table):
+    return production_table + '_prev'
+
+
+def renamed_object(name, old_prefix, new_prefix):
+    """
+    Name an index or sequence after the table it now belongs to, i.e. prod_the_geom_idx -> prod_prev_the_geom_idx
+    :param name: current name of the index or sequence
+    :param old_prefix: the table's current name
+    :param new_prefix: the table's new name
+    :return: the new name
+    """
+    if name.startswith(old_prefix + '_'):
+        return new_prefix + name[len(old_prefix):]
+    else:
+        return '{0}_{1}'.format(new_prefix, name)
+
+
+def get_indexes(table_name, gfw_env):
+    """
+    List the indexes of a cartoDB table
+    :param table_name: cartoDB table
+    :param gfw_env: gfw env
+    :return: OrderedDict of {index name: (unique, 'USING gist (the_geom)')}
+    """
+    sql = ("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = '{0}' "
+           "ORDER BY indexname".format(table_name))
+
+    index_dict = OrderedDict()
+
+    for row in cartodb_sql(sql, gfw_env)['rows']:
+        # CREATE UNIQUE INDEX name ON schema.table USING btree (cartodb_id)
+        create_sql, using_sql = row['indexdef'].split(' USING ', 1)
+        index_dict[row['indexname']] = ('UNIQUE' in create_sql.upper(), 'USING ' + using_sql)
+
+    return index_dict
+
+
+def table_objects(table_name, gfw_env):
+    """
+    List the indexes and cartodb_id sequence of a cartoDB table, which have to be renamed along with it
+    :param table_name: cartoDB table
+    :param gfw_env: gfw env
+    :return: list of (object type, name), i.e. [('INDEX', 'prod_pkey'), ('SEQUENCE', 'prod_cartodb_id_seq')]
+    """
+    object_list = [('INDEX', index_name) for index_name in get_indexes(table_name, gfw_env)]
+
+    sequence_sql = "SELECT pg_get_serial_sequence('{0}', 'cartodb_id') AS sequence_name".format(table_name)
+    sequence_name = cartodb_sql(sequence_sql, gfw_env)['rows'][0]['sequence_name']
+
+    if sequence_name:
+        # Returned as schema.sequence; like the tables, it's referred to without the schema
+        object_list.append(('SEQUENCE', sequence_name.split('.')[-1].strip('"')))
+
+    return object_list
+
+
+def dependent_views(table_list, gfw_env):
+    """
+    List the views that select from any of the tables. A view follows its table when the table is renamed, so
+    these would be left reading the old table after a swap, and dropped with it
+    :param table_list: cartoDB tables
+    :param gfw_env: gfw env
+    :return: sorted list of view names
+    """
+    view_sql = ("SELECT DISTINCT view_name FROM information_schema.view_table_usage "
+                "WHERE table_schema = current_schema() AND table_name IN ({0})")
+
+    response = cartodb_sql(view_sql.format(', '.join(["'{0}'".format(t) for t in table_list])), gfw_env)
+
+    return sorted([row['view_name'] for row in response['rows']])
+
+
+def rename_table_sql(table_name, new_table_name, object_list):
+    """
+    Build the statements to rename a table along with its indexes and sequence, so that their names are free for
+    the table that replaces it
+    :param table_name: cartoDB table
+    :param new_table_name: new name for the table
+    :param object_list: the table's indexes and sequence, from table_objects
+    :return: list of ALTER statements
+    """
+    sql_list = ['ALTER {0} {1} RENAME TO {2}'.format(object_type, name, renamed_object(name, table_name,
+                                                                                        new_table_name))
+                for object_type, name in object_list]
+
+    sql_list.append('ALTER TABLE {0} RENAME TO {1}'.format(table_name, new_table_name))
+
+    return sql_list
+
+
+def cartodb_finish_staging_table(staging_table, production_table, temp_id_field, gfw_env):
+    """
+    Make the staging table ready to replace the production table: drop the temp id field and its index, and add the
+    indexes and grants that production has. The staging table has already been cartodbfied by cartodb_create
+    :param staging_table: staging table
+    :param production_table: prod table
+    :param temp_id_field: temp id field used to upload the staging table
+    :param gfw_env: gfw env
+    :return:
+    """
+    logging.debug("add indexes and grants from {0} to {1}".format(production_table, staging_table))
+
+    # Don't carry the upload ledger or the temp id index over to production
+    sql_list = ['COMMENT ON TABLE {0} IS NULL'.format(staging_table),
+                'DROP INDEX IF EXISTS {0}'.format(temp_id_index_name(staging_table, temp_id_field))]
+
+    if temp_id_field not in get_column_order(production_table, gfw_env):
+        sql_list.append('ALTER TABLE {0} DROP COLUMN {1}'.format(staging_table, temp_id_field))
+
+    # cdb_cartodbfytable has already indexed cartodb_id and the geometry columns; add any others production has
+    staging_index_list = get_indexes(staging_table, gfw_env).values()
+
+    for index_name, (unique, using_sql) in get_indexes(production_table, gfw_env).iteritems():
+        if (unique, using_sql) not in staging_index_list:
+            sql_list.append('CREATE {0}INDEX {1} ON {2} {3}'.format('UNIQUE ' if unique else '',
+                                                                   renamed_object(index_name, production_table,
+                                                                                  staging_table),
+                                                                   staging_table, using_sql))
+
+    # i.e. SELECT for publicuser, which lets anonymous maps read the table
+    grant_sql = ("SELECT grantee, privilege_type FROM information_schema.role_table_grants "
+                 "WHERE table_schema = current_schema() AND table_name = '{0}' AND grantee <> current_user")
+
+    for row in cartodb_sql(grant_sql.format(production_table), gfw_env)['rows']:
+        sql_list.append('GRANT {0} ON {1} TO "{2}"'.format(row['privilege_type'], staging_table, row['grantee']))
+
+    cartodb_sql('; '.join(sql_list), gfw_env)
+
+    cartodb_catalog.invalidate(staging_table, gfw_env)
+
+
+def cartodb_swap_tables(staging_table, production_table, gfw_env):
+    """
+    Replace the production table with the staging table by renaming them. All the statements run in one request,
+    which the SQL API runs as a single transaction, so production is always either the old or the new table.
+    The old production table is kept as {production_table}_prev, replacing the one from the previous swap. Only
+    used if no views depend on the tables (see dependent_views); _prev is dropped without CASCADE, so if a view
+    has been created on it since, the swap fails rather than dropping the view
+    :param staging_table: staging table
+    :param production_table: prod table
+    :param gfw_env: gfw env
+    :return:
+    """
+    logging.debug("swap staging table {0} with production table {1}".format(staging_table, production_table))
+
+    previous_table = previous_table_name(production_table)
+
+    sql_list = ['DROP TABLE IF EXISTS {0}'.format(previous_table)]
+    sql_list += rename_table_sql(production_table, previous_table, table_objects(production_table, gfw_env))
+    sql_list += rename_table_sql(staging_table, production_table, table_objects(staging_table, gfw_env))
+
+    cartodb_sql('; '.join(sql_list), gfw_env)
+
+    cartodb_catalog.remove(staging_table, gfw_env)
+    cartodb_catalog.invalidate(production_table, gfw_env)
+    cartodb_catalog.invalidate(previous_table, gfw_env)
+
+
+def cartodb_rollback_swap(production_table, gfw_env):
+    """
+    Put back the production table that the last swap replaced. The table that replaced it becomes
+    {production_table}_prev, so running this again undoes the rollback
+    :param production_table: prod table
+    :param gfw_env: gfw env
+    :return:
+    """
+    previous_table = previous_table_name(production_table)
+
+    if not cartodb_check_exists(previous_table, gfw_env):
+        logging.error('No previous version of {0} to roll back to. Exiting'.format(production_table))
+        sys.exit(1)
+
+    view_list = dependent_views([production_table, previous_table], gfw_env)
+
+    if view_list:
+        logging.error('Views {0} depend on {1} or {2}; they would follow the tables when they are renamed. '
+                      'Exiting'.format(', '.join(view_list), production_table, previous_table))
+        sys.exit(1)
+
+    logging.info('Rolling back {0} to {1}'.format(production_table, previous_table))
+
+    rollback_table = production_table + '_rollback'
+
+    production_objects = table_objects(production_table, gfw_env)
+
+    # Move production out of the way, put the previous table in its place, then keep the old production as _prev
+    sql_list = rename_table_sql(production_table, rollback_table, production_objects)
+    sql_list += rename_table_sql(previous_table, production_table, table_objects(previous_table, gfw_env))
+    sql_list += rename_table_sql(rollback_table, previous_table,
+                                 [(t, renamed_object(name, production_table, rollback_table))
+                                  for t, name in production_objects])
+
+    cartodb_sql('; '.join(sql_list), gfw_env)
+
+    cartodb_catalog.invalidate(production_table, gfw_env)
+    cartodb_catalog.invalidate(previous_table, gfw_env)
 
 
 def delete_staging_table_if_exists(staging_table_name, in_gfw_env):
@@ -408,39 +1301,130 @@ def delete_staging_table_if_exists(staging_table_name, in_gfw_env):
 
     sql = 'DROP TABLE IF EXISTS {0} CASCADE'.format(staging_table_name)
     cartodb_sql(sql, in_gfw_env)
+    cartodb_catalog.remove(staging_table_name, in_gfw_env)
 
 
-def cartodb_sync(shp, production_table, where_clause, gfw_env, scratch_workspace):
+def cartodb_export_sqlite(shp, where_clause, scratch_workspace, gfw_env):
+    """
+    The local part of cartodb_sync: copy the features to a scratch GDB, add the temp id field and export them to a
+    validated sqlite database. Module-level so that it can run in a worker process
+    :param shp: input feature class (can be GDB FC or SDE too)
+    :param where_clause: where_clause of the features to export
+    :param scratch_workspace: scratch workspace
+    :param gfw_env: gfw env
+    :return: (path to the sqlite database, staging table, temp id field)
+    """
+    # Always work on a scratch copy: ogr2ogr can't read an SDE fc, and the temp id field added below mustn't be
+    # added to a dataset that other update stages are reading (or archiving) at the same time
+    shp = util.fc_to_temp_gdb(shp, scratch_workspace, where_clause)
+
+    basename = os.path.basename(shp)
+    staging_table = os.path.splitext(basename)[0] + '_staging'
+
+    # Create a temp ID field (set equal to OBJECTID) that we'll use to manage pushing to cartodb incrementally
+    temp_id_field = util.create_temp_id_field(shp, gfw_env)
+
+    return cartodb_make_valid_geom_local(shp, temp_id_field), staging_table, temp_id_field
+
+
+def cartodb_sync(shp, production_table, where_clause, gfw_env, scratch_workspace, ledger=None, run_in_process=None):
     """
     Function called by VectorLayer and other Layer objects as part of layer.update()
     Will carry out the sync process from start to finish-- pushing the shp to a staging table on cartodb, then
-    to production on cartodb, using a where_clause if included
+    to production on cartodb, using a where_clause if included. Without a where_clause, the staging table
+    replaces production, which is kept as {production_table}_prev, unless views depend on production; then all
+    of production's rows are replaced instead
     :param shp: input feature class (can be GDB FC or SDE too)
     :param production_table: final output table in cartoDB
     :param where_clause: where_clause to use when adding/deleting from final prod table
     :param gfw_env: gfw env
     :param scratch_workspace: scratch workspace
+    :param ledger: optional ChunkLedger from the run state. Chunks are also recorded in a comment on the staging
+    table; if an earlier sync of the same data left one, it's kept and only the chunks that weren't completed
+    are uploaded/pushed
+    :param run_in_process: optional StageGraph.run_in_process, to run the arcpy tools in a worker process
     :return:
     """
 
-    # ogr2ogr can't use an SDE fc as an input; must export to GDB
-    if where_clause or '@localhost).sde' in shp:
-        shp = util.fc_to_temp_gdb(shp, scratch_workspace, where_clause)
+    # The staging table has already replaced production; only the ledger wasn't cleared
+    if ledger and ledger.is_done('swap_to_production'):
+        ledger.clear()
+        return
 
-    basename = os.path.basename(shp)
-    staging_table = os.path.splitext(basename)[0] + '_staging'
+    if run_in_process:
+        export = run_in_process(cartodb_export_sqlite, shp, where_clause, scratch_workspace, gfw_env)
+    else:
+        export = cartodb_export_sqlite(shp, where_clause, scratch_workspace, gfw_env)
 
-    delete_staging_table_if_exists(staging_table, gfw_env)
+    validated_fc_in_sqlite, staging_table, temp_id_field = export
 
-    # Create a temp ID field (set equal to OBJECTID) that we'll use to manage pushing to cartodb incrementally
-    temp_id_field = util.create_temp_id_field(shp, gfw_env)
+    cartodb_sync_sqlite(validated_fc_in_sqlite, production_table, staging_table, where_clause, temp_id_field, gfw_env,
+                        ledger)
 
-    validated_fc_in_sqlite = cartodb_make_valid_geom_local(shp)
 
-    cartodb_create(validated_fc_in_sqlite, production_table, staging_table, temp_id_field, gfw_env)
+def cartodb_sync_sqlite(sqlite_db, production_table, staging_table, where_clause, temp_id_field, gfw_env,
+                        ledger=None):
+    """
+    The part of cartodb_sync that runs against the API: upload the validated sqlite database to the staging table,
+    then update production from it
+    :param sqlite_db: path to the sqlite database from cartodb_make_valid_geom_local
+    :param production_table: final output table in cartoDB
+    :param staging_table: staging table
+    :param where_clause: where_clause to use when adding/deleting from final prod table
+    :param temp_id_field: temp id field in the sqlite database
+    :param gfw_env: gfw env
+    :param ledger: optional ChunkLedger from the run state
+    :return:
+    """
+    if str(settings.get_settings(gfw_env)['cartodb'].get('diff_sync', False)).lower() == 'true':
 
-    cartodb_delete_where_clause_or_truncate_prod_table(production_table, where_clause, gfw_env)
+        if cartodb_diff_sync(sqlite_db, production_table, staging_table, where_clause, temp_id_field, gfw_env):
+            if ledger:
+                ledger.clear()
 
-    cartodb_push_to_production(staging_table, production_table, gfw_env)
+            return
 
-    delete_staging_table_if_exists(staging_table, gfw_env)
+    # Record the chunks uploaded and pushed in the run state and in a comment on the staging table. If an earlier
+    # sync of the same data stopped part way, its staging table is kept and the sync carries on from there
+    staging_ledger = cartodb_ledger.StagingLedger(staging_table, sqlite_fingerprint(sqlite_db, temp_id_field),
+                                                  gfw_env, ledger)
+    staging_ledger.load()
+
+    cartodb_create(sqlite_db, production_table, staging_table, temp_id_field, gfw_env, staging_ledger)
+
+    view_list = []
+
+    if not where_clause:
+        view_list = dependent_views([production_table, previous_table_name(production_table)], gfw_env)
+
+        if view_list:
+            logging.info('Views {0} depend on {1}; replacing its rows rather than swapping in {2}'.format(
+                ', '.join(view_list), production_table, staging_table))
+
+    if not where_clause and not view_list:
+        # Full refresh: the staging table becomes production, rather than being copied into it
+        cartodb_finish_staging_table(staging_table, production_table, temp_id_field, gfw_env)
+        cartodb_swap_tables(staging_table, production_table, gfw_env)
+
+        if ledger:
+            ledger.mark_done('swap_to_production')
+
+    else:
+        if settings.get_settings(gfw_env)['cartodb'].get('push_mode', 'chunked') == 'batch':
+            # Delete and insert in one transaction; if we're resuming, running it again gives the same result
+            cartodb_batch_push_to_production(staging_table, production_table, where_clause, gfw_env)
+
+        else:
+            if staging_ledger.is_done('delete_from_production'):
+                verify_pushed_chunks(staging_table, production_table, where_clause, staging_ledger, gfw_env)
+
+            # Only delete from production once-- if we're resuming a push, this has already happened
+            if not staging_ledger.is_done('delete_from_production'):
+                cartodb_delete_where_clause_or_truncate_prod_table(production_table, where_clause, gfw_env)
+                staging_ledger.mark_done('delete_from_production')
+
+            cartodb_push_to_production(staging_table, production_table, gfw_env, staging_ledger)
+
+        delete_staging_table_if_exists(staging_table, gfw_env)
+
+    staging_ledger.clear()
@@ -0,0 +1,240 @@
+import math
+import time
+import random
+import shutil
+import struct
+import sqlite3
+import hashlib
+import logging
+import argparse
+import tempfile
+import os
+import sys
+
+import cartodb
+import cartodb_client
+import cartodb_catalog
+import settings
+from cartodb_standin import StandinServer
+
+PRODUCTION_TABLE = 'benchmark'
+STAGING_TABLE = 'benchmark_staging'
+TEMP_ID_FIELD = 'c_temp_id'
+
+# Every synthetic feature is in this country; merge syncs replace the rows in MERGE_WHERE_CLAUSE
+ISO = 'BRA'
+MERGE_WHERE_CLAUSE = "iso = '{0}'".format(ISO)
+
+
+def polygon_wkb(x, y, radius, vertex_count):
+    """
+    Build the WKB of a regular polygon
+    :param x: longitude of the center
+    :param y: latitude of the center
+    :param radius: distance from the center to each vertex, in degrees
+    :param vertex_count: number of vertices
+    :return: little-endian WKB string
+    """
+    point_list = [(x + radius * math.cos(2 * math.pi * i / vertex_count),
+                   y + radius * math.sin(2 * math.pi * i / vertex_count)) for i in range(vertex_count)]
+    point_list.append(point_list[0])
+
+    return struct.pack('<BIII', 1, 3, 1, len(point_list)) + ''.join([struct.pack('<dd', *p) for p in point_list])
+
+
+def build_sqlite(sqlite_db, feature_count, vertex_count):
+    """
+    Build a sqlite database of random polygons, laid out like the output of cartodb_make_valid_geom_local
+    :param sqlite_db: path to the new database
+    :param feature_count: number of polygons
+    :param vertex_count: vertices per polygon
+    :return:
+    """
+    # The same features every time, so runs can be compared
+    random.seed(feature_count)
+
+    def feature_rows():
+        for i in range(1, feature_count + 1):
+            wkb = polygon_wkb(random.uniform(-70, -40), random.uniform(-30, 0), random.uniform(0.001, 0.1),
+                              vertex_count)
+
+            yield (i, buffer(wkb), hashlib.md5(wkb).hexdigest(), 'feature {0}'.format(i),
+                   round(random.uniform(1, 10000), 2), ISO, i, wkb.encode('hex').upper())
+
+    conn = sqlite3.connect(sqlite_db)
+
+    try:
+        conn.execute('CREATE TABLE geometry_columns (f_table_name TEXT, f_geometry_column TEXT)')
+        conn.execute("INSERT INTO geometry_columns VALUES ('{0}', '{1}')".format(PRODUCTION_TABLE,
+                                                                                cartodb.SQLITE_GEOMETRY_FIELD))
+
+        conn.execute('CREATE TABLE {0} ({1} INTEGER PRIMARY KEY, {2} BLOB, gfwid TEXT, name TEXT, area_ha REAL, '
+                     'iso TEXT, {3} INTEGER, {4} TEXT)'.format(PRODUCTION_TABLE, cartodb.SQLITE_FID_FIELD,
+                                                               cartodb.SQLITE_GEOMETRY_FIELD, TEMP_ID_FIELD,
+                                                               cartodb.SQLITE_WKB_FIELD))
+
+        conn.executemany('INSERT INTO {0} VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(PRODUCTION_TABLE), feature_rows())
+        conn.commit()
+
+    finally:
+        conn.close()
+
+    cartodb.sqlite_add_payload_size(sqlite_db, TEMP_ID_FIELD)
+
+
+def create_production_table(gfw_env):
+    """
+    Drop the tables left by the last sync and create an empty production table
+    :param gfw_env: gfw env
+    :return:
+    """
+    for table_name in [PRODUCTION_TABLE, cartodb.previous_table_name(PRODUCTION_TABLE), STAGING_TABLE]:
+        cartodb.cartodb_sql('DROP TABLE IF EXISTS {0} CASCADE'.format(table_name), gfw_env)
+        cartodb_catalog.remove(table_name, gfw_env)
+
+    cartodb.cartodb_sql('CREATE TABLE {0} (gfwid text, name text, area_ha numeric, iso text)'.format(PRODUCTION_TABLE),
+                        gfw_env)
+    cartodb.cartodb_sql("SELECT cdb_cartodbfytable('{0}')".format(PRODUCTION_TABLE), gfw_env)
+
+    cartodb_catalog.invalidate(PRODUCTION_TABLE, gfw_env)
+
+
+def run_benchmark(server, feature_count, vertex_count, where_clause, gfw_env, work_dir):
+    """
+    Sync a synthetic dataset to the stand-in and measure it
+    :param server: StandinServer
+    :param feature_count: number of features
+    :param vertex_count: vertices per feature
+    :param where_clause: where clause of the sync; None for a full refresh
+    :param gfw_env: gfw env
+    :param work_dir: directory for the sqlite database
+    :return: dict of results
+    """
+    sqlite_db = os.path.join(work_dir, 'benchmark_{0}.sqlite'.format(feature_count))
+    build_sqlite(sqlite_db, feature_count, vertex_count)
+
+    create_production_table(gfw_env)
+    server.reset_stats()
+
+    start_time = time.time()
+    cartodb.cartodb_sync_sqlite(sqlite_db, PRODUCTION_TABLE, STAGING_TABLE, where_clause, TEMP_ID_FIELD, gfw_env)
+    elapsed = time.time() - start_time
+
+    stats = server.reset_stats()
+
+    # Check that every feature made it to production
+    cartodb.check_row_count(PRODUCTION_TABLE, feature_count, gfw_env)
+
+    os.remove(sqlite_db)
+
+    return {'features': feature_count, 'seconds': elapsed, 'rows_per_second': feature_count / elapsed,
+            'requests': stats['requests'], 'bytes_sent': stats['bytes_received'],
+            'bytes_received': stats['bytes_sent']}
+
+
+def check_indexes(table_name, expected_indexes, gfw_env):
+    """
+    Check that a table has the same indexes (ignoring their names) as production had after the first sync
+    :param table_name: cartoDB table
+    :param expected_indexes: sorted list of (unique, using sql) from cartodb.get_indexes
+    :param gfw_env: gfw env
+    :return:
+    """
+    table_indexes = sorted(cartodb.get_indexes(table_name, gfw_env).values())
+
+    if table_indexes != expected_indexes:
+        logging.error('{0} has indexes {1}, expected {2}. Exiting'.format(table_name, table_indexes, expected_indexes))
+        sys.exit(1)
+
+
+def check_refresh_and_rollback(feature_count, vertex_count, gfw_env, work_dir):
+    """
+    After a full refresh benchmark, refresh production again from a dataset half the size, so the staging table
+    is swapped with a table that was itself swapped in, and then roll back twice. Row counts and indexes are
+    checked after each step; nothing is timed
+    :param feature_count: number of features in the benchmark dataset, now in production
+    :param vertex_count: vertices per feature
+    :param gfw_env: gfw env
+    :param work_dir: directory for the sqlite database
+    :return:
+    """
+    previous_table = cartodb.previous_table_name(PRODUCTION_TABLE)
+    expected_indexes = sorted(cartodb.get_indexes(PRODUCTION_TABLE, gfw_env).values())
+
+    repeat_count = max(feature_count / 2, 1)
+
+    sqlite_db = os.path.join(work_dir, 'benchmark_{0}_repeat.sqlite'.format(feature_count))
+    build_sqlite(sqlite_db, repeat_count, vertex_count)
+
+    cartodb.cartodb_sync_sqlite(sqlite_db, PRODUCTION_TABLE, STAGING_TABLE, None, TEMP_ID_FIELD, gfw_env)
+    os.remove(sqlite_db)
+
+    # The old production table is kept as _prev. Rolling back swaps the two, and rolling back again undoes that
+    expected_counts = [(repeat_count, feature_count), (feature_count, repeat_count), (repeat_count, feature_count)]
+
+    for i, (production_count, previous_count) in enumerate(expected_counts):
+        if i > 0:
+            cartodb.cartodb_rollback_swap(PRODUCTION_TABLE, gfw_env)
+
+        cartodb.check_row_count(PRODUCTION_TABLE, production_count, gfw_env)
+        cartodb.check_row_count(previous_table, previous_count, gfw_env)
+
+        check_indexes(PRODUCTION_TABLE, expected_indexes, gfw_env)
+        check_indexes(previous_table, expected_indexes, gfw_env)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cartodb_sync against a local stand-in for the SQL API.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='number of features in each synthetic dataset')
+    parser.add_argument('--vertices', type=int, default=20, help='vertices per polygon')
+    parser.add_argument('--mode', default='merge', choices=('merge', 'refresh'),
+                        help='merge: replace the rows in a where clause; refresh: replace the whole table')
+    parser.add_argument('--push-mode', choices=('chunked', 'batch'),
+                        help='override the push_mode setting')
+    parser.add_argument('--database', default=':memory:', help='SQLite database for the stand-in')
+    parser.add_argument('--environment', '-e', default='DEV', choices=('DEV', 'PROD'),
+                        help='settings to use for chunk sizes and concurrency')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format='%(asctime)s %(message)s')
+
+    server = StandinServer(database_path=args.database, api_key='benchmark')
+    sql_api = server.start()
+
+    # Point the settings at the stand-in for this process only; nothing is written to settings.ini
+    cartodb_settings = settings.get_settings(args.environment)['cartodb']
+    cartodb_settings.update({'sql_api': sql_api, 'api_key': 'benchmark', 'token': 'standin@cartodb',
+                             'diff_sync': 'false'})
+
+    if args.push_mode:
+        cartodb_settings['push_mode'] = args.push_mode
+
+    where_clause = MERGE_WHERE_CLAUSE if args.mode == 'merge' else None
+    work_dir = tempfile.mkdtemp()
+
+    print '{0:>10} {1:>10} {2:>10} {3:>10} {4:>12} {5:>12}'.format('features', 'seconds', 'rows/s', 'requests',
+                                                                  'MB sent', 'MB received')
+
+    try:
+        for feature_count in args.sizes:
+            result = run_benchmark(server, feature_count, args.vertices, where_clause, args.environment, work_dir)
+
+            if not where_clause:
+                check_refresh_and_rollback(feature_count, args.vertices, args.environment, work_dir)
+
+            print '{0:>10} {1:>10.1f} {2:>10.0f} {3:>10} {4:>12.1f} {5:>12.1f}'.format(
+                result['features'], result['seconds'], result['rows_per_second'], result['requests'],
+                result['bytes_sent'] / 1e6, result['bytes_received'] / 1e6)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+        # Close the keep-alive connections first, so the server's handler threads aren't left waiting on them
+        cartodb_client.get_client(args.environment).close()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
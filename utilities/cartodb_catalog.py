@@ -0,0 +1,127 @@
+import time
+import logging
+import threading
+
+import cartodb
+
+# Seconds before the list of tables and columns is downloaded again
+CATALOG_TTL = 15 * 60
+
+# {account_name: {'fetched': timestamp, 'tables': {table_name: [column names]}, 'stale': set of table names}}
+_catalogs = {}
+_lock = threading.RLock()
+
+# One row per column of every table in the account's schema, in column order. Unlike SELECT * LIMIT 1, this
+# doesn't pull the geometry of a row from each table
+CATALOG_SQL = ("SELECT table_name, column_name FROM information_schema.columns "
+               "WHERE table_schema = current_schema() {0}ORDER BY table_name, ordinal_position")
+
+
+def _table_key(table_name):
+    # Postgres folds unquoted names to lower case; drop the schema if the name is qualified (account.table)
+    return table_name.split('.')[-1].strip('"').lower()
+
+
+def _query_columns(gfw_env, table_name=None):
+    """
+    List the columns of the tables in the account, or of a single table
+    :param gfw_env: gfw env
+    :param table_name: table to list; if None, list all tables
+    :return: dict of {table_name: [column names]}
+    """
+    if table_name:
+        sql = CATALOG_SQL.format("AND table_name = '{0}' ".format(_table_key(table_name)))
+    else:
+        sql = CATALOG_SQL.format('')
+
+    table_dict = {}
+
+    for row in cartodb.cartodb_sql(sql, gfw_env)['rows']:
+        table_dict.setdefault(row['table_name'], []).append(row['column_name'])
+
+    return table_dict
+
+
+def _get_catalog(gfw_env):
+    """
+    Get the catalog for the gfw_env's account, downloading it if we don't have one or it's older than CATALOG_TTL
+    :param gfw_env: gfw env
+    :return: the catalog dict
+    """
+    account_name = cartodb.get_account_name(gfw_env)
+
+    with _lock:
+        catalog = _catalogs.get(account_name)
+
+        if not catalog or time.time() - catalog['fetched'] > CATALOG_TTL:
+            fetched = time.time()
+            table_dict = _query_columns(gfw_env)
+
+            logging.debug('Downloaded CartoDB catalog for {0}: {1} tables'.format(account_name, len(table_dict)))
+
+            catalog = {'fetched': fetched, 'tables': table_dict, 'stale': set()}
+            _catalogs[account_name] = catalog
+
+        return catalog
+
+
+def columns(table_name, gfw_env):
+    """
+    List the columns of a CartoDB table
+    :param table_name: cartoDB table name
+    :param gfw_env: gfw env
+    :return: list of column names in table order, or None if the table doesn't exist
+    """
+    key = _table_key(table_name)
+
+    with _lock:
+        catalog = _get_catalog(gfw_env)
+
+        # Tables this process has created or changed since the catalog was downloaded are looked up on their own
+        if key in catalog['stale']:
+            catalog['tables'].pop(key, None)
+            catalog['tables'].update(_query_columns(gfw_env, key))
+            catalog['stale'].discard(key)
+
+        column_list = catalog['tables'].get(key)
+
+    return list(column_list) if column_list is not None else None
+
+
+def table_exists(table_name, gfw_env):
+    """
+    Check if a CartoDB table exists
+    :param table_name: cartoDB table name
+    :param gfw_env: gfw env
+    :return: True | False
+    """
+    return columns(table_name, gfw_env) is not None
+
+
+def invalidate(table_name, gfw_env):
+    """
+    Look a table up again the next time it's needed, i.e. after creating it or adding columns
+    :param table_name: cartoDB table name
+    :param gfw_env: gfw env
+    :return:
+    """
+    with _lock:
+        catalog = _catalogs.get(cartodb.get_account_name(gfw_env))
+
+        if catalog:
+            catalog['stale'].add(_table_key(table_name))
+
+
+def remove(table_name, gfw_env):
+    """
+    Record that a table has been dropped
+    :param table_name: cartoDB table name
+    :param gfw_env: gfw env
+    :return:
+    """
+    with _lock:
+        catalog = _catalogs.get(cartodb.get_account_name(gfw_env))
+
+        if catalog:
+            catalog['tables'].pop(_table_key(table_name), None)
+            catalog['stale'].discard(_table_key(table_name))
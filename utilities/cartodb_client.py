@@ -0,0 +1,207 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import util
+import settings
+import instrumentation
+
+# {gfw_env: CartoDBClient}, shared by every thread in this process
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class CartoDBHTTPError(Exception):
+    """
+    The SQL API returned an HTTP error that isn't a SQL error (i.e. 429 rate limited, 502 bad gateway)
+    :param status_code: HTTP status code
+    :param message: response body or reason
+    :return:
+    """
+
+    def __init__(self, status_code, message):
+        super(CartoDBHTTPError, self).__init__('CartoDB SQL API returned HTTP {0}: {1}'.format(status_code, message))
+        self.status_code = status_code
+
+
+def is_overload_status(status_code):
+    """
+    Check if an HTTP status from the SQL API means it's overloaded. CARTO returns these with a JSON error body
+    too (i.e. a statement timeout is a 429), so the status has to be checked before the body
+    :param status_code: HTTP status code
+    :return: True if the API rate limited us or returned a 5xx
+    """
+    return status_code == 429 or status_code >= 500
+
+
+class CartoDBClient(object):
+    """
+    Client for the CartoDB SQL API. Keeps a pool of keep-alive connections to the API, so that each statement
+    doesn't need a new TCP connection. Statements are sent as POST bodies, so there's no limit on their length
+    :param api_url: SQL API url, i.e. http://wri-01.cartodb.com/api/v2/sql
+    :param api_key: API key for the account
+    :param connect_timeout: seconds to wait for a connection
+    :param read_timeout: seconds to wait for the API to respond to a statement
+    :param pool_size: max connections to keep open; should be at least the number of threads using the client
+    :return:
+    """
+
+    def __init__(self, api_url, api_key, connect_timeout=10, read_timeout=300, pool_size=10):
+        # Only import requests when we actually talk to the API
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+
+        # Retries are handled by cartodb_retry, which knows which statements are safe to repeat
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def sql(self, sql, timeout=None):
+        """
+        Execute a SQL statement
+        :param sql: the SQL statement
+        :param timeout: (connect, read) timeout in seconds for this statement; defaults to the client's timeout
+        :return: the JSON response, with rows as OrderedDicts in column order
+        """
+        response = self.session.post(self.api_url, data={'q': sql, 'api_key': self.api_key},
+                                     timeout=timeout or self.timeout, stream=True)
+
+        try:
+            # Parse from the (decompressed) response stream rather than reading the whole body into a string first
+            response.raw.decode_content = True
+
+            try:
+                json_result = json.load(response.raw, object_pairs_hook=OrderedDict)
+            except ValueError:
+                json_result = None
+
+            instrumentation.add_bytes(len(sql) + response.raw.tell())
+
+        finally:
+            response.close()
+
+        has_error = json_result is not None and 'error' in json_result
+
+        # Rate limits, statement timeouts and server errors also have an error body, but aren't SQL errors
+        if is_overload_status(response.status_code):
+            raise CartoDBHTTPError(response.status_code, json_result['error'] if has_error else response.reason)
+
+        # SQL errors come back as {"error": [...]}, usually with a 400
+        if has_error:
+            raise SyntaxError(json_result['error'])
+
+        if response.status_code >= 400 or json_result is None:
+            raise CartoDBHTTPError(response.status_code, response.reason)
+
+        return json_result
+
+    def _job_request(self, method, url, **kwargs):
+        """
+        Make a request to the Batch SQL API, which takes and returns JSON job objects
+        :param method: HTTP method
+        :param url: job url
+        :return: the job dict, i.e. {"job_id": ..., "status": "pending", "query": ...}
+        """
+        response = self.session.request(method, url, params={'api_key': self.api_key}, timeout=self.timeout,
+                                        **kwargs)
+
+        try:
+            job = response.json()
+        except ValueError:
+            job = None
+
+        instrumentation.add_bytes(len(response.content) + len(kwargs.get('data') or ''))
+
+        has_error = job is not None and 'error' in job
+
+        # A rate limit or server error doesn't mean the job failed; it may still be running
+        if is_overload_status(response.status_code):
+            raise CartoDBHTTPError(response.status_code, job['error'] if has_error else response.reason)
+
+        if has_error:
+            raise SyntaxError(job['error'])
+
+        if response.status_code >= 400 or job is None:
+            raise CartoDBHTTPError(response.status_code, response.reason)
+
+        return job
+
+    @property
+    def job_url(self):
+        # http://wri-01.cartodb.com/api/v2/sql -> http://wri-01.cartodb.com/api/v2/sql/job
+        return self.api_url.rstrip('/') + '/job'
+
+    def create_job(self, sql):
+        """
+        Submit a statement to the Batch SQL API. It runs on the server without an HTTP timeout; several statements
+        separated by semicolons are run as one transaction
+        :param sql: the SQL statement
+        :return: the job dict
+        """
+        return self._job_request('POST', self.job_url, data=json.dumps({'query': sql}),
+                                 headers={'Content-Type': 'application/json'})
+
+    def get_job(self, job_id):
+        """
+        Get the status of a batch job
+        :param job_id: id returned by create_job
+        :return: the job dict; status is pending, running, done, failed, cancelled or unknown
+        """
+        return self._job_request('GET', '{0}/{1}'.format(self.job_url, job_id))
+
+    def cancel_job(self, job_id):
+        """
+        Cancel a batch job that's pending or running
+        :param job_id: id returned by create_job
+        :return: the job dict
+        """
+        return self._job_request('DELETE', '{0}/{1}'.format(self.job_url, job_id))
+
+    def close(self):
+        self.session.close()
+
+
+def is_overload_error(e):
+    """
+    Check if an error from the SQL API means it's overloaded, rather than that the statement was bad
+    :param e: the exception raised by CartoDBClient.sql
+    :return: True if the API rate limited us, returned a 5xx or didn't respond in time
+    """
+    if isinstance(e, CartoDBHTTPError):
+        return is_overload_status(e.status_code)
+
+    # requests has already been imported if the client raised one of its exceptions
+    import requests
+
+    return isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+def get_client(gfw_env):
+    """
+    Get the SQL API client for the gfw_env's CartoDB account, creating it the first time
+    :param gfw_env: gfw env
+    :return: a CartoDBClient
+    """
+    with _clients_lock:
+        if gfw_env not in _clients:
+            cartodb_settings = settings.get_settings(gfw_env)['cartodb']
+
+            # A key in the settings (i.e. for the local stand-in) is used instead of the token file
+            key = cartodb_settings.get('api_key') or util.get_token(cartodb_settings['token'])
+
+            _clients[gfw_env] = CartoDBClient(cartodb_settings['sql_api'], key,
+                                              float(cartodb_settings.get('connect_timeout', 10)),
+                                              float(cartodb_settings.get('read_timeout', 300)),
+                                              int(cartodb_settings.get('pool_size', 10)))
+
+            logging.debug('Created CartoDB SQL API client for {0}'.format(cartodb_settings['sql_api']))
+
+        return _clients[gfw_env]
@@ -0,0 +1,261 @@
+import re
+import json
+import time
+import logging
+import threading
+
+import cartodb
+import cartodb_catalog
+
+# Chunks of a table are where clauses of the form "{field} >= {start} and {field} < {end}"
+RANGE_PATTERN = re.compile(r'^(\w+) >= (-?\d+) and \1 < (-?\d+)$')
+
+# Min seconds between comment updates for range chunks; a resumed sync checks these by counting rows
+# (verify_staging_chunks, verify_pushed_chunks), so one done since the last update is only repeated
+FLUSH_SECONDS = 10
+
+
+def parse_range(key):
+    """
+    Parse a chunk where clause
+    :param key: the where clause
+    :return: (field, start, end), or None if the key isn't a range
+    """
+    match = RANGE_PATTERN.match(key)
+
+    if match:
+        return match.group(1), int(match.group(2)), int(match.group(3))
+
+    return None
+
+
+def add_range(range_list, start, end):
+    """
+    Add [start, end) to a list of ranges, merging it with the ranges it touches
+    :param range_list: sorted list of non-overlapping [start, end] lists
+    :param start: first id
+    :param end: id after the last id
+    :return: the new sorted list of ranges
+    """
+    merged_list = []
+
+    for range_start, range_end in sorted(range_list + [[start, end]]):
+        if merged_list and range_start <= merged_list[-1][1]:
+            merged_list[-1][1] = max(merged_list[-1][1], range_end)
+        else:
+            merged_list.append([range_start, range_end])
+
+    return merged_list
+
+
+def remove_range(range_list, start, end):
+    """
+    Remove [start, end) from a list of ranges
+    :param range_list: sorted list of non-overlapping [start, end] lists
+    :param start: first id
+    :param end: id after the last id
+    :return: the new sorted list of ranges
+    """
+    remaining_list = []
+
+    for range_start, range_end in range_list:
+        if range_start < start:
+            remaining_list.append([range_start, min(range_end, start)])
+
+        if range_end > end:
+            remaining_list.append([max(range_start, end), range_end])
+
+    return remaining_list
+
+
+class StagingLedger(object):
+    """
+    Records the chunks of a cartodb sync that have been uploaded to the staging table and pushed to production,
+    both in the local ChunkLedger (if there is one) and as a JSON comment on the staging table. The comment
+    survives a run that died without saving its run state, and is dropped along with the staging table
+    Chunks are stored as merged id ranges, so the comment stays small however many chunks there are. Has the
+    same methods as ChunkLedger, so cartodb_execute_where_clause can use either
+    :param staging_table: staging table
+    :param source_id: fingerprint of the data being uploaded; a staging table uploaded from other data isn't used
+    :param gfw_env: gfw env
+    :param local_ledger: optional ChunkLedger from the run state
+    :return:
+    """
+
+    def __init__(self, staging_table, source_id, gfw_env, local_ledger=None):
+        self.staging_table = staging_table
+        self.source_id = source_id
+        self.gfw_env = gfw_env
+        self.local_ledger = local_ledger
+
+        # {field: [[start, end], ...]} of range chunks, and a set of the other keys (i.e. delete_from_production)
+        self.ranges = {}
+        self.keys = set()
+
+        self.resumed = False
+
+        self._lock = threading.RLock()
+        self._last_save = 0
+
+        # Comments are built under _lock and sent under _save_lock, numbered so an older one never replaces a newer
+        self._save_lock = threading.Lock()
+        self._version = 0
+        self._saved_version = 0
+
+    def _read_comment(self):
+        if not cartodb_catalog.table_exists(self.staging_table, self.gfw_env):
+            return None
+
+        sql = "SELECT obj_description('{0}'::regclass, 'pg_class') AS comment".format(self.staging_table)
+        comment = cartodb.cartodb_sql(sql, self.gfw_env)['rows'][0]['comment']
+
+        try:
+            return json.loads(comment) if comment else None
+        except ValueError:
+            return None
+
+    def _add(self, key):
+        parsed_range = parse_range(key)
+
+        if parsed_range:
+            field, start, end = parsed_range
+            self.ranges[field] = add_range(self.ranges.get(field, []), start, end)
+        else:
+            self.keys.add(key)
+
+        return parsed_range[0] if parsed_range else None
+
+    def load(self):
+        """
+        Read the ledger from the staging table's comment. If the staging table doesn't exist, has no ledger or was
+        uploaded from different data, drop it and start over
+        :return: True if the staging table is kept and the sync can pick up where it stopped
+        """
+        comment = self._read_comment()
+
+        with self._lock:
+            if comment and comment.get('source') == self.source_id:
+                self.ranges = comment.get('ranges', {})
+                self.keys = set(comment.get('keys', []))
+
+                # Chunks done since the comment was last updated
+                if self.local_ledger:
+                    for key in self.local_ledger.keys():
+                        self._add(key)
+
+                self.resumed = True
+
+                logging.info('Resuming sync using existing staging table {0}'.format(self.staging_table))
+
+            else:
+                if comment:
+                    logging.debug('Staging table {0} is from other source data; '
+                                  'starting over'.format(self.staging_table))
+
+                cartodb.delete_staging_table_if_exists(self.staging_table, self.gfw_env)
+
+                if self.local_ledger:
+                    self.local_ledger.clear()
+
+        return self.resumed
+
+    def save(self, force=True):
+        """
+        Write the ledger to the staging table's comment. The request is made without holding the ledger's lock,
+        so other chunks can still be recorded while it's sent
+        :param force: write it even if it was written less than FLUSH_SECONDS ago
+        :return:
+        """
+        with self._lock:
+            if not force and time.time() - self._last_save < FLUSH_SECONDS:
+                return
+
+            # Count the save from now, so chunks finishing while it's sent don't start another
+            self._last_save = time.time()
+
+            self._version += 1
+            version = self._version
+
+            comment = json.dumps({'source': self.source_id, 'ranges': self.ranges, 'keys': sorted(self.keys)})
+
+        with self._save_lock:
+            if version < self._saved_version:
+                return
+
+            cartodb.cartodb_sql("COMMENT ON TABLE {0} IS '{1}'".format(self.staging_table,
+                                                                       comment.replace("'", "''")), self.gfw_env)
+            self._saved_version = version
+
+    def has_chunks(self):
+        # The staging table was kept from an earlier attempt, even if none of its chunks had finished
+        return self.resumed
+
+    def is_done(self, key):
+        parsed_range = parse_range(key)
+
+        with self._lock:
+            if not parsed_range:
+                return key in self.keys
+
+            field, start, end = parsed_range
+
+            return any([s <= start and end <= e for s, e in self.ranges.get(field, [])])
+
+    def mark_done(self, key):
+        with self._lock:
+            field = self._add(key)
+
+        if self.local_ledger:
+            self.local_ledger.mark_done(key)
+
+        # Other keys (i.e. delete_from_production) can't be checked when resuming, so are saved right away
+        self.save(force=field is None)
+
+    def forget(self, key):
+        """
+        Record that a chunk needs to be done again
+        :param key: the chunk
+        :return:
+        """
+        parsed_range = parse_range(key)
+
+        with self._lock:
+            if parsed_range:
+                field, start, end = parsed_range
+                self.ranges[field] = remove_range(self.ranges.get(field, []), start, end)
+            else:
+                self.keys.discard(key)
+
+            if self.local_ledger:
+                self.local_ledger.unmark(key)
+
+        self.save()
+
+    def forget_field(self, field):
+        """
+        Record that all chunks of a field need to be done again
+        :param field: id field of the chunks, i.e. cartodb_id
+        :return:
+        """
+        with self._lock:
+            self.ranges.pop(field, None)
+
+            if self.local_ledger:
+                for key in self.local_ledger.keys():
+                    if (parse_range(key) or [None])[0] == field:
+                        self.local_ledger.unmark(key)
+
+        self.save()
+
+    def field_ranges(self, field):
+        with self._lock:
+            return [list(r) for r in self.ranges.get(field, [])]
+
+    def clear(self):
+        with self._lock:
+            self.ranges = {}
+            self.keys = set()
+            self.resumed = False
+
+            if self.local_ledger:
+                self.local_ledger.clear()
@@ -0,0 +1,523 @@
+import re
+import json
+import bisect
+import binascii
+import time
+import uuid
+import Queue
+import sqlite3
+import logging
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from collections import OrderedDict
+
+# Postgres SQL used by gfw-sync that SQLite doesn't understand, and the SQLite equivalent. {user} is the account
+SQL_REWRITES = [(re.compile(r'^TRUNCATE\s+(?:TABLE\s+)?', re.I), 'DELETE FROM '),
+                (re.compile(r'\s+CASCADE$', re.I), ''),
+                (re.compile(r'\binformation_schema\.columns\b', re.I), 'standin_columns'),
+                (re.compile(r'\binformation_schema\.role_table_grants\b', re.I), 'standin_role_table_grants'),
+                (re.compile(r'\binformation_schema\.view_table_usage\b', re.I), 'standin_view_table_usage'),
+                (re.compile(r'\bpg_indexes\b', re.I), 'standin_indexes'),
+                (re.compile(r'\bcurrent_user\b', re.I), "'{user}'"),
+                (re.compile(r"\bobj_description\('(\w+)'::regclass, 'pg_class'\)", re.I),
+                 r"(SELECT comment FROM standin_comments WHERE table_name = '\1')"),
+                (re.compile(r'\bARRAY\[([^\]]*)\]', re.I), r"'[\1]'"),
+                (re.compile(r'(\bINDEX\s+\w+\s+ON\s+\w+)\s+USING\s+\w+', re.I), r'\1')]
+
+# Batch job states that won't change again
+FINISHED_JOB_STATES = ['done', 'failed', 'cancelled']
+
+# Columns added by cdb_cartodbfytable
+CARTODB_COLUMNS = [('cartodb_id', 'INTEGER PRIMARY KEY'), ('the_geom', 'BLOB'), ('the_geom_webmercator', 'BLOB'),
+                   ('created_at', 'TEXT DEFAULT CURRENT_TIMESTAMP'), ('updated_at', 'TEXT DEFAULT CURRENT_TIMESTAMP')]
+
+# Views standing in for the Postgres catalog. Tables used by the stand-in itself start with standin_
+CATALOG_VIEWS_SQL = """
+CREATE TEMP VIEW standin_columns AS
+    SELECT 'public' AS table_schema, m.name AS table_name, p.name AS column_name, p.cid + 1 AS ordinal_position
+    FROM main.sqlite_master m JOIN pragma_table_info(m.name, 'main') p
+    WHERE m.type = 'table' AND m.name NOT LIKE 'standin!_%' ESCAPE '!' AND m.name NOT LIKE 'sqlite!_%' ESCAPE '!';
+
+-- indexdef is built from the index's columns rather than its SQL, which SQLite rewrites with a quoted table
+-- name when the table is renamed
+CREATE TEMP VIEW standin_indexes AS
+    SELECT 'public' AS schemaname, m.tbl_name AS tablename, m.name AS indexname,
+           'CREATE ' || CASE WHEN l."unique" THEN 'UNIQUE ' ELSE '' END || 'INDEX ' || m.name || ' ON public.' ||
+           m.tbl_name || ' USING btree (' ||
+           (SELECT group_concat(name, ', ') FROM (SELECT name FROM pragma_index_info(m.name, 'main') ORDER BY seqno))
+           || ')' AS indexdef
+    FROM main.sqlite_master m JOIN pragma_index_list(m.tbl_name, 'main') l ON l.name = m.name
+    WHERE m.type = 'index' AND m.sql IS NOT NULL;
+
+-- SQLite doesn't record which tables a view reads, so look for the table name in the view's SQL
+CREATE TEMP VIEW standin_view_table_usage AS
+    SELECT 'public' AS view_schema, v.name AS view_name, 'public' AS table_schema, t.name AS table_name
+    FROM main.sqlite_master v JOIN main.sqlite_master t
+    WHERE v.type = 'view' AND t.type = 'table' AND
+          ' ' || lower(v.sql) || ' ' GLOB '*[^a-z0-9_]' || lower(t.name) || '[^a-z0-9_]*';
+
+CREATE TEMP VIEW standin_role_table_grants AS
+    SELECT NULL AS grantee, NULL AS privilege_type, NULL AS table_schema, NULL AS table_name WHERE 0;
+"""
+
+
+def split_statements(sql):
+    """
+    Split SQL into statements on the semicolons that aren't inside quotes or comments
+    :param sql: one or more SQL statements
+    :return: list of statements, without the trailing semicolons
+    """
+    statement_list = []
+    current_statement = ''
+
+    for part in sql.split(';'):
+        current_statement += part + ';'
+
+        if sqlite3.complete_statement(current_statement):
+            statement_list.append(current_statement.strip()[:-1].strip())
+            current_statement = ''
+
+    if current_statement.strip(' ;\r\n\t'):
+        statement_list.append(current_statement.strip()[:-1].strip())
+
+    return [s for s in statement_list if s]
+
+
+def rewrite_statement(statement, user):
+    for pattern, replacement in SQL_REWRITES:
+        statement = pattern.sub(replacement.replace('{user}', user), statement)
+
+    return statement
+
+
+def field_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long, float)):
+        return 'number'
+    else:
+        return 'string'
+
+
+def json_value(value):
+    # Blobs (i.e. WKB geometry) are returned as hex, like bytea columns
+    if isinstance(value, buffer):
+        return str(value).encode('hex')
+
+    return value
+
+
+_thresholds = {}
+
+
+def width_bucket(value, thresholds_json):
+    """
+    Postgres width_bucket(value, ARRAY[...]); the array is passed as JSON
+    :return: number of thresholds <= value
+    """
+    if thresholds_json not in _thresholds:
+        _thresholds.clear()
+        _thresholds[thresholds_json] = json.loads(thresholds_json)
+
+    return bisect.bisect_right(_thresholds[thresholds_json], value)
+
+
+def decode(value, encoding):
+    if encoding != 'hex':
+        raise ValueError('Only hex is supported')
+
+    return buffer(binascii.unhexlify(value))
+
+
+class StandinDatabase(object):
+    """
+    SQLite database that runs SQL the way the SQL API does: all the statements in a request run in one
+    transaction, and the result is the rows of the last one. Covers the SQL that gfw-sync sends: geometry is
+    stored as WKB blobs, and the Postgres catalog tables it reads are emulated with views
+    :param path: path to the SQLite database; ':memory:' for a database that's gone when the stand-in stops
+    :param user: account name
+    :return:
+    """
+
+    def __init__(self, path, user='standin'):
+        self.user = user
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+
+        # Statements that need more than rewriting, and the method that runs them
+        self.handlers = [(re.compile(r"^SELECT cdb_cartodbfytable\((?:'\w+',\s*)?'(\w+)'\)$", re.I), self.cartodbfy),
+                         (re.compile(r'^ALTER INDEX (\w+) RENAME TO (\w+)$', re.I), self.rename_index),
+                         (re.compile(r'^ALTER TABLE (\w+) RENAME TO (\w+)$', re.I), self.rename_table),
+                         (re.compile(r'^DROP TABLE (IF EXISTS )?(\w+)$', re.I), self.drop_table),
+                         (re.compile(r"^COMMENT ON TABLE (\w+) IS (NULL|'.*')$", re.I | re.S), self.comment),
+                         (re.compile(r'^(GRANT|ALTER SEQUENCE) ', re.I), lambda cursor, match: None)]
+
+        self.conn.create_function('current_schema', 0, lambda: 'public')
+        self.conn.create_function('pg_get_serial_sequence', 2, lambda table_name, column_name: None)
+        self.conn.create_function('width_bucket', 2, width_bucket)
+        self.conn.create_function('decode', 2, decode)
+        self.conn.create_function('ST_GeomFromWKB', 2, lambda wkb, srid: wkb)
+
+        self.conn.execute('CREATE TABLE IF NOT EXISTS standin_comments (table_name TEXT PRIMARY KEY, comment TEXT)')
+        self.conn.executescript(CATALOG_VIEWS_SQL)
+
+    def cartodbfy(self, cursor, match):
+        """
+        Add the cartoDB columns to a table, with cartodb_id as the primary key, and index the geometry columns
+        """
+        table_name = match.group(1)
+        column_list = [(r[1], r[2]) for r in cursor.execute('PRAGMA table_info({0})'.format(table_name))]
+        cartodb_column_names = [name for name, column_type in CARTODB_COLUMNS]
+
+        new_column_list = CARTODB_COLUMNS + [c for c in column_list if c[0].lower() not in cartodb_column_names]
+        copy_columns = ', '.join([name for name, column_type in column_list])
+
+        cursor.execute('CREATE TABLE standin_cartodbfy ({0})'.format(', '.join(['{0} {1}'.format(*c)
+                                                                                for c in new_column_list])))
+        cursor.execute('INSERT INTO standin_cartodbfy ({0}) SELECT {0} FROM {1}'.format(copy_columns, table_name))
+        cursor.execute('DROP TABLE {0}'.format(table_name))
+        cursor.execute('ALTER TABLE standin_cartodbfy RENAME TO {0}'.format(table_name))
+
+        for column_name in ['the_geom', 'the_geom_webmercator']:
+            cursor.execute('CREATE INDEX {0}_{1}_idx ON {0} ({1})'.format(table_name, column_name))
+
+        cursor.execute('SELECT ? AS cdb_cartodbfytable', (table_name,))
+
+    def rename_index(self, cursor, match):
+        index_name, new_index_name = match.groups()
+        index_sql = cursor.execute('SELECT sql FROM sqlite_master WHERE type = ? AND name = ?',
+                                   ('index', index_name)).fetchone()[0]
+
+        cursor.execute('DROP INDEX {0}'.format(index_name))
+        cursor.execute(re.sub(r'(?i)^(CREATE (?:UNIQUE )?INDEX )"?\w+"?', r'\g<1>' + new_index_name, index_sql))
+
+    def rename_table(self, cursor, match):
+        cursor.execute(match.group(0))
+        cursor.execute('UPDATE standin_comments SET table_name = ? WHERE table_name = ?', match.groups()[::-1])
+
+    def drop_table(self, cursor, match):
+        cursor.execute(match.group(0))
+        cursor.execute('DELETE FROM standin_comments WHERE table_name = ?', (match.group(2),))
+
+    def comment(self, cursor, match):
+        table_name, comment = match.groups()
+        cursor.execute('DELETE FROM standin_comments WHERE table_name = ?', (table_name,))
+
+        if comment.upper() != 'NULL':
+            cursor.execute('INSERT INTO standin_comments VALUES (?, ?)', (table_name, comment[1:-1].replace("''", "'")))
+
+    def run_statement(self, cursor, statement):
+        statement = rewrite_statement(statement, self.user)
+
+        for pattern, handler in self.handlers:
+            match = pattern.match(statement)
+
+            if match:
+                return handler(cursor, match)
+
+        cursor.execute(statement)
+
+    def execute(self, sql):
+        """
+        Execute one or more SQL statements in a transaction
+        :param sql: the SQL
+        :return: SQL API response dict with rows, fields, total_rows and time
+        """
+        start_time = time.time()
+
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+
+            try:
+                for statement in split_statements(sql):
+                    self.run_statement(cursor, statement)
+
+                if cursor.description:
+                    field_names = [d[0] for d in cursor.description]
+                    row_list = [OrderedDict(zip(field_names, [json_value(v) for v in row])) for row in cursor]
+                    total_rows = len(row_list)
+
+                else:
+                    field_names = []
+                    row_list = []
+                    total_rows = max(cursor.rowcount, 0)
+
+                cursor.execute('COMMIT')
+
+            except sqlite3.Error:
+                cursor.execute('ROLLBACK')
+                raise
+
+        fields = OrderedDict()
+        for name in field_names:
+            fields[name] = {'type': field_type(row_list[0][name]) if row_list else 'string'}
+
+        return OrderedDict([('rows', row_list), ('time', time.time() - start_time), ('fields', fields),
+                            ('total_rows', total_rows)])
+
+    def interrupt(self):
+        self.conn.interrupt()
+
+
+class BatchJobRunner(object):
+    """
+    Runs batch jobs one at a time in the order they were submitted, like the Batch SQL API does for each user
+    :param database: StandinDatabase
+    :param job_delay: seconds each job stays pending before it runs, to test polling and cancelling
+    :return:
+    """
+
+    def __init__(self, database, job_delay=0):
+        self.database = database
+        self.job_delay = job_delay
+
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        worker = threading.Thread(target=self.run_jobs)
+        worker.daemon = True
+        worker.start()
+
+    def update_job(self, job, **kwargs):
+        job.update(kwargs)
+        job['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def submit(self, user, query):
+        job = OrderedDict([('job_id', str(uuid.uuid4())), ('user', user), ('query', query), ('status', 'pending')])
+
+        with self.lock:
+            self.update_job(job, created_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+            self.jobs[job['job_id']] = job
+
+        self.queue.put(job['job_id'])
+
+        return dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+            if not job or job['status'] in FINISHED_JOB_STATES:
+                return None
+
+            if job['status'] == 'running':
+                self.database.interrupt()
+
+            self.update_job(job, status='cancelled')
+
+            return dict(job)
+
+    def run_jobs(self):
+        while True:
+            job_id = self.queue.get()
+            time.sleep(self.job_delay)
+
+            with self.lock:
+                job = self.jobs[job_id]
+
+                if job['status'] != 'pending':
+                    continue
+
+                self.update_job(job, status='running')
+
+            try:
+                self.database.execute(job['query'])
+                status, failed_reason = 'done', None
+
+            except sqlite3.Error as e:
+                status, failed_reason = 'failed', str(e)
+
+            with self.lock:
+                if job['status'] == 'running':
+                    self.update_job(job, status=status)
+
+                    if failed_reason:
+                        self.update_job(job, failed_reason=failed_reason)
+
+            logging.info('Batch job {0} {1}'.format(job_id, job['status']))
+
+
+class StandinRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles /api/v2/sql (q and api_key as query string or form parameters) and the Batch SQL API at
+    /api/v2/sql/job (POST a JSON {"query": ...}) and /api/v2/sql/job/{job_id} (GET to poll, DELETE to cancel)
+    """
+
+    # Keep connections open between requests, like the SQL API
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status_code, body):
+        content = json.dumps(body)
+        self.server.add_stats(bytes_sent=len(content))
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_params(self):
+        """
+        Read the parameters from the query string and the request body
+        :return: (path, dict of parameters, JSON body or None)
+        """
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        json_body = None
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        self.server.add_stats(requests=1, bytes_received=len(self.path) + len(body))
+
+        if 'application/json' in (self.headers.get('Content-Type') or ''):
+            json_body = json.loads(body) if body else {}
+        else:
+            params.update(urlparse.parse_qsl(body))
+
+        return url.path.rstrip('/'), params, json_body
+
+    def handle_request(self):
+        path, params, json_body = self.read_params()
+
+        if not path.startswith(self.server.sql_path):
+            return self.send_json(404, {'error': ['not found']})
+
+        if self.server.api_key and params.get('api_key') != self.server.api_key:
+            return self.send_json(401, {'error': ['permission denied']})
+
+        job_path = path[len(self.server.sql_path):].strip('/').split('/')
+
+        if job_path == ['']:
+            if 'q' not in params:
+                return self.send_json(400, {'error': ['You must indicate a sql query']})
+
+            try:
+                return self.send_json(200, self.server.database.execute(params['q'].decode('utf-8')))
+            except sqlite3.Error as e:
+                return self.send_json(400, {'error': [str(e)]})
+
+        elif job_path == ['job'] and self.command == 'POST':
+            if not json_body or not json_body.get('query'):
+                return self.send_json(400, {'error': ['You must indicate a valid SQL']})
+
+            return self.send_json(201, self.server.jobs.submit(self.server.user, json_body['query']))
+
+        elif len(job_path) == 2 and job_path[0] == 'job' and self.command in ['GET', 'DELETE']:
+            if self.command == 'GET':
+                job = self.server.jobs.get(job_path[1])
+            else:
+                job = self.server.jobs.cancel(job_path[1])
+
+            if not job:
+                return self.send_json(404, {'error': ['Job with id {0} not found'.format(job_path[1])]})
+
+            return self.send_json(200, job)
+
+        return self.send_json(404, {'error': ['not found']})
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_DELETE = handle_request
+
+    def log_message(self, message_format, *args):
+        logging.debug(message_format % args)
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in for the CartoDB SQL API and Batch SQL API, for testing the sync without a cartoDB account
+    Set sql_api to http://localhost:{port}/api/v2/sql to use it
+    :param port: port to listen on; 0 picks a free port
+    :param database_path: SQLite database to run the SQL against
+    :param api_key: API key requests must include; if None, any key is accepted
+    :param job_delay: seconds each batch job stays pending before it runs
+    :param user: account name
+    :return:
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, database_path=':memory:', api_key=None, job_delay=0, user='standin'):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), StandinRequestHandler)
+
+        self.sql_path = '/api/v2/sql'
+        self.api_key = api_key
+        self.user = user
+
+        self.database = StandinDatabase(database_path, user)
+        self.jobs = BatchJobRunner(self.database, job_delay)
+
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def add_stats(self, **kwargs):
+        with self.stats_lock:
+            for key, value in kwargs.iteritems():
+                self.stats[key] += value
+
+    def reset_stats(self):
+        """
+        Zero the counts of requests and bytes received and sent
+        :return: the counts before they were reset
+        """
+        with self.stats_lock:
+            stats = dict(self.stats)
+            self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0}
+
+        return stats
+
+    @property
+    def sql_api(self):
+        return 'http://localhost:{0}{1}'.format(self.server_address[1], self.sql_path)
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        :return: the SQL API url
+        """
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        return self.sql_api
+
+    def stop(self):
+        """
+        Stop serving requests started by start() and close the listening socket
+        :return:
+        """
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the CartoDB SQL API.')
+    parser.add_argument('--port', type=int, default=8090, help='port to listen on')
+    parser.add_argument('--database', default=':memory:', help='SQLite database to run the SQL against')
+    parser.add_argument('--api-key', help='API key requests must include; by default any key is accepted')
+    parser.add_argument('--job-delay', type=float, default=0,
+                        help='seconds each batch job stays pending before it runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
+
+    server = StandinServer(args.port, args.database, args.api_key, args.job_delay)
+
+    print 'CartoDB SQL API stand-in listening at {0}'.format(server.sql_api)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
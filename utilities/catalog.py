@@ -0,0 +1,191 @@
+import os
+import threading
+
+from lazy_import import arcpy
+
+# {(path, property): value} for datasets described during this run
+_cache = {}
+_lock = threading.RLock()
+
+# {(path, property): threading.Event} for lookups in progress, so that other threads wanting the same property
+# wait for that lookup instead of starting their own, without holding up lookups of anything else
+_pending = {}
+
+# Incremented by every invalidate, so a lookup that was running at the time doesn't cache what it found
+_generation = 0
+
+
+def _cache_key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _is_catalog_path(path):
+    # Feature layers and table views (i.e. 'esri_service_output_fl') are just names, and can be redefined at any
+    # time, so only datasets with a full path are cached
+    return isinstance(path, basestring) and (os.sep in path or '/' in path)
+
+
+def _get(path, property_name, func):
+    """
+    Get a cached property of a dataset, calling func to look it up the first time
+    func (i.e. arcpy.Describe of an SDE dataset) can be slow, so it's called outside the lock
+    :param path: path to the dataset
+    :param property_name: name of the property in the cache
+    :param func: function that takes the path and returns the property
+    :return: the property
+    """
+    if not _is_catalog_path(path):
+        return func(path)
+
+    key = (_cache_key(path), property_name)
+
+    while True:
+        with _lock:
+            if key in _cache:
+                return _cache[key]
+
+            event = _pending.get(key)
+
+            if not event:
+                event = _pending[key] = threading.Event()
+                generation = _generation
+                break
+
+        # Another thread is looking it up; if it failed, try again ourselves
+        event.wait()
+
+    try:
+        value = func(path)
+
+        with _lock:
+            if generation == _generation:
+                _cache[key] = value
+
+        return value
+
+    finally:
+        with _lock:
+            del _pending[key]
+
+        event.set()
+
+
+def invalidate(path=None):
+    """
+    Drop everything cached for a dataset, i.e. after adding a field or appending to it. Datasets inside it (i.e.
+    feature classes in a GDB, or anything in a deleted scratch directory) are dropped as well
+    :param path: path to the dataset; if None, clear the whole cache
+    :return:
+    """
+    global _generation
+
+    with _lock:
+        _generation += 1
+
+        if path is None:
+            _cache.clear()
+
+        elif _is_catalog_path(path):
+            path_key = _cache_key(path)
+
+            for key in [k for k in _cache if k[0] == path_key or k[0].startswith(path_key + os.sep)]:
+                del _cache[key]
+
+
+def exists(path):
+    """
+    Check if a dataset exists. Only positive results are cached; datasets are created during the run
+    :param path: path to the dataset
+    :return: True | False
+    """
+    if not _is_catalog_path(path):
+        return arcpy.Exists(path)
+
+    key = (_cache_key(path), 'exists')
+
+    with _lock:
+        if key in _cache:
+            return True
+
+    path_exists = arcpy.Exists(path)
+
+    if path_exists:
+        with _lock:
+            _cache[key] = True
+
+    return path_exists
+
+
+def describe(path):
+    return _get(path, 'describe', arcpy.Describe)
+
+
+def spatial_reference(path):
+    return _get(path, 'spatialReference', lambda p: describe(p).spatialReference)
+
+
+def extent(path):
+    return _get(path, 'extent', lambda p: describe(p).extent)
+
+
+def data_type(path):
+    return _get(path, 'dataType', lambda p: describe(p).dataType)
+
+
+def fields(path):
+    """
+    List the fields of a dataset
+    :param path: path to the dataset
+    :return: list of arcpy field objects
+    """
+    return _get(path, 'fields', arcpy.ListFields)
+
+
+def field_names(path):
+    return [f.name for f in fields(path)]
+
+
+def add_field(in_table, *args, **kwargs):
+    """
+    Add a field with arcpy.AddField_management, then invalidate the cached field list
+    Takes the same arguments as arcpy.AddField_management
+    """
+    result = arcpy.AddField_management(in_table, *args, **kwargs)
+    invalidate(in_table)
+
+    return result
+
+
+def delete_field(in_table, *args, **kwargs):
+    """
+    Delete a field with arcpy.DeleteField_management, then invalidate the cached field list
+    Takes the same arguments as arcpy.DeleteField_management
+    """
+    result = arcpy.DeleteField_management(in_table, *args, **kwargs)
+    invalidate(in_table)
+
+    return result
+
+
+def append(inputs, target, *args, **kwargs):
+    """
+    Append with arcpy.Append_management, then invalidate the target's cached extent etc
+    Takes the same arguments as arcpy.Append_management. If target is a feature layer, the caller must invalidate
+    the dataset it references
+    """
+    result = arcpy.Append_management(inputs, target, *args, **kwargs)
+    invalidate(target)
+
+    return result
+
+
+def delete(in_data, *args, **kwargs):
+    """
+    Delete a dataset with arcpy.Delete_management, then invalidate what's cached for it, so that a dataset
+    created at the same path later isn't described from the cache
+    Takes the same arguments as arcpy.Delete_management
+    """
+    result = arcpy.Delete_management(in_data, *args, **kwargs)
+    invalidate(in_data)
+
+    return result
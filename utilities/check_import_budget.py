@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules that take seconds to import or are only needed by some layer types. None of the entry points should
+# import these before they start processing a layer
+HEAVY_MODULES = ['arcpy', 'arcpy_metadata', 'gspread', 'oauth2client', 'boto', 'bs4', 'validators', 'win32file',
+                 'requests']
+
+# Entry point (relative to the gfw-sync2 dir): max seconds to run its imports
+IMPORT_BUDGETS = {'gfw-sync.py': 1.0,
+                  os.path.join('utilities', 'cronjob.py'): 1.0,
+                  os.path.join('utilities', 'email_stats.py'): 1.0}
+
+# Run in a fresh interpreter so that each entry point starts with an empty sys.modules
+# The script runs under a name other than __main__, so its imports run but main() doesn't
+PROBE = '''
+import json, os, runpy, sys, time
+
+script = sys.argv[1]
+sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+
+start_time = time.time()
+runpy.run_path(script, run_name='import_budget')
+elapsed = time.time() - start_time
+
+sys.stdout.write(json.dumps({'seconds': elapsed, 'modules': sys.modules.keys()}))
+'''
+
+
+def check_entry_point(script, budget, root_dir):
+    """
+    Import an entry point in a new python process and check how long it took and what it imported
+    :param script: path to the script, relative to root_dir
+    :param budget: max seconds allowed
+    :param root_dir: the gfw-sync2 dir
+    :return: list of error messages; empty if the entry point is within budget
+    """
+    output = subprocess.check_output([sys.executable, '-c', PROBE, script], cwd=root_dir)
+    result = json.loads(output.splitlines()[-1])
+
+    error_list = []
+
+    if result['seconds'] > budget:
+        error_list.append('{0} took {1:.2f} seconds to import; budget is {2:.2f}'.format(script, result['seconds'],
+                                                                                      budget))
+
+    heavy_imports = sorted([m for m in HEAVY_MODULES if m in result['modules']])
+
+    if heavy_imports:
+        error_list.append('{0} imported {1} at startup'.format(script, ', '.join(heavy_imports)))
+
+    print '{0}: {1:.2f} seconds'.format(script, result['seconds'])
+
+    return error_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that gfw-sync entry points start up within budget.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply all budgets by this value, i.e. on a slower machine')
+    args = parser.parse_args()
+
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    error_list = []
+
+    for script, budget in sorted(IMPORT_BUDGETS.iteritems()):
+        error_list += check_entry_point(script, budget * args.scale, root_dir)
+
+    if error_list:
+        print '\n'.join(error_list)
+        sys.exit(1)
+
+    print 'All entry points within import budget'
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,10 @@
-import subprocess
 import datetime
 import argparse
 
 import google_sheet as gs
 import email_stats
-
-parser = argparse.ArgumentParser(description='Pass environment to kick off gfw-sync cron job.')
-parser.add_argument('--environment', '-e', default='DEV', choices=('DEV', 'PROD'),
-                    help='the environment/config files to use for this run')
-args = parser.parse_args()
+import settings
+from scheduler import LayerScheduler
 
 
 def parse_update_freq(field_text):
@@ -46,18 +42,33 @@ def parse_update_freq(field_text):
 
     return update_layer
 
-	
+
 def main():
-	all_layer_dict = gs.sheet_to_dict(args.environment)
+    parser = argparse.ArgumentParser(description='Pass environment to kick off gfw-sync cron job.')
+    parser.add_argument('--environment', '-e', default='DEV', choices=('DEV', 'PROD'),
+                        help='the environment/config files to use for this run')
+    parser.add_argument('--config-source', default='google',
+                        help='where to read the config table: google, or the path to a JSON file or directory of '
+                             'CSVs exported from it')
+    args = parser.parse_args()
+
+    gs.set_config_source(args.config_source)
+
+    # Download the config table at the start of the nightly run; the layers we start will reuse this snapshot
+    all_layer_dict = gs.sheet_to_dict(args.environment, refresh=True)
 
-	for layername, layerdef in all_layer_dict.iteritems():
+    due_layer_dict = {layername: layerdef for layername, layerdef in all_layer_dict.iteritems()
+                      if parse_update_freq(layerdef['update_days'])}
 
-		update_layer_today = parse_update_freq(layerdef['update_days'])
+    # Run independent layers at the same time, respecting the limits set for each shared resource
+    scheduler_settings = dict(settings.get_settings(args.environment)['scheduler'])
+    max_workers = scheduler_settings.pop('max_workers')
 
-		if update_layer_today:
-			subprocess.call(['python', 'gfw-sync.py', '-l', layername, '-e', args.environment])
+    scheduler = LayerScheduler(due_layer_dict, args.environment, max_workers, scheduler_settings,
+                               args.config_source)
+    layer_results = scheduler.run()
 
-	email_stats.send_summary()
+    email_stats.send_summary(layer_results)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
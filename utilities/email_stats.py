@@ -5,17 +5,21 @@ from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 
 import util
+import instrumentation
 
 
-def send_summary():
+def send_summary(layer_results=None):
     """
     Read log file and send the result email
+    :param layer_results: optional dict of {layername: return code} from the cronjob scheduler
     :return:
     """
     root_dir = os.getcwd()
     log_file = os.path.join(root_dir, 'logs', time.strftime("%Y%m%d") + '.log')
 
-    result_text = read_log_to_result_text(log_file)
+    result_text = read_log_to_result_text(log_file, layer_results)
+    result_text += slowest_stages_text()
+
     send_email(result_text)
 
 
@@ -47,10 +51,12 @@ def parse_line_add_result(input_line, input_dict):
     return input_dict
 
 
-def read_log_to_result_text(log):
+def read_log_to_result_text(log, layer_results=None):
     """
     Open the log file, parse it, and then inspect the return dict to understand if layers succeeded/failed
     :param log: path to log file
+    :param layer_results: optional dict of {layername: return code}. Layers that exited with an error or never
+    wrote to the log are reported as failures
     :return: text output for an email
     """
     layer_log_dict = {}
@@ -69,6 +75,15 @@ def read_log_to_result_text(log):
         else:
             final_dict['failure'].append(layername)
 
+    if layer_results:
+        for layername, returncode in layer_results.iteritems():
+            for result_type in ['success', 'checked']:
+                if returncode != 0 and layername in final_dict[result_type]:
+                    final_dict[result_type].remove(layername)
+
+            if (returncode != 0 or layername not in layer_log_dict) and layername not in final_dict['failure']:
+                final_dict['failure'].append(layername)
+
     text_output = 'These layers succeeded:<br>{0}<br><br>' \
                   'These layers were checked but no new data found:<br>{1}<br><br>' \
                   'These layers failed:<br>{2}' \
@@ -78,6 +93,23 @@ def read_log_to_result_text(log):
     return text_output
 
 
+def slowest_stages_text(count=10):
+    """
+    Read today's run reports and list the stages that took the longest
+    :param count: number of stages to list
+    :return: text output for an email
+    """
+    stage_list = instrumentation.slowest_records(count=count)
+
+    if not stage_list:
+        return ''
+
+    line_list = ['{0} | {1}: {2:.1f} min ({3} rows)'.format(layername, record['name'], record['wall_time'] / 60,
+                                                            record['rows']) for layername, record in stage_list]
+
+    return '<br><br>Slowest stages:<br>{0}'.format('<br>'.join(line_list))
+
+
 def send_email(body_text):
     """
     Send an email given a body text
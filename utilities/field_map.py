@@ -3,6 +3,7 @@ import arcpy
 import logging
 
 import util
+import catalog
 import settings
 import subtypes_and_domains as sub
 
@@ -116,7 +117,7 @@ def build_field_map(in_fc_list, in_field_dict):
 
             # Pull out the field object if it exists. We'll modify this to set a new name and length
             # and then push it back to the field mapping
-            current_field_list = [f for f in arcpy.ListFields(fc) if f.name == field_name]
+            current_field_list = [f for f in catalog.fields(fc) if f.name == field_name]
 
             # If this field exists in the fc of interest
             if len(current_field_list) == 1:
@@ -166,7 +167,7 @@ def _fieldmap_already_complete(in_fc, ini_dict):
     """
 
     ini_field_list = [k for k in ini_dict.keys() if k != '__joins__']
-    fc_field_list = [f.name for f in arcpy.ListFields(in_fc) if not f.required and 'Shape' not in f.name]
+    fc_field_list = [f.name for f in catalog.fields(in_fc) if not f.required and 'Shape' not in f.name]
 
     if set(ini_field_list) == set(fc_field_list):
         fm_already_complete = True
@@ -186,8 +187,8 @@ def set_workspace_from_fl(input_fl):
     """
 
     # Find SDE path so we can grab relevant tables
-    sde_path = os.path.dirname(arcpy.Describe(input_fl).catalogPath)
-    desc = arcpy.Describe(sde_path)
+    sde_path = os.path.dirname(catalog.describe(input_fl).catalogPath)
+    desc = catalog.describe(sde_path)
     if hasattr(desc, "datasetType") and desc.datasetType == 'FeatureDataset':
         sde_path = os.path.dirname(sde_path)
 
@@ -279,7 +280,7 @@ def _ini_dict_to_field_objects(in_fl, input_ini_dict):
                 source_field = field_obj.source_field.split('.')[-1]
 
             else:
-                source_table = arcpy.Describe(in_fl).catalogPath
+                source_table = catalog.describe(in_fl).catalogPath
                 source_field = field_obj.source_field
 
             # Need to use this to find the subtypes; if a feature layer has joins, it doesn't
@@ -326,7 +327,7 @@ def _get_full_field_name(in_field_name, in_fl):
             # If there are joins, need to qualify it with the full name of the FC
             if _has_joins(in_fl):
                 field_name = in_field_name
-                full_table_name = os.path.basename(arcpy.Describe(in_fl).catalogPath)
+                full_table_name = os.path.basename(catalog.describe(in_fl).catalogPath)
                 full_field_name = '{0}.{1}'.format(full_table_name, field_name)
 
             # If no joins, can just use the regular field name
@@ -349,8 +350,8 @@ def _has_joins(in_fl):
     # If joins are present, the name of the actual dataset will be visible in field names
     # i.e. if a regular field in not-joined dataset cmr.forest.prod_forest is area_ha
     # that field will be called cmr.forest.prod_forest.area_ha in a joined dataset
-    src_table = os.path.basename(arcpy.Describe(in_fl).catalogPath)
-    joined_fields = [f.name for f in arcpy.ListFields(in_fl) if src_table in f.name]
+    src_table = os.path.basename(catalog.describe(in_fl).catalogPath)
+    joined_fields = [f.name for f in catalog.fields(in_fl) if src_table in f.name]
 
     if joined_fields:
         has_joins = True
@@ -449,9 +450,9 @@ def _post_process_fields(in_fc, in_field_list):
         cursor_field_list = [field.out_field_name]
 
         # If the field is already in our output FC, don't need to add it again
-        if field.out_field_name not in [f.name for f in arcpy.ListFields(in_fc)]:
+        if field.out_field_name not in catalog.field_names(in_fc):
             # Add the out_field_name to the feature class-- was not present inintially
-            arcpy.AddField_management(in_fc, field.out_field_name, "TEXT", "", "", 254)
+            catalog.add_field(in_fc, field.out_field_name, "TEXT", "", "", 254)
 
         if field.equation_add_field:
 
@@ -479,7 +480,7 @@ def _post_process_fields(in_fc, in_field_list):
             # but the fields themselves are integers, therefore need an additional
             # text field to update with the proper value
             temp_field_name = field.out_field_name + '__string__'
-            arcpy.AddField_management(in_fc, temp_field_name, 'TEXT', "", "", 254)
+            catalog.add_field(in_fc, temp_field_name, 'TEXT', "", "", 254)
 
             # Add it to the list of Field objects, and to the cursor_field_list
             temp_field_obj = Field(temp_field_name)
@@ -568,15 +569,16 @@ def _cleanup_output_fc(in_fc, field_list):
                 else:
                     arcpy.RemoveSubtype_management(in_fc, field.subtype_dict.keys())
 
-            arcpy.DeleteField_management(in_fc, field.out_field_name)
+            catalog.delete_field(in_fc, field.out_field_name)
 
     # After we remove all the fields to delete, check if any __string__ fields are present
     # These are added above to handle domains/subtypes-- their source fields are integers, but output
     # values are strings. We update the __string__ fields to the correct value, then delete the original
     # coded value field and then rename the __string__ field to the proper name. Ugh.
-    temp_str_fields = [f.name for f in arcpy.ListFields(in_fc) if '__string__' in f.name]
+    temp_str_fields = [f.name for f in catalog.fields(in_fc) if '__string__' in f.name]
     for field_name in temp_str_fields:
         arcpy.AlterField_management(in_fc, field_name, field_name.replace('__string__', ''))
+        catalog.invalidate(in_fc)
 
 
 def ini_fieldmap_to_fc(in_fc, dataset_name, ini_dict, out_workspace):
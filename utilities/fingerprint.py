@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+import logging
+
+import catalog
+from lazy_import import arcpy
+
+
+def manifest_path(layername, gfw_env):
+    """
+    Each layer has its own manifest file so that layers running in parallel don't overwrite each other
+    :param layername: tech_title of the layer
+    :param gfw_env: gfw env
+    :return: path to {dir}\logs\manifests\{gfw_env}\{layername}.json
+    """
+    return os.path.join(os.getcwd(), 'logs', 'manifests', gfw_env, layername + '.json')
+
+
+def fingerprint_dataset(in_fc, exclude_fields=None):
+    """
+    Hash the schema, row count and contents of a feature class. Each feature is hashed from its attributes and
+    geometry, and the feature hashes are summed so that the result doesn't depend on row order
+    Required fields (OBJECTID, Shape_Length, etc) are skipped; they change whenever the data is copied
+    :param in_fc: input feature class
+    :param exclude_fields: fields to leave out (i.e. fields that this process adds to the source)
+    :return: md5 hex digest
+    """
+    exclude_list = [f.lower() for f in exclude_fields] if exclude_fields else []
+
+    field_list = [f for f in catalog.fields(in_fc) if not f.required and f.type not in ['Geometry', 'OID']
+                  and f.name.lower() not in exclude_list]
+    field_names = sorted([f.name for f in field_list])
+
+    schema_md5 = hashlib.md5()
+    for f in sorted(field_list, key=lambda x: x.name):
+        schema_md5.update('{0}|{1}|{2}\n'.format(f.name, f.type, f.length))
+
+    row_count = 0
+    feature_hash_sum = 0
+
+    with arcpy.da.SearchCursor(in_fc, field_names + ['SHAPE@WKB']) as cursor:
+        for row in cursor:
+            row_md5 = hashlib.md5(repr(row[:-1]))
+
+            if row[-1]:
+                row_md5.update(row[-1])
+
+            feature_hash_sum = (feature_hash_sum + int(row_md5.hexdigest(), 16)) % (2 ** 128)
+            row_count += 1
+
+    md5 = hashlib.md5()
+    md5.update(schema_md5.hexdigest())
+    md5.update('{0}|{1:032x}'.format(row_count, feature_hash_sum))
+
+    logging.debug('Fingerprinted {0} features in {1}'.format(row_count, in_fc))
+
+    return md5.hexdigest()
+
+
+def get_last_fingerprint(layername, gfw_env):
+    """
+    Get the source fingerprint stored after the last successful update of this layer
+    :param layername: tech_title of the layer
+    :param gfw_env: gfw env
+    :return: fingerprint, or None if there's no manifest for this layer
+    """
+    path = manifest_path(layername, gfw_env)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as manifest_file:
+        return json.load(manifest_file)['fingerprint']
+
+
+def save_fingerprint(layername, gfw_env, source_fingerprint):
+    """
+    Store the fingerprint of the source used in a successful update
+    :param layername: tech_title of the layer
+    :param gfw_env: gfw env
+    :param source_fingerprint: fingerprint from fingerprint_dataset
+    :return:
+    """
+    path = manifest_path(layername, gfw_env)
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as manifest_file:
+        json.dump({'layer': layername, 'fingerprint': source_fingerprint}, manifest_file, indent=4)
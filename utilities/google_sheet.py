@@ -1,8 +1,68 @@
-import gspread
+import os
+import csv
+import json
 import time
 import sys
 import logging
-from oauth2client.service_account import ServiceAccountCredentials
+import threading
+from retrying import retry
+
+import atomic_file
+
+# Default spreadsheet: the config table
+# https://docs.google.com/spreadsheets/d/1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI/edit#gid=0
+CONFIG_SPREADSHEET_KEY = r'1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI'
+
+# Seconds a downloaded sheet is used before we download it again. Snapshots are written to disk, so all layers
+# started by the nightly cronjob share one download
+SNAPSHOT_TTL = 15 * 60
+
+# Columns of the config table read by Layer.__init__, layer_decision_tree and the scheduler
+LAYERDEF_COLUMNS = ['tech_title', 'type', 'source', 'field_map', 'esri_service_output', 'cartodb_service_output',
+                    'merge_where_field', 'delete_features_input_where_clause', 'archive_output', 'download_output',
+                    'esri_mosaics', 'transformation', 'global_layer', 'add_country_value', 'vector_to_raster_output',
+                    'tile_cache_service', 'post_process_script', 'update_days', 'last_updated']
+
+# Authorized gspread client and its credentials, shared by every call in this process
+_client = None
+_credentials = None
+
+# Where the config table is read from and written to; see set_config_source
+_config_backend = None
+
+# {(spreadsheet_key, sheet_name): SheetSnapshot} for the sheets read by this process
+_snapshots = {}
+
+# Cell updates waiting for flush_pending_writes, in the order they were queued
+# Each is a tuple of (spreadsheet_key, sheet_name, unique_id_col, unique_id_value, colname, new value, old value)
+_pending_writes = []
+_pending_writes_lock = threading.Lock()
+
+
+def _get_client():
+    """
+    Authorize with the service account once per process. The access token is refreshed when it expires
+    :return: an authorized gspread client
+    """
+    global _client, _credentials
+
+    # Only import the google API libraries when we actually need to read/write the sheet
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    if not _client:
+        spreadsheet_file = r'D:\scripts\gfw-sync2\tokens\spreadsheet.json'
+
+        # Updated for oauth2client
+        # http://gspread.readthedocs.org/en/latest/oauth2.html
+        _credentials = ServiceAccountCredentials.from_json_keyfile_name(spreadsheet_file,
+                                                                        ['https://spreadsheets.google.com/feeds'])
+        _client = gspread.authorize(_credentials)
+
+    elif _credentials.access_token_expired:
+        _client.login()
+
+    return _client
 
 
 def _open_spreadsheet(sheet_name, custom_key=False):
@@ -11,56 +71,340 @@ def _open_spreadsheet(sheet_name, custom_key=False):
     :return: a gspread wks object that can be used to edit/update a given sheet
     """
 
-    spreadsheet_file = r'D:\scripts\gfw-sync2\tokens\spreadsheet.json'
-
     if custom_key:
         spreadsheet_key = custom_key
     else:
-        spreadsheet_key = r'1pkJCLNe9HWAHqxQh__s-tYQr9wJzGCb6rmRBPj8yRWI'
-
-    # Updated for oauth2client
-    # http://gspread.readthedocs.org/en/latest/oauth2.html
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(spreadsheet_file,
-                                                                   ['https://spreadsheets.google.com/feeds'])
+        spreadsheet_key = CONFIG_SPREADSHEET_KEY
 
-    gc = gspread.authorize(credentials)
-    wks = gc.open_by_key(spreadsheet_key).worksheet(sheet_name)
+    wks = _get_client().open_by_key(spreadsheet_key).worksheet(sheet_name)
 
     return wks
 
 
-def sheet_to_dict(gfw_env):
+class SheetSnapshot(object):
     """
-    Convert the spreadsheet to a dict with {layername: {colName: colVal, colName2: colVal}
-    :param gfw_env: the name of the sheet to call (PROD | DEV)
-    :return: a dictionary representing the sheet
+    A copy of all values in a sheet, indexed by column name and by the values in unique id columns
+    so that cell lookups don't need to scan the sheet
+    :param spreadsheet_key: key of the spreadsheet
+    :param sheet_name: name of the sheet
+    :param values: list of rows from wks.get_all_values(); the first row is the header
+    :param fetched: time the values were downloaded
+    :return:
+    """
+
+    def __init__(self, spreadsheet_key, sheet_name, values, fetched=None):
+        self.spreadsheet_key = spreadsheet_key
+        self.sheet_name = sheet_name
+        self.values = values
+        self.fetched = fetched if fetched else time.time()
+
+        self.header = values[0]
+        self._col_index = {colname: i for i, colname in enumerate(self.header)}
+
+        # {unique_id_col: {unique_id_value: row index}}, built the first time a column is used as an id
+        self._row_index = {}
+
+    @property
+    def path(self):
+        return snapshot_path(self.spreadsheet_key, self.sheet_name)
+
+    def expired(self):
+        return time.time() - self.fetched > SNAPSHOT_TTL
+
+    def _row(self, unique_id_col, unique_id_value):
+        if unique_id_col not in self._row_index:
+            col_index = self._col_index[unique_id_col]
+            self._row_index[unique_id_col] = {row[col_index]: i for i, row in enumerate(self.values) if i > 0}
+
+        return self._row_index[unique_id_col][unique_id_value]
+
+    def cell_location(self, unique_id_col, unique_id_value, colname):
+        """
+        Get the row and col of a cell, numbered from 1 like the google sheets API
+        Raises a KeyError if the id or column doesn't exist
+        :param unique_id_col: the column that has unique ids (tech_title in the config table)
+        :param unique_id_value: the particular value we're looking for in the unique id col
+        :param colname: the column name
+        :return: row_id, col_id
+        """
+        return self._row(unique_id_col, unique_id_value) + 1, self._col_index[colname] + 1
+
+    def get_value(self, unique_id_col, unique_id_value, colname):
+        return self.values[self._row(unique_id_col, unique_id_value)][self._col_index[colname]]
+
+    def set_value(self, unique_id_col, unique_id_value, colname, update_value):
+        self.values[self._row(unique_id_col, unique_id_value)][self._col_index[colname]] = update_value
+
+    def row_dict(self, unique_id_col, unique_id_value):
+        """
+        Get a row as {colname: value}. This is a new dict, so changes to it don't affect the snapshot
+        :param unique_id_col: the column that has unique ids (tech_title in the config table)
+        :param unique_id_value: the particular value we're looking for in the unique id col
+        :return: dict of the row
+        """
+        return dict(zip(self.header, self.values[self._row(unique_id_col, unique_id_value)]))
+
+    def to_dict(self, unique_id_col='tech_title'):
+        return {row[self._col_index[unique_id_col]]: dict(zip(self.header, row)) for row in self.values[1:]}
+
+    def save(self):
+        """
+        Write the snapshot to disk for other processes to use. Write to a temp file and then swap it in so that
+        another process never reads a partial snapshot
+        :return:
+        """
+        with atomic_file.write(self.path) as snapshot_file:
+            json.dump({'fetched': self.fetched, 'values': self.values}, snapshot_file)
+
+
+class ConfigBackend(object):
+    """
+    Interface for the places a sheet can be read from and written to
+    Sheets are lists of rows, with the column names in the first row, like wks.get_all_values()
+    """
+
+    # Save snapshots to disk so that other processes don't need to read the sheet again
+    cache_on_disk = False
+
+    def read_sheet(self, sheet_name):
+        raise NotImplementedError
+
+    def write_cells(self, sheet_name, cell_dict):
+        """
+        Write a batch of values
+        :param sheet_name: name of the sheet
+        :param cell_dict: {(unique_id_col, unique_id_value, colname): value}
+        :return:
+        """
+        raise NotImplementedError
+
+
+class GoogleSheetBackend(ConfigBackend):
     """
+    Reads and writes a sheet of a google spreadsheet
+    :param spreadsheet_key: key of the spreadsheet
+    :return:
+    """
+
+    cache_on_disk = True
+
+    def __init__(self, spreadsheet_key=CONFIG_SPREADSHEET_KEY):
+        self.spreadsheet_key = spreadsheet_key
+
+    def read_sheet(self, sheet_name):
+        logging.debug('Downloading sheet {0}'.format(sheet_name))
+        return _open_spreadsheet(sheet_name, self.spreadsheet_key).get_all_values()
+
+    def write_cells(self, sheet_name, cell_dict):
+        _write_cells(self.spreadsheet_key, sheet_name, cell_dict)
+
+
+class LocalFileBackend(ConfigBackend):
+    """
+    Reads and writes the config table from a local export, so that we can run without network access
+    Either a JSON file with a key for each sheet (PROD, DEV) holding a list of rows or a list of {colname: value}
+    dicts, or a directory with a CSV file for each sheet (PROD.csv, DEV.csv), as downloaded from google sheets
+    :param path: path to the JSON file or CSV directory
+    :return:
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            logging.error('Config source {0} does not exist. Exiting.'.format(path))
+            sys.exit(1)
 
-    sheet_as_dict = {}
-    wks = _open_spreadsheet(gfw_env)
-    gdoc_as_lists = wks.get_all_values()
+        self.path = path
+        self.is_csv = os.path.isdir(path)
 
-    # Pull the header row from the Google doc
-    header_row = gdoc_as_lists[0]
+    def _csv_path(self, sheet_name):
+        return os.path.join(self.path, sheet_name + '.csv')
 
-    # Iterate over the remaining data rows
-    for dataRow in gdoc_as_lists[1:]:
+    def _read_json(self):
+        with open(self.path) as json_file:
+            return json.load(json_file)
 
-        # Build a dictionary for each row with the column title
-        # as the key and the value of that row as the value
-        row_as_dict = {k: v for (k, v) in zip(header_row, dataRow)}
+    def read_sheet(self, sheet_name):
+        if self.is_csv:
+            with open(self._csv_path(sheet_name), 'rb') as csv_file:
+                return [row for row in csv.reader(csv_file)]
 
-        # Grab the technical title (what we know the layer as)
-        layer_name = row_as_dict['tech_title']
+        try:
+            row_list = self._read_json()[sheet_name]
+        except KeyError:
+            logging.error('Sheet {0} not found in {1}. Exiting.'.format(sheet_name, self.path))
+            sys.exit(1)
+
+        if row_list and isinstance(row_list[0], dict):
+            header = sorted(set([colname for row in row_list for colname in row]))
+            row_list = [header] + [[row.get(colname) for colname in header] for row in row_list]
+
+        # Match the google sheet, where every value is a string
+        return [[u'' if value is None else unicode(value) for value in row] for row in row_list]
+
+    def write_cells(self, sheet_name, cell_dict):
+        # Parallel gfw-sync runs can share a config source. Read it again under the lock so that their writes
+        # aren't lost, and swap the new file in so that a reader never sees it half written
+        lock_path = self._csv_path(sheet_name) if self.is_csv else self.path
+
+        with atomic_file.lock(lock_path):
+            snapshot = SheetSnapshot(None, sheet_name, self.read_sheet(sheet_name))
+
+            for (unique_id_col, unique_id_value, colname), value in cell_dict.iteritems():
+                snapshot.set_value(unique_id_col, unique_id_value, colname, value)
+
+            if self.is_csv:
+                with atomic_file.write(self._csv_path(sheet_name), 'wb') as csv_file:
+                    csv.writer(csv_file).writerows(snapshot.values)
+
+            else:
+                sheet_dict = self._read_json()
+
+                if sheet_dict[sheet_name] and isinstance(sheet_dict[sheet_name][0], dict):
+                    sheet_dict[sheet_name] = [dict(zip(snapshot.header, row)) for row in snapshot.values[1:]]
+                else:
+                    sheet_dict[sheet_name] = snapshot.values
+
+                with atomic_file.write(self.path) as json_file:
+                    json.dump(sheet_dict, json_file, indent=4, sort_keys=True)
+
+
+def set_config_source(config_source):
+    """
+    Choose where the config table is read from
+    :param config_source: 'google' for the google sheet, or the path to a JSON file/CSV directory exported from it
+    :return:
+    """
+    global _config_backend
+
+    if not config_source or config_source == 'google':
+        _config_backend = GoogleSheetBackend()
+    else:
+        _config_backend = LocalFileBackend(config_source)
+
+    # Anything read so far came from the previous source
+    _snapshots.pop((CONFIG_SPREADSHEET_KEY, 'PROD'), None)
+    _snapshots.pop((CONFIG_SPREADSHEET_KEY, 'DEV'), None)
+
+
+def _get_backend(spreadsheet_key):
+    if spreadsheet_key == CONFIG_SPREADSHEET_KEY:
+        if not _config_backend:
+            set_config_source('google')
+
+        return _config_backend
+
+    return GoogleSheetBackend(spreadsheet_key)
+
+
+def validate_config_table(values, sheet_name):
+    """
+    Check that the config table has the columns we need to build layers, and that each layer is listed once
+    :param values: list of rows; the first is the header
+    :param sheet_name: name of the sheet, for error messages
+    :return:
+    """
+    if not values:
+        logging.error('Config table {0} is empty. Exiting.'.format(sheet_name))
+        sys.exit(1)
+
+    missing_columns = [c for c in LAYERDEF_COLUMNS if c not in values[0]]
+
+    if missing_columns:
+        logging.error('Config table {0} is missing columns {1}. Exiting.'.format(sheet_name,
+                                                                                ', '.join(missing_columns)))
+        sys.exit(1)
+
+    tech_title_index = values[0].index('tech_title')
+    tech_title_list = [row[tech_title_index] for row in values[1:] if row[tech_title_index]]
+
+    duplicate_list = sorted(set([t for t in tech_title_list if tech_title_list.count(t) > 1]))
+
+    if duplicate_list:
+        logging.error('Config table {0} lists these layers more than once: {1}. '
+                      'Exiting.'.format(sheet_name, ', '.join(duplicate_list)))
+        sys.exit(1)
+
+
+def snapshot_path(spreadsheet_key, sheet_name):
+    return os.path.join(os.getcwd(), 'logs', 'config_cache', '{0}_{1}.json'.format(spreadsheet_key, sheet_name))
+
+
+def _load_snapshot_file(spreadsheet_key, sheet_name):
+    """
+    Load a snapshot saved by this or another process
+    :param spreadsheet_key: key of the spreadsheet
+    :param sheet_name: name of the sheet
+    :return: a SheetSnapshot, or None if there's no snapshot on disk or it has expired
+    """
+    path = snapshot_path(spreadsheet_key, sheet_name)
+
+    try:
+        with open(path) as snapshot_file:
+            snapshot_json = json.load(snapshot_file)
 
-        # Add that as a key to the larger outDict dictionary
-        sheet_as_dict[layer_name] = {}
+    # Missing, or being swapped by another process-- download instead
+    except (IOError, OSError, ValueError):
+        return None
 
-        # For the values in each row, add them to the row-level dictionary
-        for key, value in row_as_dict.iteritems():
-            sheet_as_dict[layer_name][key] = value
+    snapshot = SheetSnapshot(spreadsheet_key, sheet_name, snapshot_json['values'], snapshot_json['fetched'])
 
-    return sheet_as_dict
+    return None if snapshot.expired() else snapshot
+
+
+def get_snapshot(sheet_name, spreadsheet_key=None, refresh=False):
+    """
+    Get a snapshot of a sheet, downloading it only if we don't have one newer than SNAPSHOT_TTL
+    :param sheet_name: the name of the sheet (PROD | DEV for the config table)
+    :param spreadsheet_key: key for the spreadsheet if not the default config table
+    :param refresh: download the sheet even if we have a current snapshot
+    :return: a SheetSnapshot
+    """
+    if not spreadsheet_key:
+        spreadsheet_key = CONFIG_SPREADSHEET_KEY
+
+    backend = _get_backend(spreadsheet_key)
+    snapshot = _snapshots.get((spreadsheet_key, sheet_name))
+
+    if refresh or not snapshot or snapshot.expired():
+        snapshot = None
+
+        if backend.cache_on_disk and not refresh:
+            snapshot = _load_snapshot_file(spreadsheet_key, sheet_name)
+
+        if not snapshot:
+            values = backend.read_sheet(sheet_name)
+
+            if spreadsheet_key == CONFIG_SPREADSHEET_KEY:
+                validate_config_table(values, sheet_name)
+
+            snapshot = SheetSnapshot(spreadsheet_key, sheet_name, values)
+
+            if backend.cache_on_disk:
+                snapshot.save()
+
+        _snapshots[(spreadsheet_key, sheet_name)] = snapshot
+
+    return snapshot
+
+
+def sheet_to_dict(gfw_env, refresh=False):
+    """
+    Convert the spreadsheet to a dict with {layername: {colName: colVal, colName2: colVal}
+    :param gfw_env: the name of the sheet to call (PROD | DEV)
+    :param refresh: download the sheet even if we have a current snapshot
+    :return: a dictionary representing the sheet
+    """
+    return get_snapshot(gfw_env, refresh=refresh).to_dict()
+
+
+def load_config_snapshot(gfw_env, refresh=False):
+    """
+    Get the config table at the start of a run. Later calls to get_layerdef use the same snapshot until it expires
+    :param gfw_env: the name of the sheet to call (PROD | DEV)
+    :param refresh: download the sheet even if we have a current snapshot
+    :return: a dictionary representing the sheet
+    """
+    return sheet_to_dict(gfw_env, refresh)
 
 
 def get_layerdef(layer_name, gfw_env):
@@ -72,7 +416,7 @@ def get_layerdef(layer_name, gfw_env):
     """
 
     try:
-        layerdef = sheet_to_dict(gfw_env)[layer_name]
+        layerdef = get_snapshot(gfw_env).row_dict('tech_title', layer_name)
 
         layerdef['name'] = layerdef['tech_title']
         layerdef['gfw_env'] = gfw_env
@@ -86,7 +430,8 @@ def get_layerdef(layer_name, gfw_env):
 
 def set_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_value, spreadsheet_key=None):
     """
-    Update a value in the spreadsheet given the layername and column name
+    Update a value in the spreadsheet given the layername and column name. The snapshot of the sheet is patched
+    with the new value, both in memory and on disk
     :param unique_id_col: the column that has unique ids (tech_title in the config table)
     :param unique_id_value: the particular value we're looking for in the unique id col
     :param colname: the column name to update
@@ -94,15 +439,49 @@ def set_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_val
     :param in_update_value: the value to set
     :param spreadsheet_key: key for the spreadsheet if not the default config table
     """
+    if not spreadsheet_key:
+        spreadsheet_key = CONFIG_SPREADSHEET_KEY
+
+    cell_dict = {(unique_id_col, unique_id_value, colname): in_update_value}
+
+    _get_backend(spreadsheet_key).write_cells(sheet_name, cell_dict)
+    _patch_snapshots(spreadsheet_key, sheet_name, cell_dict)
+
+
+def _patch_snapshots(spreadsheet_key, sheet_name, cell_dict):
+    """
+    Patch written values into the snapshot in memory, and the snapshot on disk if the backend caches it
+    Start from the snapshot on disk if it's current; another process may have patched it since we loaded ours
+    :param spreadsheet_key: key of the spreadsheet
+    :param sheet_name: name of the sheet
+    :param cell_dict: {(unique_id_col, unique_id_value, colname): value}
+    :return:
+    """
+    snapshot = get_snapshot(sheet_name, spreadsheet_key)
+
+    for (unique_id_col, unique_id_value, colname), value in cell_dict.iteritems():
+        snapshot.set_value(unique_id_col, unique_id_value, colname, value)
+
+    if not _get_backend(spreadsheet_key).cache_on_disk:
+        return
 
-    wks, row_id, col_id = get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key)
+    # Other gfw-sync processes patch the same file; read it again under the lock so their changes aren't lost
+    with atomic_file.lock(snapshot.path):
+        disk_snapshot = _load_snapshot_file(spreadsheet_key, sheet_name)
 
-    wks.update_cell(row_id, col_id, in_update_value)
+        if disk_snapshot:
+            for (unique_id_col, unique_id_value, colname), value in cell_dict.iteritems():
+                disk_snapshot.set_value(unique_id_col, unique_id_value, colname, value)
+
+            disk_snapshot.save()
+
+        else:
+            snapshot.save()
 
 
 def get_value(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key=None):
     """
-    Update a value in the spreadsheet given the layername and column name
+    Get a value from the spreadsheet snapshot given the layername and column name
     :param unique_id_col: the column that has unique ids (tech_title in the config table)
     :param unique_id_value: the particular value we're looking for in the unique id col
     :param colname: the column name to get the value of
@@ -110,43 +489,161 @@ def get_value(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_k
     :param spreadsheet_key: key for the spreadsheet if not the default config table
     """
 
-    wks, row_id, col_id = get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key)
-
-    return wks.cell(row_id, col_id).value
+    return get_snapshot(sheet_name, spreadsheet_key).get_value(unique_id_col, unique_id_value, colname)
 
 
-def get_cell_location(unique_id_col, unique_id_value, colname, sheet_name, spreadsheet_key=None):
+def queue_value(unique_id_col, unique_id_value, colname, sheet_name, in_update_value, spreadsheet_key=None):
     """
-    Get the row and col of a particular cell so later we can report the value or update it
+    Queue a cell update to be written with all other queued updates by flush_pending_writes
+    The snapshot is patched right away, so get_value and get_layerdef return the new value
     :param unique_id_col: the column that has unique ids (tech_title in the config table)
     :param unique_id_value: the particular value we're looking for in the unique id col
-    :param colname: the column name to get the value of
-    :param sheet_name: the name of the sheet in the google doc
-    :param spreadsheet_key: json key if not the default config table
+    :param colname: the column name to update
+    :param sheet_name: the name of the sheet to update
+    :param in_update_value: the value to set
+    :param spreadsheet_key: key for the spreadsheet if not the default config table
+    """
+    snapshot = get_snapshot(sheet_name, spreadsheet_key)
+    old_value = snapshot.get_value(unique_id_col, unique_id_value, colname)
+
+    snapshot.set_value(unique_id_col, unique_id_value, colname, in_update_value)
+
+    with _pending_writes_lock:
+        _pending_writes.append((snapshot.spreadsheet_key, sheet_name, unique_id_col, unique_id_value, colname,
+                                in_update_value, old_value))
+
+
+def pending_write_count():
+    with _pending_writes_lock:
+        return len(_pending_writes)
+
+
+def discard_pending_writes(start_index=0):
+    """
+    Drop queued updates (i.e. those queued by a layer that then failed) and restore the old values in the snapshot
+    :param start_index: discard updates from this position in the queue on; use pending_write_count() to get it
+    before the work that queues them
+    :return:
+    """
+    with _pending_writes_lock:
+        discard_list = _pending_writes[start_index:]
+        del _pending_writes[start_index:]
+
+    for spreadsheet_key, sheet_name, unique_id_col, unique_id_value, colname, new_value, old_value in \
+            reversed(discard_list):
+        snapshot = get_snapshot(sheet_name, spreadsheet_key)
+        snapshot.set_value(unique_id_col, unique_id_value, colname, old_value)
+
+
+def _a1_address(row_id, col_id):
+    """
+    Convert a row and column number to an A1 style address, i.e. 3, 28 to AB3
+    :param row_id: row number, starting at 1
+    :param col_id: column number, starting at 1
+    :return: the A1 address
     """
+    col_letters = ''
+
+    while col_id:
+        col_id, remainder = divmod(col_id - 1, 26)
+        col_letters = chr(65 + remainder) + col_letters
+
+    return '{0}{1}'.format(col_letters, row_id)
+
 
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=60000, stop_max_attempt_number=6)
+def _write_cells(spreadsheet_key, sheet_name, cell_dict):
+    """
+    Write a batch of values to one sheet with a single update_cells call
+    Reads the range spanning all the cells once, which also gives us the id column values to check that rows haven't
+    moved since the snapshot was downloaded. If they have, the sheet is downloaded again and the batch retried
+    :param spreadsheet_key: key of the spreadsheet
+    :param sheet_name: name of the sheet
+    :param cell_dict: {(unique_id_col, unique_id_value, colname): value}
+    :return:
+    """
     wks = _open_spreadsheet(sheet_name, spreadsheet_key)
+    snapshot = get_snapshot(sheet_name, spreadsheet_key)
+
+    # {(row_id, col_id): (unique_id_col_id, unique_id_value, value)}
+    location_dict = {}
+
+    for (unique_id_col, unique_id_value, colname), value in cell_dict.iteritems():
+        row_id, col_id = snapshot.cell_location(unique_id_col, unique_id_value, colname)
+        unique_id_col_id = snapshot.cell_location(unique_id_col, unique_id_value, unique_id_col)[1]
+
+        location_dict[(row_id, col_id)] = (unique_id_col_id, unique_id_value, value)
+
+    row_ids = [row_id for row_id, col_id in location_dict]
+    col_ids = [c for row_id, col_id in location_dict for c in (col_id, location_dict[(row_id, col_id)][0])]
+
+    range_label = '{0}:{1}'.format(_a1_address(min(row_ids), min(col_ids)), _a1_address(max(row_ids), max(col_ids)))
+    range_cells = {(cell.row, cell.col): cell for cell in wks.range(range_label)}
+
+    for (row_id, col_id), (unique_id_col_id, unique_id_value, value) in location_dict.iteritems():
+        if range_cells[(row_id, unique_id_col_id)].value != unique_id_value:
+            get_snapshot(sheet_name, spreadsheet_key, refresh=True)
+            raise ValueError('Rows in sheet {0} have moved since it was downloaded; retrying'.format(sheet_name))
+
+    update_list = []
+
+    for (row_id, col_id), (unique_id_col_id, unique_id_value, value) in location_dict.iteritems():
+        range_cells[(row_id, col_id)].value = value
+        update_list.append(range_cells[(row_id, col_id)])
+
+    wks.update_cells(update_list)
+
+
+def flush_pending_writes():
+    """
+    Write all queued cell updates, one batch per sheet. Multiple updates to the same cell are coalesced, keeping the
+    last value. Each batch is retried with exponential backoff; if a batch still fails it's logged and left in the
+    queue
+    :return: True if all updates were written
+    """
+    with _pending_writes_lock:
+        write_list = list(_pending_writes)
+
+    # {(spreadsheet_key, sheet_name): {(unique_id_col, unique_id_value, colname): value}}
+    sheet_dict = {}
+
+    for spreadsheet_key, sheet_name, unique_id_col, unique_id_value, colname, new_value, old_value in write_list:
+        sheet_dict.setdefault((spreadsheet_key, sheet_name), {})[(unique_id_col, unique_id_value, colname)] = new_value
+
+    all_written = True
+
+    for (spreadsheet_key, sheet_name), cell_dict in sheet_dict.iteritems():
+        logging.debug('Writing {0} cells to sheet {1}'.format(len(cell_dict), sheet_name))
+
+        try:
+            _get_backend(spreadsheet_key).write_cells(sheet_name, cell_dict)
 
-    gdoc_as_lists = wks.get_all_values()
+        except Exception:
+            logging.exception('Unable to write {0} to sheet {1}'.format(cell_dict, sheet_name))
+            all_written = False
+            continue
 
-    unique_id_index = gdoc_as_lists[0].index(unique_id_col)
+        with _pending_writes_lock:
+            _pending_writes[:] = [w for w in _pending_writes if w[0:2] != (spreadsheet_key, sheet_name)
+                                  or w not in write_list]
 
-    row_id = [x[unique_id_index] for x in gdoc_as_lists].index(unique_id_value) + 1
-    col_id = gdoc_as_lists[0].index(colname) + 1
+        # The snapshot may have been downloaded again while writing, so patch it again
+        _patch_snapshots(spreadsheet_key, sheet_name, cell_dict)
 
-    return wks, row_id, col_id
+    return all_written
 
 
 def update_gs_timestamp(layername, gfw_env):
     """
-    Update the 'last_updated' column for the layer specified with the current date
+    Queue an update of the 'last_updated' column for the layer specified with the current date
+    Written to the sheet by flush_pending_writes at the end of the run
     :param layername: the row to update (based on tech_title column)
     :param gfw_env: gfw env
     """
-    set_value('tech_title', layername, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
+    queue_value('tech_title', layername, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
 
     # If the layer is part of a global_layer, update its last_updated timestamp as well
     associated_global_layer = get_layerdef(layername, gfw_env)['global_layer']
 
     if associated_global_layer:
-        set_value('tech_title', associated_global_layer, 'last_updated', time.strftime("%m/%d/%Y"), gfw_env)
+        queue_value('tech_title', associated_global_layer, 'last_updated', gfw_env, time.strftime("%m/%d/%Y"))
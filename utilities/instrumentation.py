@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+import urlparse
+from contextlib import contextmanager
+
+from lazy_import import arcpy, requests, urllib2
+
+# arcpy toolboxes whose tools we time when instrumentation is installed
+# Tools are exposed at the top level of arcpy as {ToolName}_{toolbox alias}
+ARCPY_TOOLBOXES = ['management', 'conversion', 'analysis', 'cartography', 'edit', 'server']
+
+_report = None
+_report_lock = threading.Lock()
+_local = threading.local()
+
+# Worker threads add to the rows and bytes of records opened by the thread that started them
+_count_lock = threading.Lock()
+_installed = False
+
+
+def report_path(layername, date_string=None):
+    """
+    Run reports are written to {dir}\logs\{date}\{layername}.json, alongside the log file for the same day
+    :param layername: tech_title of the layer
+    :param date_string: YYYYMMDD date; defaults to today
+    :return: path to the report
+    """
+    if not date_string:
+        date_string = time.strftime("%Y%m%d")
+
+    return os.path.join(os.getcwd(), 'logs', date_string, layername + '.json')
+
+
+def _cpu_time():
+    # os.times is for the whole process, so CPU time for stages that run at the same time overlaps
+    user_time, system_time = os.times()[0:2]
+    return user_time + system_time
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    return _local.stack
+
+
+def start_report(layername, gfw_env, run_id=None):
+    """
+    Start recording measurements for a layer. Anything measured until finish_report is called is added to it
+    :param layername: tech_title of the layer
+    :param gfw_env: gfw env
+    :param run_id: id of the gfw-sync run
+    :return:
+    """
+    global _report
+
+    with _report_lock:
+        _report = {'layer': layername, 'gfw_env': gfw_env, 'run_id': run_id, 'status': 'running',
+                   'start_time': time.strftime('%Y-%m-%d %H:%M:%S'), '_start': time.time(), '_cpu': _cpu_time(),
+                   'records': []}
+
+
+def discard_report():
+    """
+    Stop recording measurements without writing a report
+    :return:
+    """
+    global _report
+
+    with _report_lock:
+        _report = None
+
+
+def finish_report(status):
+    """
+    Add totals to the current report and write it to logs\{date}\{layername}.json
+    :param status: final status of the layer-- finished | checked | failed
+    :return: path to the report, or None if no report was started
+    """
+    global _report
+
+    with _report_lock:
+        report, _report = _report, None
+
+    if not report:
+        return None
+
+    report['status'] = status
+    report['wall_time'] = round(time.time() - report.pop('_start'), 3)
+    report['cpu_time'] = round(_cpu_time() - report.pop('_cpu'), 3)
+
+    totals = {}
+    for record in report['records']:
+        kind_totals = totals.setdefault(record['kind'], {'count': 0, 'wall_time': 0, 'rows': 0, 'bytes': 0})
+        kind_totals['count'] += 1
+        kind_totals['wall_time'] = round(kind_totals['wall_time'] + record['wall_time'], 3)
+        kind_totals['rows'] += record['rows']
+        kind_totals['bytes'] += record['bytes']
+
+    report['totals'] = totals
+
+    path = report_path(report['layer'])
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=4, sort_keys=True)
+
+    logging.debug('Wrote run report to {0}'.format(path))
+
+    return path
+
+
+@contextmanager
+def measure(kind, name):
+    """
+    Record the wall time, CPU time, rows and bytes of a block of code in the current report
+    If the innermost open record on this thread has the same kind and name (i.e. a stage that calls a method
+    that is also instrumented as a stage), that record is reused rather than nested
+    :param kind: type of record-- stage | arcpy | http | cartodb_chunk
+    :param name: name of the stage/tool/url
+    :return: the record dict
+    """
+    stack = _stack()
+
+    if stack and stack[-1]['kind'] == kind and stack[-1]['name'] == name:
+        yield stack[-1]
+        return
+
+    record = {'kind': kind, 'name': name, 'parent': stack[-1]['name'] if stack else None,
+              'thread': threading.current_thread().name, 'status': 'finished', 'rows': 0, 'bytes': 0}
+
+    start_time = time.time()
+    start_cpu = _cpu_time()
+    stack.append(record)
+
+    try:
+        yield record
+
+    except BaseException as e:
+        # Exiting with code 0 is how datasources report that there's nothing to do
+        if not (isinstance(e, SystemExit) and not e.code):
+            record['status'] = 'failed'
+        raise
+
+    finally:
+        stack.pop()
+
+        record['start_time'] = time.strftime('%H:%M:%S', time.localtime(start_time))
+        record['wall_time'] = round(time.time() - start_time, 3)
+        record['cpu_time'] = round(_cpu_time() - start_cpu, 3)
+
+        with _report_lock:
+            if _report:
+                _report['records'].append(record)
+
+
+def add_rows(row_count):
+    """
+    Add to the rows processed by every open record on this thread, so that a stage includes the rows of its chunks
+    (including chunks sent from worker threads, see inherit)
+    :param row_count: number of rows
+    :return:
+    """
+    with _count_lock:
+        for record in _stack():
+            record['rows'] += int(row_count)
+
+
+def add_bytes(byte_count):
+    """
+    Add to the bytes moved by every open record on this thread
+    :param byte_count: number of bytes
+    :return:
+    """
+    with _count_lock:
+        for record in _stack():
+            record['bytes'] += int(byte_count)
+
+
+def open_records():
+    """
+    Get the records open on this thread, to pass to worker threads started inside them
+    :return: list of records, outermost first
+    """
+    return list(_stack())
+
+
+@contextmanager
+def inherit(record_list):
+    """
+    Measure the work of a worker thread as part of records opened by the thread that started it: records the worker
+    opens get the innermost of them as their parent, and its rows and bytes are added to all of them
+    :param record_list: records from open_records
+    :return:
+    """
+    _local.stack = list(record_list)
+
+    try:
+        yield
+
+    finally:
+        _local.stack = []
+
+
+def clear_stack():
+    """
+    Forget the records open on this thread, i.e. the ones a forked worker process inherits from its parent
+    :return:
+    """
+    _local.stack = []
+
+
+def take_records():
+    """
+    Stop recording without writing a report, i.e. in a child process that hands its records back to the parent
+    :return: list of the records measured since start_report
+    """
+    global _report
+
+    with _report_lock:
+        report, _report = _report, None
+
+    return report['records'] if report else []
+
+
+def add_records(record_list):
+    """
+    Add records measured in another process to the current report. Records without a parent are attached to the
+    innermost open record on this thread, and their rows and bytes are added to every open record
+    :param record_list: records returned by take_records
+    :return:
+    """
+    stack = _stack()
+
+    for record in record_list:
+        if record['parent'] is None and stack:
+            record['parent'] = stack[-1]['name']
+
+            add_rows(record['rows'])
+            add_bytes(record['bytes'])
+
+    with _report_lock:
+        if _report:
+            _report['records'] += record_list
+
+
+def stage(func):
+    """
+    Decorator to measure a layer method as a stage
+    :param func: the method
+    :return: the wrapped method
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with measure('stage', func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _wrap_arcpy_tool(tool_name, tool):
+
+    @functools.wraps(tool)
+    def wrapper(*args, **kwargs):
+        with measure('arcpy', tool_name):
+            return tool(*args, **kwargs)
+
+    wrapper.instrumented = True
+
+    return wrapper
+
+
+def _describe_url(url):
+    parsed_url = urlparse.urlparse(url)
+    return '{0}{1}'.format(parsed_url.netloc, parsed_url.path)
+
+
+def _instrument_arcpy(arcpy_module):
+    for attribute_name in dir(arcpy_module):
+        tool = getattr(arcpy_module, attribute_name)
+
+        if callable(tool) and attribute_name.split('_')[-1] in ARCPY_TOOLBOXES and \
+                not getattr(tool, 'instrumented', False):
+            setattr(arcpy_module, attribute_name, _wrap_arcpy_tool(attribute_name, tool))
+
+
+def _instrument_requests(requests_module):
+    session_request = requests_module.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        # Requests made by code that measures its own HTTP calls (i.e. cartodb_sql) are already recorded
+        stack = _stack()
+        if stack and stack[-1]['kind'] == 'http':
+            return session_request(session, method, url, *args, **kwargs)
+
+        with measure('http', '{0} {1}'.format(method.upper(), _describe_url(url))):
+            response = session_request(session, method, url, *args, **kwargs)
+
+            # Don't read streamed responses here; the caller will read them in chunks
+            if kwargs.get('stream'):
+                add_bytes(response.headers.get('content-length', 0))
+            else:
+                add_bytes(len(response.content))
+
+            return response
+
+    requests_module.Session.request = request
+
+
+def _instrument_urllib2(urllib2_module):
+    urlopen = urllib2_module.urlopen
+
+    def instrumented_urlopen(url, *args, **kwargs):
+        url_string = url.get_full_url() if isinstance(url, urllib2_module.Request) else url
+
+        with measure('http', 'GET {0}'.format(_describe_url(url_string))):
+            response = urlopen(url, *args, **kwargs)
+            add_bytes(response.info().getheader('content-length') or 0)
+
+            return response
+
+    urllib2_module.urlopen = instrumented_urlopen
+
+
+def install():
+    """
+    Wrap the arcpy geoprocessing tools, requests and urllib2 so that every tool call and HTTP request is measured
+    Only calls made through the module (i.e. arcpy.Append_management, urllib2.urlopen) are wrapped
+    Modules that haven't been imported yet are wrapped when they are, so installing doesn't load arcpy
+    :return:
+    """
+    global _installed
+
+    if _installed:
+        return
+
+    arcpy.when_imported(_instrument_arcpy)
+    requests.when_imported(_instrument_requests)
+    urllib2.when_imported(_instrument_urllib2)
+
+    _installed = True
+
+
+def is_installed():
+    return _installed
+
+
+def slowest_records(date_string=None, kind='stage', count=10):
+    """
+    Read all run reports for a day and find the slowest records of a kind
+    :param date_string: YYYYMMDD date; defaults to today
+    :param kind: the kind of record to compare
+    :param count: number of records to return
+    :return: list of (layername, record) tuples, slowest first
+    """
+    report_dir = os.path.dirname(report_path('', date_string))
+
+    if not os.path.exists(report_dir):
+        return []
+
+    record_list = []
+
+    for fname in os.listdir(report_dir):
+        if os.path.splitext(fname)[1] != '.json':
+            continue
+
+        with open(os.path.join(report_dir, fname)) as report_file:
+            report = json.load(report_file)
+
+        record_list += [(report['layer'], r) for r in report['records'] if r['kind'] == kind]
+
+    return sorted(record_list, key=lambda x: x[1]['wall_time'], reverse=True)[0:count]
@@ -0,0 +1,106 @@
+import sys
+import importlib
+import threading
+
+# {module name: [callbacks to run once it's imported]}
+_import_callbacks = {}
+_import_lock = threading.RLock()
+
+
+class _ImportHook(object):
+    """
+    Import hook on sys.meta_path that runs the callbacks registered with when_imported right after a module is
+    first imported, whether that's through a LazyModule or a plain import statement elsewhere
+    :return:
+    """
+
+    def __init__(self):
+        self._importing = set()
+
+    def find_module(self, fullname, path=None):
+        # Let the regular importers find the module while we're importing it ourselves
+        if fullname in _import_callbacks and fullname not in self._importing:
+            return self
+
+        return None
+
+    def load_module(self, fullname):
+        self._importing.add(fullname)
+
+        try:
+            module = importlib.import_module(fullname)
+        finally:
+            self._importing.discard(fullname)
+
+        _run_callbacks(fullname)
+
+        return module
+
+
+_import_hook = _ImportHook()
+
+
+def _run_callbacks(module_name):
+    with _import_lock:
+        callback_list = _import_callbacks.pop(module_name, [])
+
+    for callback in callback_list:
+        callback(sys.modules[module_name])
+
+
+def when_imported(module_name, callback):
+    """
+    Call callback(module) once a module has been imported: now if it already has been, otherwise as soon as it is,
+    without importing it ourselves
+    :param module_name: name of the module
+    :param callback: function that takes the module
+    :return:
+    """
+    with _import_lock:
+        if _import_hook not in sys.meta_path:
+            sys.meta_path.insert(0, _import_hook)
+
+        _import_callbacks.setdefault(module_name, []).append(callback)
+
+    if module_name in sys.modules:
+        _run_callbacks(module_name)
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported the first time one of its attributes is used
+    Used for arcpy, which takes several seconds to import and isn't needed to schedule layers, send the
+    summary email or parse the command line
+    :param module_name: name of the module to import
+    :return:
+    """
+
+    def __init__(self, module_name):
+        self.__dict__['_module_name'] = module_name
+
+    def _load(self):
+        # importlib returns the module from sys.modules after the first import, so attributes patched onto the
+        # real module (i.e. by instrumentation.install) are always seen
+        return importlib.import_module(self._module_name)
+
+    def when_imported(self, callback):
+        """
+        Call callback(module) once the module has been imported, without importing it now
+        :param callback: function that takes the module
+        :return:
+        """
+        when_imported(self._module_name, callback)
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return '<lazy module {0}>'.format(self._module_name)
+
+
+arcpy = LazyModule('arcpy')
+requests = LazyModule('requests')
+urllib2 = LazyModule('urllib2')
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import catalog
+import atomic_file
+from lazy_import import arcpy
+
+# Min seconds between writes of the state file for chunks marked done; stages and layers are always written
+CHUNK_SAVE_SECONDS = 10
+
+
+def run_state_dir():
+    """
+    Run state files are written alongside the log files in {dir}\logs\runs
+    :return: path to the run state dir
+    """
+    return os.path.join(os.getcwd(), 'logs', 'runs')
+
+
+def _dataset_files(path):
+    """
+    List the files on disk that make up a dataset, so that we can fingerprint them without opening the data
+    :param path: path to a shapefile, tif, GDB feature class or other file-based dataset
+    :return: list of file paths, or an empty list if the dataset isn't file based (i.e. SDE)
+    """
+    if '.sde' in path.lower():
+        return []
+
+    # Feature classes in a GDB are stored in the GDB directory; a change to the FC changes these files
+    gdb_index = path.lower().find('.gdb')
+    if gdb_index != -1:
+        gdb_path = path[0:gdb_index + 4]
+        return [os.path.join(gdb_path, f) for f in sorted(os.listdir(gdb_path)) if not f.endswith('.lock')]
+
+    dirname, fname = os.path.split(path)
+    base_fname = os.path.splitext(fname)[0]
+
+    if os.path.isdir(dirname):
+        return [os.path.join(dirname, f) for f in sorted(os.listdir(dirname))
+                if os.path.splitext(f)[0] == base_fname and not f.endswith('.lock')]
+
+    return []
+
+
+def fingerprint_source(source):
+    """
+    Build a cheap fingerprint of a source dataset. Uses the names, sizes and modified times of the files that make
+    up the dataset (an edit to an attribute or a vertex changes the time, even if not the size), or the row count
+    and extent if the dataset isn't file based
+    :param source: path to a dataset, or a list of paths
+    :return: md5 hex digest
+    """
+    md5 = hashlib.md5()
+
+    path_list = source if type(source) is list else [source]
+
+    for path in path_list:
+        file_list = _dataset_files(path)
+
+        if file_list:
+            for f in file_list:
+                file_stat = os.stat(f)
+                md5.update('{0}|{1}|{2!r}\n'.format(os.path.basename(f), file_stat.st_size, file_stat.st_mtime))
+
+        else:
+            row_count = arcpy.GetCount_management(path).getOutput(0)
+            extent = catalog.extent(path)
+            md5.update('{0}|{1}|{2}\n'.format(path, row_count, extent.JSON))
+
+    return md5.hexdigest()
+
+
+class RunState(object):
+    """
+    A durable record of the work completed in a gfw-sync run. Written to {dir}\logs\runs\{run_id}.json after every
+    completed stage (and every few seconds while chunks are completing) so that a failed run can be resumed with
+    gfw-sync.py --resume {run_id}
+    :param run_id: the id of the run
+    :param state: dict of state loaded from a previous run
+    :return:
+    """
+
+    def __init__(self, run_id, state=None):
+        self.run_id = run_id
+        self.path = os.path.join(run_state_dir(), run_id + '.json')
+
+        self.state = state if state else {'run_id': run_id, 'layers': {}}
+        self.resumed = state is not None
+
+        # Chunk keys are kept as sets in memory, and written as lists
+        for layer_state in self.state['layers'].values():
+            layer_state['chunks'] = {name: set(key_list) for name, key_list in layer_state['chunks'].iteritems()}
+
+        self._lock = threading.RLock()
+        self._last_save = 0
+
+    @classmethod
+    def create(cls):
+        # Include the process id; the nightly scheduler starts several runs in the same second
+        run_id = '{0}_{1}'.format(time.strftime('%Y%m%d_%H%M%S'), os.getpid())
+        return cls(run_id)
+
+    @classmethod
+    def load(cls, run_id):
+        path = os.path.join(run_state_dir(), run_id + '.json')
+
+        if not os.path.exists(path):
+            raise IOError('No run state found for run {0} at {1}'.format(run_id, path))
+
+        with open(path) as state_file:
+            state = json.load(state_file)
+
+        return cls(run_id, state)
+
+    def save(self, force=True):
+        """
+        Write the state to a temp file, then swap it in so that a crash mid-write doesn't lose the previous state
+        :param force: write it even if it was written less than CHUNK_SAVE_SECONDS ago
+        :return:
+        """
+        with self._lock:
+            if not force and time.time() - self._last_save < CHUNK_SAVE_SECONDS:
+                return
+
+            with atomic_file.write(self.path) as state_file:
+                json.dump(self.state, state_file, sort_keys=True, default=sorted)
+
+            self._last_save = time.time()
+
+    def layer(self, layername):
+        """
+        Get the run state for one layer in this run
+        :param layername: tech_title of the layer
+        :return: LayerRunState object
+        """
+        with self._lock:
+            if layername not in self.state['layers']:
+                self.state['layers'][layername] = {'fingerprint': None, 'finished': False, 'stages': [], 'skipped': [],
+                                                   'attributes': {}, 'chunks': {}}
+
+        return LayerRunState(self, layername)
+
+
+class LayerRunState(object):
+    """
+    The part of a RunState for a single layer: the stages completed, the layer attributes saved after each stage,
+    and the cartodb chunks that have been uploaded
+    :param run_state: the RunState this belongs to
+    :param layername: tech_title of the layer
+    :return:
+    """
+
+    def __init__(self, run_state, layername):
+        self.run_state = run_state
+        self.layername = layername
+
+    @property
+    def _state(self):
+        return self.run_state.state['layers'][self.layername]
+
+    @property
+    def finished(self):
+        return self._state['finished']
+
+    def has_progress(self):
+        return bool(self._state['stages'])
+
+    def check_fingerprint(self, fingerprint):
+        """
+        Compare the fingerprint of the input to the one recorded when this layer last ran. If they differ,
+        the source has changed, and all recorded work for this layer is discarded
+        :param fingerprint: fingerprint of the current input
+        :return: True if the previously recorded work is still valid
+        """
+        with self.run_state._lock:
+            previous_fingerprint = self._state['fingerprint']
+            is_valid = previous_fingerprint == fingerprint
+
+            if previous_fingerprint and not is_valid:
+                logging.info('Input for {0} has changed since run {1}; '
+                             'rerunning all stages'.format(self.layername, self.run_state.run_id))
+
+            if not is_valid:
+                self._state.update({'fingerprint': fingerprint, 'finished': False, 'stages': [], 'skipped': [],
+                                    'attributes': {}, 'chunks': {}})
+                self.run_state.save()
+
+        return is_valid
+
+    def update_fingerprint(self, fingerprint):
+        with self.run_state._lock:
+            self._state['fingerprint'] = fingerprint
+            self.run_state.save()
+
+    def is_complete(self, stage_name):
+        return stage_name in self._state['stages']
+
+    def complete_stage(self, stage_name, attributes=None):
+        """
+        Record that a stage has completed, along with the layer attributes it produced
+        :param stage_name: name of the stage
+        :param attributes: dict of layer attributes to restore when resuming
+        :return:
+        """
+        with self.run_state._lock:
+            self._state['stages'].append(stage_name)
+
+            if stage_name in self._state.get('skipped', []):
+                self._state['skipped'].remove(stage_name)
+
+            if attributes:
+                self._state['attributes'].update(attributes)
+
+            self.run_state.save()
+
+    def skip_stages(self, stage_list):
+        """
+        Record the stages that were skipped because a stage they depend on failed; a resumed run runs them
+        :param stage_list: names of the skipped stages
+        :return:
+        """
+        with self.run_state._lock:
+            self._state['skipped'] = list(stage_list)
+            self.run_state.save()
+
+    def attributes(self):
+        return dict(self._state['attributes'])
+
+    def finish(self):
+        with self.run_state._lock:
+            self._state['finished'] = True
+            self.run_state.save()
+
+    def chunk_ledger(self, name):
+        """
+        Get a ledger to record the chunks uploaded to a particular cartodb table
+        :param name: name of the ledger (usually the cartodb table)
+        :return: ChunkLedger object
+        """
+        with self.run_state._lock:
+            if name not in self._state['chunks']:
+                self._state['chunks'][name] = set()
+
+        return ChunkLedger(self, name)
+
+
+class ChunkLedger(object):
+    """
+    Records the chunks of a cartodb sync that have completed, so a resumed sync can skip them
+    :param layer_run_state: the LayerRunState this belongs to
+    :param name: name of the ledger
+    :return:
+    """
+
+    def __init__(self, layer_run_state, name):
+        self.layer_run_state = layer_run_state
+        self.name = name
+
+    @property
+    def _chunks(self):
+        return self.layer_run_state._state['chunks'][self.name]
+
+    def has_chunks(self):
+        return bool(self._chunks)
+
+    def is_done(self, key):
+        return key in self._chunks
+
+    def keys(self):
+        return list(self._chunks)
+
+    def mark_done(self, key):
+        # A sync checks what's already in CartoDB when it resumes, so a chunk that isn't written here before a
+        # crash is only repeated, not lost
+        with self.layer_run_state.run_state._lock:
+            self._chunks.add(key)
+            self.layer_run_state.run_state.save(force=False)
+
+    def unmark(self, key):
+        with self.layer_run_state.run_state._lock:
+            if key in self._chunks:
+                self._chunks.discard(key)
+                self.layer_run_state.run_state.save()
+
+    def clear(self):
+        with self.layer_run_state.run_state._lock:
+            self._chunks.clear()
+            self.layer_run_state.run_state.save()
@@ -0,0 +1,176 @@
+import logging
+import subprocess
+import threading
+
+
+def layer_resources(layerdef):
+    """
+    List the shared resources a layer holds while it's being updated. Used by the LayerScheduler to make sure
+    we don't overload the SDE workspace, the cartoDB account or ArcGIS server by running too many layers at once
+    :param layerdef: a layerdef from the config table
+    :return: a list of resource names
+    """
+    resources = []
+
+    if '.sde' in layerdef['esri_service_output'].lower():
+        resources.append('sde')
+
+    if layerdef['cartodb_service_output']:
+        resources.append('cartodb')
+
+    if layerdef['tile_cache_service']:
+        resources.append('arcgis_server')
+
+    # Country layers that feed the same global layer all delete from/append to the same outputs
+    # Only one of them can safely be writing to that global layer at a time
+    if layerdef['global_layer']:
+        resources.append('global_layer:{0}'.format(layerdef['global_layer']))
+
+    return resources
+
+
+def build_dependencies(layer_dict):
+    """
+    Build a dict of {layername: set(layers that must finish first)}. If a global layer is due to run on the same
+    night as the country_vector layers that feed it, the country layers need to finish first
+    :param layer_dict: dict of {layername: layerdef} for all layers to run
+    :return: dependency dict
+    """
+    dependency_dict = {layername: set() for layername in layer_dict}
+
+    for layername, layerdef in layer_dict.iteritems():
+        global_layer = layerdef['global_layer']
+
+        if global_layer in layer_dict and global_layer != layername:
+            dependency_dict[global_layer].add(layername)
+
+    return dependency_dict
+
+
+class LayerScheduler(object):
+    """
+    Runs gfw-sync.py for a set of layers using a pool of workers. Layers start as soon as the layers they depend on
+    have finished and the shared resources they need (SDE, cartoDB, ArcGIS server) are below their limits
+    :param layer_dict: dict of {layername: layerdef} for all layers to run
+    :param gfw_env: the environment to pass to gfw-sync.py (PROD | DEV)
+    :param max_workers: the max number of layers to run at once
+    :param resource_limits: dict of {resource_name: max concurrent layers}. Resources not listed are unlimited
+    :param config_source: the --config-source to pass to gfw-sync.py
+    :return:
+    """
+
+    def __init__(self, layer_dict, gfw_env, max_workers=1, resource_limits=None, config_source='google'):
+        self.layer_dict = layer_dict
+        self.gfw_env = gfw_env
+        self.config_source = config_source
+        self.max_workers = max(int(max_workers), 1)
+
+        self.resource_limits = {}
+
+        if resource_limits:
+            for resource_name, limit in resource_limits.iteritems():
+                self.resource_limits[resource_name] = max(int(limit), 1)
+
+        self.dependencies = build_dependencies(layer_dict)
+        self.resources = {layername: layer_resources(layerdef) for layername, layerdef in layer_dict.iteritems()}
+
+        self.results = {}
+
+        self._pending = sorted(layer_dict.keys())
+        self._running = set()
+        self._resources_in_use = {}
+        self._condition = threading.Condition()
+
+    def _resource_limit(self, resource_name):
+        # Global layers can only be written by one country layer at a time
+        if resource_name.startswith('global_layer:'):
+            return 1
+
+        return self.resource_limits.get(resource_name)
+
+    def _can_start(self, layername):
+        """
+        Check that all dependencies are finished and all resources required by the layer are available
+        :param layername: the layer to check
+        :return: True | False
+        """
+        if not self.dependencies[layername].issubset(self.results.keys()):
+            return False
+
+        for resource_name in self.resources[layername]:
+            limit = self._resource_limit(resource_name)
+
+            if limit and self._resources_in_use.get(resource_name, 0) >= limit:
+                return False
+
+        return True
+
+    def _acquire(self, layername):
+        for resource_name in self.resources[layername]:
+            self._resources_in_use[resource_name] = self._resources_in_use.get(resource_name, 0) + 1
+
+        self._pending.remove(layername)
+        self._running.add(layername)
+
+    def _release(self, layername, returncode):
+        for resource_name in self.resources[layername]:
+            self._resources_in_use[resource_name] -= 1
+
+        self._running.remove(layername)
+        self.results[layername] = returncode
+
+    def run_layer(self, layername):
+        """
+        Run gfw-sync.py for a single layer in its own process
+        :param layername: the tech_title of the layer
+        :return: the return code of the process
+        """
+        return subprocess.call(['python', 'gfw-sync.py', '-l', layername, '-e', self.gfw_env,
+                                '--config-source', self.config_source])
+
+    def _worker(self, layername):
+        try:
+            returncode = self.run_layer(layername)
+
+        except Exception:
+            logging.exception('Unable to run gfw-sync for {0}'.format(layername))
+            returncode = 1
+
+        with self._condition:
+            self._release(layername, returncode)
+            self._condition.notify_all()
+
+    def run(self):
+        """
+        Start layers as workers, dependencies and resources allow until all layers have finished
+        :return: dict of {layername: return code}
+        """
+        with self._condition:
+            while self._pending or self._running:
+
+                for layername in list(self._pending):
+                    if len(self._running) >= self.max_workers:
+                        break
+
+                    if self._can_start(layername):
+                        self._acquire(layername)
+                        logging.debug('Starting {0}. Running: {1}'.format(layername, ', '.join(self._running)))
+
+                        worker = threading.Thread(target=self._worker, args=(layername,), name=layername)
+                        worker.daemon = True
+                        worker.start()
+
+                # Nothing running and nothing able to start-- the config table has a dependency cycle
+                if not self._running:
+                    logging.error('Unable to schedule {0}; check global_layer values for '
+                                  'a cycle'.format(', '.join(self._pending)))
+
+                    for layername in self._pending:
+                        self.results[layername] = 1
+
+                    self._pending = []
+                    break
+
+                self._condition.wait()
+
+        return self.results
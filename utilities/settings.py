@@ -1,6 +1,9 @@
 import os
 from configobj import ConfigObj
 
+# ini files from the config folder are only parsed once per process
+_config_cache = {}
+
 
 def get_ini_file(ini_f, folder=None):
     """
@@ -9,6 +12,9 @@ def get_ini_file(ini_f, folder=None):
     :return:
     """
 
+    if folder and (ini_f, folder) in _config_cache:
+        return _config_cache[(ini_f, folder)]
+
     if folder:
         abspath = os.path.abspath(__file__)
         dir_name = os.path.dirname(os.path.dirname(abspath))
@@ -19,6 +25,9 @@ def get_ini_file(ini_f, folder=None):
     # Grab the ini_file and return it's keys value pairs as a dict
     content = ConfigObj(ini_file)
 
+    if folder == 'config':
+        _config_cache[(ini_f, folder)] = content
+
     return content
 
 
@@ -0,0 +1,289 @@
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+
+import instrumentation
+import logger
+
+
+def _run_in_child(func, args, log_level, instrumented):
+    """
+    Entry point for a function run in a worker process by StageGraph.run_in_process
+    :param func: the function
+    :param args: tuple of arguments
+    :param log_level: name of the parent's log level
+    :param instrumented: whether the parent has installed instrumentation
+    :return: (return value, exit code, traceback string or None, instrumentation records)
+    """
+    # A spawned worker (i.e. on Windows) doesn't have the parent's handlers
+    if not logging.getLogger().handlers:
+        logger.build_logger(log_level)
+
+    if instrumented:
+        instrumentation.install()
+
+    instrumentation.clear_stack()
+    instrumentation.start_report(None, None)
+
+    result = None
+    exit_code = 0
+    error = None
+
+    try:
+        result = func(*args)
+
+    except SystemExit as e:
+        exit_code = e.code
+
+    except Exception:
+        error = traceback.format_exc()
+
+    return result, exit_code, error, instrumentation.take_records()
+
+
+class Stage(object):
+    """
+    A single step of a layer update
+    :param name: name of the stage, used for logging and to reference it as a dependency
+    :param func: function to call (no arguments) to run the stage
+    :param depends_on: list of stage names that must finish before this stage starts
+    :param uses_arcpy: whether the stage runs arcpy tools in its own thread; these stages run one at a time
+    :return:
+    """
+
+    def __init__(self, name, func, depends_on=None, uses_arcpy=False):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on) if depends_on else []
+        self.uses_arcpy = uses_arcpy
+
+        self.status = 'pending'
+
+
+class StageGraph(object):
+    """
+    A dependency graph of update stages. Stages run as soon as everything they depend on has finished, so stages
+    that only read the result of an earlier stage can run at the same time in a pool of threads
+    arcpy.env is global to a process, and arcpy isn't thread safe, so stages that run arcpy tools either hand that
+    work to run_in_process, or are added with uses_arcpy=True so that only one of them runs at a time
+    If a stage fails, the stages that depend on it are skipped, but independent stages still run to completion
+    :param name: name of the graph (usually the layer name), used for logging
+    :param max_workers: max number of stages to run at once
+    :param run_state: optional LayerRunState. Stages it lists as complete are skipped, and each stage that finishes
+    is recorded in it
+    :param checkpoint: optional function that takes a stage name and returns a dict of attributes to record in the
+    run_state after that stage
+    :return:
+    """
+
+    def __init__(self, name, max_workers=1, run_state=None, checkpoint=None):
+        self.name = name
+        self.max_workers = max(int(max_workers), 1)
+
+        self.run_state = run_state
+        self.checkpoint = checkpoint
+
+        self.stages = {}
+        self._stage_order = []
+
+        self._running = set()
+        self._condition = threading.Condition()
+
+        # Held while a uses_arcpy stage runs
+        self._arcpy_lock = threading.Lock()
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def add_stage(self, name, func, depends_on=None, uses_arcpy=False):
+        """
+        Add a stage to the graph
+        :param name: unique stage name
+        :param func: function to call to run the stage
+        :param depends_on: list of stage names that must finish first; must already be in the graph
+        :param uses_arcpy: run arcpy tools in this process; only one such stage runs at a time
+        :return: the stage object
+        """
+        if name in self.stages:
+            raise ValueError('Stage {0} already in graph {1}'.format(name, self.name))
+
+        for dependency in depends_on or []:
+            if dependency not in self.stages:
+                raise ValueError('Stage {0} depends on unknown stage {1}'.format(name, dependency))
+
+        stage = Stage(name, func, depends_on, uses_arcpy)
+
+        self.stages[name] = stage
+        self._stage_order.append(name)
+
+        return stage
+
+    def run_in_process(self, func, *args):
+        """
+        Run a function in a worker process and wait for it to finish. Each call gets a fresh process, so arcpy
+        environment settings made by one stage can't leak into another. Log messages go to the same log file, and
+        instrumentation records are added to the current report
+        :param func: a module-level function, so it can be pickled
+        :param args: picklable arguments
+        :return: the function's return value
+        """
+        with self._pool_lock:
+            if not self._pool:
+                self._pool = multiprocessing.Pool(self.max_workers, maxtasksperchild=1)
+
+        log_level = logging.getLevelName(logging.getLogger().getEffectiveLevel())
+
+        result, exit_code, error, record_list = self._pool.apply(_run_in_child, (func, args, log_level,
+                                                                                 instrumentation.is_installed()))
+        instrumentation.add_records(record_list)
+
+        if error:
+            raise RuntimeError('{0} failed in a worker process:\n{1}'.format(func.__name__, error))
+
+        if exit_code:
+            sys.exit(exit_code)
+
+        return result
+
+    def _ready_stages(self):
+        """
+        Find pending stages whose dependencies have all finished. Stages with a failed or skipped dependency
+        are marked as skipped
+        :return: list of stages ready to run, in the order they were added
+        """
+        ready_list = []
+
+        for stage_name in self._stage_order:
+            stage = self.stages[stage_name]
+
+            if stage.status != 'pending':
+                continue
+
+            dependency_status = [self.stages[d].status for d in stage.depends_on]
+
+            if 'failed' in dependency_status or 'skipped' in dependency_status:
+                logging.error('Skipping stage {0} for {1}; a stage it depends on did not '
+                              'finish'.format(stage_name, self.name))
+                stage.status = 'skipped'
+
+            elif all([s == 'finished' for s in dependency_status]):
+                ready_list.append(stage)
+
+        return ready_list
+
+    def run_stage(self, stage):
+        """
+        Run a single stage, logging how long it took
+        :param stage: the stage object
+        :return: the final status of the stage-- finished | failed
+        """
+        logging.debug('Starting stage {0} for {1}'.format(stage.name, self.name))
+        start_time = time.time()
+
+        try:
+            with instrumentation.measure('stage', stage.name):
+                if stage.uses_arcpy:
+                    with self._arcpy_lock:
+                        stage.func()
+                else:
+                    stage.func()
+
+            status = 'finished'
+
+        except SystemExit as e:
+            # Most validation failures are logged and then call sys.exit(1)
+            status = 'finished' if not e.code else 'failed'
+
+        except Exception:
+            logging.exception('Error in stage {0} for {1}'.format(stage.name, self.name))
+            status = 'failed'
+
+        elapsed = time.time() - start_time
+
+        if status == 'finished':
+            logging.debug('Finished stage {0} for {1} in {2:.1f} seconds'.format(stage.name, self.name, elapsed))
+        else:
+            logging.error('Stage {0} for {1} failed after {2:.1f} seconds'.format(stage.name, self.name, elapsed))
+
+        return status
+
+    def _worker(self, stage):
+        status = self.run_stage(stage)
+
+        # Record the stage without holding the condition, so a slow checkpoint doesn't hold up the other stages
+        if status == 'finished' and self.run_state:
+            try:
+                attributes = self.checkpoint(stage.name) if self.checkpoint else None
+                self.run_state.complete_stage(stage.name, attributes)
+
+            except Exception:
+                logging.exception('Error recording stage {0} for {1}'.format(stage.name, self.name))
+                status = 'failed'
+
+        with self._condition:
+            stage.status = status
+            self._running.remove(stage.name)
+            self._condition.notify_all()
+
+    def run(self):
+        """
+        Run all stages in the graph, then exit if any of them failed
+        :return:
+        """
+        if self.run_state:
+            for stage_name in self._stage_order:
+                if self.run_state.is_complete(stage_name):
+                    logging.info('Stage {0} for {1} completed in a previous run; '
+                                 'skipping'.format(stage_name, self.name))
+                    self.stages[stage_name].status = 'finished'
+
+        try:
+            self._run_stages()
+
+        finally:
+            if self._pool:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+        failed_stages = [s for s in self._stage_order if self.stages[s].status == 'failed']
+        skipped_stages = [s for s in self._stage_order if self.stages[s].status == 'skipped']
+
+        if self.run_state:
+            self.run_state.skip_stages(skipped_stages)
+
+        if failed_stages or skipped_stages:
+            logging.error('Update of {0} did not complete. Failed stages: {1}. Skipped stages: '
+                          '{2}. Exiting'.format(self.name, ', '.join(failed_stages) or 'none',
+                                                ', '.join(skipped_stages) or 'none'))
+            sys.exit(1)
+
+    def _run_stages(self):
+        with self._condition:
+            while True:
+                for stage in self._ready_stages():
+                    if len(self._running) >= self.max_workers:
+                        break
+
+                    stage.status = 'running'
+                    self._running.add(stage.name)
+
+                    worker = threading.Thread(target=self._worker, args=(stage,),
+                                              name='{0}.{1}'.format(self.name, stage.name))
+                    worker.daemon = True
+                    worker.start()
+
+                if not self._running:
+                    break
+
+                self._condition.wait()
+
+            # Anything still pending couldn't run, i.e. it depends on a stage that failed
+            for stage_name in self._stage_order:
+                if self.stages[stage_name].status == 'pending':
+                    logging.error('Skipping stage {0} for {1}; a stage it depends on did not '
+                                  'finish'.format(stage_name, self.name))
+                    self.stages[stage_name].status = 'skipped'
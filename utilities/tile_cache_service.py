@@ -8,6 +8,7 @@ import sys
 import shutil
 import urlparse
 
+from utilities import catalog
 from utilities import settings
 from utilities import util
 
@@ -81,7 +82,7 @@ def find_src_mxd(json_response):
 
     source_mxd = resources['onPremisePath']
 
-    if not arcpy.Exists(source_mxd):
+    if not catalog.exists(source_mxd):
         logging.error("Found path to source MXD {0} but arcpy doesn't think it exists. Exiting")
         sys.exit(1)
 
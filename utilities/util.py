@@ -1,4 +1,3 @@
-import arcpy
 import json
 import ctypes
 import itertools
@@ -6,14 +5,16 @@ import os
 import string
 import shutil
 import errno
-import win32file
 import sys
 import cartodb
+import catalog
 import logging
 import uuid
 import urllib2
 from ConfigParser import ConfigParser
 
+from lazy_import import arcpy
+
 
 def byteify(unicode_string):
     if isinstance(unicode_string, dict):
@@ -44,6 +45,9 @@ def list_network_drives():
     Grab all the drives on the current PC, returning those that are mapped through the network
     :return: list of network drives
     """
+    # Windows-only, and only needed when checking a source path; import here to keep startup fast
+    import win32file
+
     drive_bitmask = ctypes.cdll.kernel32.GetLogicalDrives()
     all_drives = list(itertools.compress(string.ascii_uppercase, map(lambda x: ord(x) - ord('0'),
                                                                      bin(drive_bitmask)[:1:-1])))
@@ -110,7 +114,7 @@ def is_wgs_84(input_dataset):
     :return: True/False if SRS is WGS84
     """
     logging.debug('Starting layer.isWGS84')
-    sr_as_string = arcpy.Describe(input_dataset).spatialReference.exporttostring()
+    sr_as_string = catalog.spatial_reference(input_dataset).exporttostring()
 
     first_element = sr_as_string.split(',')[0]
 
@@ -197,7 +201,7 @@ def add_field_and_calculate(fc, field_name, field_type, field_length, field_val,
     logging.debug("add_field_and_calculate: Adding field {0} and calculating to {1}".format(field_name, field_val))
 
     if field_name not in list_fields(fc, gfw_env):
-        arcpy.AddField_management(fc, field_name, field_type, "", "", field_length)
+        catalog.add_field(fc, field_name, field_type, "", "", field_length)
 
     if field_type in ['TEXT', 'DATE']:
         field_val = "'{0}'".format(field_val)
@@ -216,8 +220,8 @@ def list_fields(input_dataset, gfw_env):
     :return: list of fields
     """
 
-    if arcpy.Exists(input_dataset):
-        field_list = [x.name for x in arcpy.ListFields(input_dataset)]
+    if catalog.exists(input_dataset):
+        field_list = catalog.field_names(input_dataset)
 
     elif cartodb.cartodb_check_exists(input_dataset, gfw_env):
         field_list = cartodb.get_column_order(input_dataset, gfw_env)
@@ -240,7 +244,7 @@ def create_temp_id_field(input_dataset, in_gfw_env):
     """
 
     temp_id_fieldname = 'c_temp_id'
-    oid_field = [f.name for f in arcpy.ListFields(input_dataset) if f.type == 'OID'][0]
+    oid_field = [f.name for f in catalog.fields(input_dataset) if f.type == 'OID'][0]
 
     add_field_and_calculate(input_dataset, temp_id_fieldname, 'LONG', "", oid_field, in_gfw_env)
 